@@ -2,11 +2,19 @@ import os
 import json
 import logging
 import time
-import urllib
 import socket
+import sys
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import botocore
-import boto3
+import botocore.exceptions
+
+# boto3, botocore.config, urllib.request, ssl and hashlib are imported where
+# they are used, so that a cold start only pays for what its path needs.
+# Importing boto3 and building a client take longer than the rest of the
+# module put together.
 
 
 logger = logging.getLogger()
@@ -15,30 +23,232 @@ logging.getLogger('boto3').setLevel(logging.CRITICAL)
 logging.getLogger('botocore').setLevel(logging.CRITICAL)
 
 
-ec2_client = boto3.client("ec2")
+# Shared by every AWS client. Short connect timeouts keep an unreachable
+# endpoint from stalling a failover, the pool is large enough for concurrent
+# route replacement, and keep-alive lets warm invocations reuse connections.
+# The standard retry mode is the only retry layer, including for ReplaceRoute:
+# it retries throttling and transient errors with backoff, up to
+# total_max_attempts calls in all. ("max_attempts" would count retries only.)
+CLIENT_CONFIG_OPTIONS = {
+    "connect_timeout": 3,
+    "read_timeout": 10,
+    "max_pool_connections": 10,
+    "tcp_keepalive": True,
+    "retries": {"mode": "standard", "total_max_attempts": 3},
+}
+
+# Clients are created on first use, once per service, and reused across calls
+# and warm invocations.
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(service):
+    client = clients.get(service)
+    if client is None:
+        # Client creation from the default session is not thread-safe
+        with clients_lock:
+            client = clients.get(service)
+            if client is None:
+                import boto3
+                import botocore.config
+                client = boto3.client(service, config=botocore.config.Config(**CLIENT_CONFIG_OPTIONS))
+                clients[service] = client
+    return client
+
 
 LIFECYCLE_HOOK_NAME_KEY = "LifecycleHookName"
 AUTO_SCALING_GROUP_NAME_KEY = "AutoScalingGroupName"
 LIFECYCLE_ACTION_TOKEN_KEY = "LifecycleActionToken"
+EC2_INSTANCE_ID_KEY = "EC2InstanceId"
+
+# EventBridge events that trigger an immediate failover
+EC2_STATE_CHANGE_DETAIL_TYPE = "EC2 Instance State-change Notification"
+CLOUDWATCH_ALARM_DETAIL_TYPE = "CloudWatch Alarm State Change"
+FAILOVER_INSTANCE_STATES = ("stopping", "stopped", "shutting-down", "terminated")
+
+# Tag set on every NAT instance by the launch template
+NAT_INSTANCE_TAG = "alterNATInstance"
 
-# Checks every CONNECTIVITY_CHECK_INTERVAL seconds, exits after 1 minute
+# Checks every CONNECTIVITY_CHECK_INTERVAL seconds, exits after 1 minute.
+# Fractional values are allowed for sub-second checks.
 DEFAULT_CONNECTIVITY_CHECK_INTERVAL = "5"
 
+# Seconds between scheduled connectivity tester invocations.
+CONNECTIVITY_TEST_PERIOD = 60
+
+# With ENABLE_ADAPTIVE_CHECK_INTERVAL, checks back off from every
+# CONNECTIVITY_CHECK_INTERVAL seconds to every CONNECTIVITY_CHECK_SLOW_INTERVAL
+# seconds after CONNECTIVITY_CHECK_HEALTHY_STREAK healthy rounds in a row, and
+# return to the fast interval as soon as a check fails or its probes take longer
+# than CONNECTIVITY_CHECK_SLOW_PROBE seconds.
+DEFAULT_ENABLE_ADAPTIVE_CHECK_INTERVAL = False
+DEFAULT_CONNECTIVITY_CHECK_SLOW_INTERVAL = "20"
+DEFAULT_CONNECTIVITY_CHECK_HEALTHY_STREAK = "12"
+DEFAULT_CONNECTIVITY_CHECK_SLOW_PROBE = "1"
+
+# The long running monitor (see run_monitor) serves its health on
+# MONITOR_HEALTH_HOST:MONITOR_HEALTH_PORT, and reports unhealthy once a target
+# hasn't completed a check for MONITOR_STALE_AFTER seconds. Saturation, shard
+# and load sharing checks run every MONITOR_MAINTENANCE_INTERVAL seconds, as
+# they do once per connectivity tester invocation.
+DEFAULT_MONITOR_HEALTH_HOST = "127.0.0.1"
+DEFAULT_MONITOR_HEALTH_PORT = "8080"
+DEFAULT_MONITOR_STALE_AFTER = "60"
+DEFAULT_MONITOR_MAINTENANCE_INTERVAL = "60"
+
+# Maximum number of manifest targets checked at once when a single tester
+# covers several route table sets via CONNECTIVITY_TEST_MANIFEST.
+DEFAULT_CONNECTIVITY_TEST_MAX_CONCURRENCY = "8"
+
+# How connectivity is probed. "http" makes a full request, "tcp" only opens a
+# connection and "tls" completes a TLS handshake without sending a request.
+# "session" makes a HEAD request over a kept-alive connection to each URL,
+# reused for the rest of the invocation, and times each layer separately.
+DEFAULT_CONNECTIVITY_PROBE_TYPE = "http"
+CONNECTIVITY_PROBE_TYPES = ("http", "tcp", "tls", "session")
+
+# Replace the route after this many consecutive failed checks occurring within
+# CONNECTIVITY_FAILURE_WINDOW seconds.
+DEFAULT_CONNECTIVITY_FAILURE_THRESHOLD = "1"
+DEFAULT_CONNECTIVITY_FAILURE_WINDOW = "60"
+
 # Which URLs to check for connectivity
 DEFAULT_CHECK_URLS = ["https://www.example.com", "https://www.google.com"]
 
-# The timeout for the connectivity checks.
+# The timeout for the connectivity checks. Override with CONNECTIVITY_CHECK_TIMEOUT.
 REQUEST_TIMEOUT = 5
 
+# Route tables are replaced concurrently by up to this many workers, which
+# matches the connection pool size in CLIENT_CONFIG_OPTIONS.
+ROUTE_REPLACEMENT_MAX_WORKERS = 10
+
+# DescribeRouteTables is eventually consistent and can show the old route for
+# a moment after ReplaceRoute, so a mismatch is described again this many
+# times, with a delay that doubles from ROUTE_VERIFICATION_INITIAL_DELAY.
+ROUTE_VERIFICATION_ATTEMPTS = 4
+ROUTE_VERIFICATION_INITIAL_DELAY = 0.25
+
+# Failover only falls back to NAT Gateways in the failed zone, unless
+# ENABLE_CROSS_AZ_FALLBACK allows the rest of the VPC's NAT Gateways, at the
+# cost of cross-AZ data transfer charges until the NAT instance is restored.
+DEFAULT_ENABLE_CROSS_AZ_FALLBACK = False
+
 # Waiting time for SSM to start commands.
 SSM_TIMEOUT_SECONDS = 30
 
+# SSM command results are polled after SSM_POLL_INITIAL_DELAY seconds, doubling
+# the delay up to SSM_POLL_MAX_DELAY, for at most SSM_COMMAND_WAIT_SECONDS.
+SSM_POLL_INITIAL_DELAY = 0.25
+SSM_POLL_MAX_DELAY = 2
+SSM_COMMAND_WAIT_SECONDS = 20
+SSM_PENDING_STATUSES = ("Pending", "InProgress", "Delayed")
+
 # Whether or not return to the nat instance when the nat gateway is used.
 DEFAULT_ENABLE_NAT_RESTORE = False
 
 # Whether or not use IPv6.
 DEFAULT_HAS_IPV6 = True
 
+# Whether to emit the duration of each failover and restore phase as CloudWatch
+# Embedded Metric Format records. These are billed as custom metrics.
+DEFAULT_ENABLE_METRICS = False
+DEFAULT_METRICS_NAMESPACE = "alterNAT"
+
+# Seconds that VPC, NAT Gateway and ASG lookups are cached across warm invocations.
+DEFAULT_TOPOLOGY_CACHE_TTL = "300"
+
+# Route state recorded for each route table is trusted instead of describing
+# the route tables again for up to this many seconds.
+DEFAULT_ROUTE_STATE_MAX_AGE = "300"
+
+# Minimum seconds between failing over to a NAT Gateway and attempting to
+# restore the NAT instance, so that restore and failover can't flap each minute.
+DEFAULT_NAT_RESTORE_HOLDDOWN = "300"
+
+# Upper bound for the hold-down, which doubles after every restore that is
+# followed by another failover within the maximum hold-down.
+DEFAULT_NAT_RESTORE_MAX_HOLDDOWN = "3600"
+
+# A NAT instance must pass this many consecutive health checks, spanning at
+# least NAT_RESTORE_HEALTHY_WINDOW seconds, before routes are restored to it.
+DEFAULT_NAT_RESTORE_HEALTHY_CHECKS = "1"
+DEFAULT_NAT_RESTORE_HEALTHY_WINDOW = "0"
+
+# Whether to restore the route tables of the tester's own subnets first and
+# verify them with the tester's probes before the rest
+DEFAULT_NAT_RESTORE_CANARY = False
+
+# Seconds to let a restored canary route settle before probing through it
+CANARY_SETTLE_SECONDS = 2
+
+# ethtool counters collected by the CloudWatch agent on NAT instances that
+# count packets the instance dropped for exceeding an EC2 network allowance
+SATURATION_METRICS = (
+    "conntrack_allowance_exceeded",
+    "bw_out_allowance_exceeded",
+    "pps_allowance_exceeded",
+)
+DEFAULT_ENABLE_SATURATION_FAILOVER = False
+DEFAULT_CLOUDWATCH_NAMESPACE = "alterNAT"
+DEFAULT_SATURATION_LOOKBACK = "300"
+
+# Route tables shift to the NAT Gateway once the allowances are exceeded more
+# than SATURATION_THRESHOLD times within the lookback, and shift back once
+# they are exceeded no more than SATURATION_RECOVERY_THRESHOLD times.
+DEFAULT_SATURATION_THRESHOLD = "100"
+DEFAULT_SATURATION_RECOVERY_THRESHOLD = "0"
+
+# Fraction of a NAT instance's route tables shifted when it is saturated
+DEFAULT_SATURATION_SHIFT_FRACTION = "1"
+
+# Shifted route tables stay on the NAT Gateway for at least
+# SATURATION_HOLDDOWN seconds, doubling each time the instance saturates again
+# soon after they shift back, up to SATURATION_MAX_HOLDDOWN seconds. Keep it
+# longer than SATURATION_LOOKBACK, so that recovery is judged on counts taken
+# after the shift.
+DEFAULT_SATURATION_HOLDDOWN = "600"
+DEFAULT_SATURATION_MAX_HOLDDOWN = "3600"
+
+# Load sharing splits route tables between the NAT instance and NAT Gateways
+# by weight, rebalancing at most every LOAD_SHARING_INTERVAL seconds. In
+# LOAD_SHARING_WEIGHTS, "instance" is the NAT instance and "gateway" the
+# preferred standby NAT Gateway; other NAT Gateways are named by ID.
+DEFAULT_ENABLE_LOAD_SHARING = False
+DEFAULT_LOAD_SHARING_WEIGHTS = '{"instance": 1}'
+DEFAULT_LOAD_SHARING_INTERVAL = "900"
+
+# Whether route tables are sharded across every InService NAT instance of an
+# ASG, rather than all routed through the first one
+DEFAULT_SHARD_ROUTE_TABLES = False
+
+# Lifecycle action tokens already handled, mapped to when they may be
+# forgotten, so that SNS redeliveries to a warm Lambda do no work.
+LIFECYCLE_TOKEN_TTL = 3600
+processed_lifecycle_tokens = {}
+processed_lifecycle_tokens_lock = threading.Lock()
+
+# Brownout detection keeps the round trip time and outcome of each probe, per
+# URL, for BROWNOUT_WINDOW seconds. Once a URL has BROWNOUT_MIN_SAMPLES, it is
+# degraded if its p90 latency (in ms) or its error ratio exceed the limits. The
+# NAT instance is browned out when every URL is degraded, and
+# BROWNOUT_SHIFT_FRACTION of its route tables shift to the NAT Gateway.
+DEFAULT_ENABLE_BROWNOUT_DETECTION = False
+DEFAULT_BROWNOUT_P90_LATENCY = "2000"
+DEFAULT_BROWNOUT_ERROR_RATIO = "0.5"
+DEFAULT_BROWNOUT_WINDOW = "300"
+DEFAULT_BROWNOUT_MIN_SAMPLES = "10"
+DEFAULT_BROWNOUT_SHIFT_FRACTION = "1"
+LATENCY_SAMPLES_PER_URL = 500
+
+# Route state flags of route tables deliberately moved to a NAT Gateway, which
+# NAT restore leaves to the feature that moved them
+HELD_ROUTE_FLAGS = ("saturated", "load_shared", "brownout")
+
+# Maps a lookup key to a (value, expiry) tuple. Kept at module level so that it
+# survives between invocations of a warm Lambda.
+topology_cache = {}
+
 
 # Overrides socket.getaddrinfo to perform IPv4 lookups
 # See https://github.com/chime/terraform-aws-alternat/issues/87
@@ -51,8 +261,318 @@ def disable_ipv6():
     socket.getaddrinfo = getaddrinfo_ipv4
 
 
+metrics_lock = threading.Lock()
+
+
+def put_metric(name, value, unit, **properties):
+    """
+    Prints a CloudWatch Embedded Metric Format record to stdout, where the
+    Lambda runtime ships it to CloudWatch Logs to be extracted as a metric.
+    The metric has FunctionName and Phase dimensions; other properties are
+    searchable in the logs but are not dimensions.
+    """
+    if not get_env_bool("ENABLE_METRICS", DEFAULT_ENABLE_METRICS):
+        return
+
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": os.getenv("METRICS_NAMESPACE", DEFAULT_METRICS_NAMESPACE),
+                    "Dimensions": [["FunctionName", "Phase"]],
+                    "Metrics": [{"Name": name, "Unit": unit}],
+                }
+            ],
+        },
+        "FunctionName": os.getenv("AWS_LAMBDA_FUNCTION_NAME", "local"),
+        "Phase": properties.pop("phase", "none"),
+        name: value,
+    }
+    record.update(properties)
+    # print writes the record and newline separately, so records from worker
+    # threads could interleave and no longer parse as EMF
+    line = json.dumps(record) + "\n"
+    with metrics_lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+
+@contextmanager
+def timed_phase(phase, **properties):
+    """
+    Times the enclosed block and emits it as a PhaseDuration metric, including
+    whether the phase raised.
+    """
+    start = time.perf_counter()
+    succeeded = False
+    try:
+        yield
+        succeeded = True
+    finally:
+        duration = (time.perf_counter() - start) * 1000
+        logger.debug("Phase %s took %.1fms", phase, duration)
+        put_metric("PhaseDuration", duration, "Milliseconds", phase=phase, Succeeded=succeeded, **properties)
+
+
+def get_cached_topology(key, resolver, *args):
+    """
+    Returns the cached result of resolver(*args) for key, calling the resolver
+    only if there is no entry or it is older than TOPOLOGY_CACHE_TTL seconds.
+    """
+    now = time.monotonic()
+    entry = topology_cache.get(key)
+    if entry and entry[1] > now:
+        return entry[0]
+
+    value = resolver(*args)
+    ttl = float(os.getenv("TOPOLOGY_CACHE_TTL", DEFAULT_TOPOLOGY_CACHE_TTL))
+    topology_cache[key] = (value, now + ttl)
+    return value
+
+
+def invalidate_topology_cache():
+    logger.info("Invalidating cached VPC and NAT Gateway topology")
+    topology_cache.clear()
+
+
+def prefetch_topology(route_tables, public_subnet_id, target=None):
+    """
+    Resolves the VPC and standby NAT Gateway ahead of any failure so that a
+    failover only has to replace routes, and checks that the standby NAT
+    Gateways are still available.
+    """
+    try:
+        vpc_id = get_vpc_id(route_tables[0], target)
+        candidates = get_nat_gateway_candidates(vpc_id, public_subnet_id, target)
+        get_cached_topology(
+            ("nat_gateway_validation", *candidates), validate_nat_gateway_candidates, candidates
+        )
+    except Exception as error:
+        logger.warning("Unable to prefetch VPC and NAT Gateway topology: %s", error)
+
+
+class MemoryStateStore:
+    """
+    Keeps route state in memory. It survives between invocations of a warm
+    Lambda only, which is enough to avoid repeating work within a run.
+    """
+
+    def __init__(self):
+        self.items = {}
+
+    def get(self, keys):
+        return {key: dict(self.items[key]) for key in keys if key in self.items}
+
+    def update(self, items):
+        for key, values in items.items():
+            self.items.setdefault(key, {}).update(values)
+
+
+class DynamoDBStateStore:
+    """
+    Keeps route state in a DynamoDB table keyed by RouteTableId, so that it is
+    shared by every invocation and by both functions. Each field of a route
+    table's state is a separate JSON encoded attribute, so that updates never
+    need a read and updates of different fields never overwrite each other.
+    """
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+    def get(self, keys):
+        client = get_client("dynamodb")
+        states = {}
+        keys = list(keys)
+        # BatchGetItem reads at most 100 items per call
+        for i in range(0, len(keys), 100):
+            response = client.batch_get_item(RequestItems={
+                self.table_name: {
+                    "Keys": [{"RouteTableId": {"S": key}} for key in keys[i:i + 100]],
+                    "ConsistentRead": True,
+                }
+            })
+            for item in response["Responses"].get(self.table_name, []):
+                states[item["RouteTableId"]["S"]] = {
+                    name: json.loads(value["S"]) for name, value in item.items() if name != "RouteTableId"
+                }
+        return states
+
+    def update(self, items):
+        items = {key: values for key, values in items.items() if values}
+        if not items:
+            return
+        # Updates are on the failover path, so route tables are written concurrently
+        with ThreadPoolExecutor(max_workers=min(len(items), ROUTE_REPLACEMENT_MAX_WORKERS)) as executor:
+            list(executor.map(self.update_item, items.keys(), items.values()))
+
+    def update_item(self, key, values):
+        fields = list(values)
+        get_client("dynamodb").update_item(
+            TableName=self.table_name,
+            Key={"RouteTableId": {"S": key}},
+            UpdateExpression="SET " + ", ".join(f"#f{i} = :v{i}" for i in range(len(fields))),
+            ExpressionAttributeNames={f"#f{i}": field for i, field in enumerate(fields)},
+            ExpressionAttributeValues={f":v{i}": {"S": json.dumps(values[field])} for i, field in enumerate(fields)},
+        )
+
+
+memory_state_store = MemoryStateStore()
+
+
+def get_state_store():
+    table_name = os.getenv("STATE_TABLE_NAME")
+    if table_name:
+        return DynamoDBStateStore(table_name)
+    return memory_state_store
+
+
+def load_route_states(route_tables):
+    try:
+        return get_state_store().get(route_tables)
+    except Exception as error:
+        logger.warning("Unable to load route state: %s", error)
+        return {}
+
+
+def record_route_states(items):
+    # State is an optimisation, so failing to save it must never fail a failover
+    try:
+        get_state_store().update(items)
+    except Exception as error:
+        logger.warning("Unable to save route state: %s", error)
+
+
+def record_route_targets(route_tables, target_id, planned=False):
+    """
+    Records target_id as the target of route_tables. Only failovers and NAT
+    restores count towards the restore hold-down. Planned moves, such as
+    load sharing, shard moves and shifts, only record the target.
+    """
+    now = time.time()
+    if planned:
+        record_route_states({rtb: {"target": target_id, "updated": now} for rtb in route_tables})
+        return
+    if target_id.startswith("i-"):
+        record_route_states({rtb: {"target": target_id, "updated": now, "last_restore": now} for rtb in route_tables})
+        return
+
+    # A failover soon after a restore means the restore failed, so back off
+    # further before the next one. A failover long after resets the backoff.
+    max_holddown = float(os.getenv("NAT_RESTORE_MAX_HOLDDOWN", DEFAULT_NAT_RESTORE_MAX_HOLDDOWN))
+    states = load_route_states(route_tables)
+    items = {}
+    for rtb in route_tables:
+        state = states.get(rtb, {})
+        last_restore = state.get("last_restore", 0)
+        restore_failures = state.get("restore_failures", 0)
+        if last_restore > state.get("last_failover", 0):
+            restore_failures = restore_failures + 1 if now - last_restore < max_holddown else 0
+        items[rtb] = {
+            "target": target_id,
+            "updated": now,
+            "last_failover": now,
+            "restore_failures": restore_failures,
+            "healthy_checks": 0,
+        }
+    record_route_states(items)
+
+
+def is_using_nat_gateway(route_tables):
+    """
+    Returns whether any of route_tables routes through a NAT Gateway, from the
+    recorded route state if it is recent enough, otherwise by describing them.
+    The described targets are recorded in turn, so that routes which don't
+    change are only described once every ROUTE_STATE_MAX_AGE seconds.
+    """
+    states = load_route_states(route_tables)
+    max_age = float(os.getenv("ROUTE_STATE_MAX_AGE", DEFAULT_ROUTE_STATE_MAX_AGE))
+    now = time.time()
+    if all(rtb in states and "target" in states[rtb] and now - states[rtb]["updated"] < max_age for rtb in route_tables):
+        logger.debug("Using recorded route state for %s", route_tables)
+        return any(states[rtb]["target"].startswith("nat-") for rtb in route_tables)
+
+    try:
+        routes = inspect_routes(route_tables)
+    except Exception as e:
+        logger.error(f"Error checking NAT Gateway routes: {e}")
+        return False
+    record_route_states({
+        rtb: {"target": route["target_id"], "updated": now}
+        for rtb, route in routes.items()
+        if route["target_id"] and route["state"] == "active"
+    })
+    return any(route["target_type"] == "nat_gateway" and route["state"] == "active" for route in routes.values())
+
+
+def is_shift_held_down(route_tables):
+    """
+    Returns whether route_tables were shifted to a NAT Gateway less than
+    NAT_RESTORE_HOLDDOWN seconds ago. Shifts are planned, so unlike failovers
+    they don't extend the hold-down.
+    """
+    last_shifted = max((state.get("last_shifted", 0) for state in load_route_states(route_tables).values()), default=0)
+    remaining = last_shifted + get_restore_holddown(0) - time.time()
+    if remaining > 0:
+        logger.info("Shifted to NAT Gateway recently, not shifting back for another %.0fs", remaining)
+        return True
+    return False
+
+
+def get_restore_holddown(restore_failures):
+    holddown = float(os.getenv("NAT_RESTORE_HOLDDOWN", DEFAULT_NAT_RESTORE_HOLDDOWN))
+    max_holddown = float(os.getenv("NAT_RESTORE_MAX_HOLDDOWN", DEFAULT_NAT_RESTORE_MAX_HOLDDOWN))
+    return min(holddown * 2 ** restore_failures, max_holddown)
+
+
+def is_restore_held_down(route_tables):
+    states = load_route_states(route_tables).values()
+    if not states:
+        return False
+    state = max(states, key=lambda state: state.get("last_failover", 0))
+    holddown = get_restore_holddown(state.get("restore_failures", 0))
+    remaining = state.get("last_failover", 0) + holddown - time.time()
+    if remaining > 0:
+        logger.info("Failed over %.0fs ago, not restoring NAT instance for another %.0fs", holddown - remaining, remaining)
+        return True
+    return False
+
+
+def record_restore_health_check(route_tables, healthy):
+    """
+    Records the result of a NAT instance health check and returns whether the
+    streak of healthy checks is long enough to restore routes to the instance.
+    """
+    if not healthy:
+        record_route_states({rtb: {"healthy_checks": 0} for rtb in route_tables})
+        return False
+
+    required_checks = int(os.getenv("NAT_RESTORE_HEALTHY_CHECKS", DEFAULT_NAT_RESTORE_HEALTHY_CHECKS))
+    required_window = float(os.getenv("NAT_RESTORE_HEALTHY_WINDOW", DEFAULT_NAT_RESTORE_HEALTHY_WINDOW))
+    states = load_route_states(route_tables)
+    now = time.time()
+    streak = min(states.get(rtb, {}).get("healthy_checks", 0) for rtb in route_tables)
+    healthy_since = max(states.get(rtb, {}).get("healthy_since", now) for rtb in route_tables) if streak else now
+    streak += 1
+    record_route_states({rtb: {"healthy_checks": streak, "healthy_since": healthy_since} for rtb in route_tables})
+
+    if streak < required_checks or now - healthy_since < required_window:
+        logger.info(
+            "NAT instance passed %d of %d health checks over %.0fs of %.0fs, not restoring yet",
+            streak, required_checks, now - healthy_since, required_window
+        )
+        return False
+    return True
+
+
 def get_az_and_vpc_zone_identifier(auto_scaling_group):
-    autoscaling = boto3.client("autoscaling")
+    return get_cached_topology(
+        ("asg", auto_scaling_group), describe_az_and_vpc_zone_identifier, auto_scaling_group
+    )
+
+
+def describe_az_and_vpc_zone_identifier(auto_scaling_group):
+    autoscaling = get_client("autoscaling")
 
     try:
         asg_objects = autoscaling.describe_auto_scaling_groups(AutoScalingGroupNames=[auto_scaling_group])
@@ -75,9 +595,22 @@ def get_az_and_vpc_zone_identifier(auto_scaling_group):
     raise MissingVPCZoneIdentifierError(asg_objects)
 
 
-def get_vpc_id(route_table):
+def get_vpc_id(route_table, target=None):
+    """
+    Returns the VPC of route_table. A "vpc_id" set on a connectivity target,
+    or the VPC_ID env. variable when there is no target, skips the lookup.
+    """
+    vpc_id = target.get("vpc_id") if target is not None else os.getenv("VPC_ID")
+    if vpc_id:
+        logger.debug("Using configured VPC ID (%s)", vpc_id)
+        return vpc_id
+
+    return get_cached_topology(("vpc_id", route_table), describe_vpc_id, route_table)
+
+
+def describe_vpc_id(route_table):
     try:
-        route_tables = ec2_client.describe_route_tables(RouteTableIds=[route_table])
+        route_tables = get_client("ec2").describe_route_tables(RouteTableIds=[route_table])
     except botocore.exceptions.ClientError as error:
         logger.error("Unable to get vpc id")
         raise error
@@ -87,40 +620,181 @@ def get_vpc_id(route_table):
     return vpc_id
 
 
-def get_nat_gateway_id(vpc_id, subnet_id):
-    nat_gateway_id = os.getenv("NAT_GATEWAY_ID")
+def get_nat_gateway_candidates(vpc_id, subnet_id, target=None):
+    """
+    Returns the standby NAT Gateways for subnet_id, most preferred first. Like
+    get_vpc_id, a target's "nat_gateway_id" or the NAT_GATEWAY_ID env. variable
+    overrides it. Otherwise the ranking comes from the NAT_GATEWAY_CANDIDATES
+    env. variable, which the Terraform module sets to the NAT Gateways it
+    creates, so that a failover makes no lookup even in a Lambda whose cache is
+    cold. Failing that, the NAT Gateways are described and ranked, and cached
+    with the rest of the topology.
+    """
+    nat_gateway_id = target.get("nat_gateway_id") if target is not None else os.getenv("NAT_GATEWAY_ID")
     if nat_gateway_id:
-        logger.info("Using NAT_GATEWAY_ID env. variable (%s)", nat_gateway_id)
-        return nat_gateway_id
+        logger.info("Using configured NAT Gateway ID (%s)", nat_gateway_id)
+        return [nat_gateway_id]
+
+    candidates = json.loads(os.getenv("NAT_GATEWAY_CANDIDATES", "{}")).get(subnet_id)
+    if candidates:
+        logger.debug("Using configured NAT Gateway candidates for %s: %s", subnet_id, candidates)
+        return candidates
 
+    cross_az = get_env_bool("ENABLE_CROSS_AZ_FALLBACK", DEFAULT_ENABLE_CROSS_AZ_FALLBACK)
+    return get_cached_topology(
+        ("nat_gateway_candidates", vpc_id, subnet_id, cross_az), describe_nat_gateway_candidates, vpc_id, subnet_id, cross_az
+    )
+
+
+def describe_nat_gateway_candidates(vpc_id, subnet_id, cross_az=False):
+    """
+    Lists the available NAT Gateways in vpc_id ranked for routes from the AZ of
+    subnet_id: the gateway in subnet_id itself, then any others in the same AZ,
+    then, only if cross_az is set, the rest of the VPC.
+    """
     try:
-        nat_gateways = ec2_client.describe_nat_gateways(
-            Filters=[
-                {
-                    "Name": "vpc-id",
-                    "Values": [vpc_id]
-                },
-                {
-                    "Name": "subnet-id",
-                    "Values": [subnet_id]
-                },
-                {
-                    "Name": "state",
-                    "Values": ["available"]
-                }
-            ]
-        )
+        paginator = get_client("ec2").get_paginator("describe_nat_gateways")
+        nat_gateways = [
+            nat_gateway
+            for page in paginator.paginate(
+                Filters=[
+                    {
+                        "Name": "vpc-id",
+                        "Values": [vpc_id]
+                    },
+                    {
+                        "Name": "state",
+                        "Values": ["available"]
+                    }
+                ]
+            )
+            for nat_gateway in page["NatGateways"]
+        ]
+        subnet_ids = sorted({subnet_id} | {nat_gateway["SubnetId"] for nat_gateway in nat_gateways})
+        subnets = get_client("ec2").describe_subnets(SubnetIds=subnet_ids)["Subnets"]
     except botocore.exceptions.ClientError as error:
         logger.error("Unable to describe nat gateway")
         raise error
 
     logger.debug("NAT Gateways: %s", nat_gateways)
-    if len(nat_gateways.get("NatGateways")) < 1:
-        raise MissingNatGatewayError(nat_gateways)
+    if len(nat_gateways) < 1:
+        raise MissingNatGatewayError(vpc_id, subnet_id)
+
+    subnet_azs = {subnet["SubnetId"]: subnet["AvailabilityZone"] for subnet in subnets}
 
-    nat_gateway_id = nat_gateways['NatGateways'][0]["NatGatewayId"]
-    logger.debug("NAT Gateway ID: %s", nat_gateway_id)
-    return nat_gateway_id
+    def rank(nat_gateway):
+        if nat_gateway["SubnetId"] == subnet_id:
+            return 0
+        if subnet_azs.get(nat_gateway["SubnetId"]) == subnet_azs.get(subnet_id):
+            return 1
+        return 2
+
+    candidates = [
+        nat_gateway["NatGatewayId"] for nat_gateway in sorted(nat_gateways, key=rank) if cross_az or rank(nat_gateway) < 2
+    ]
+    if not candidates:
+        raise MissingNatGatewayError(vpc_id, subnet_id)
+    logger.debug("NAT Gateway candidates for %s: %s", subnet_id, candidates)
+    return candidates
+
+
+def validate_nat_gateway_candidates(candidates):
+    """
+    Checks that the standby NAT Gateways in candidates are available, so that
+    a broken standby is reported before a failover has to skip it. Returns the
+    unavailable ones, which order_nat_gateway_candidates moves to the end.
+    """
+    try:
+        # Unlike NatGatewayIds, a filter doesn't fail on a deleted NAT Gateway
+        nat_gateways = get_client("ec2").describe_nat_gateways(
+            Filters=[{"Name": "nat-gateway-id", "Values": candidates}]
+        )["NatGateways"]
+    except botocore.exceptions.ClientError as error:
+        logger.error("Unable to describe standby NAT Gateways %s: %s", candidates, error)
+        nat_gateways = []
+
+    available = {nat_gateway["NatGatewayId"] for nat_gateway in nat_gateways if nat_gateway["State"] == "available"}
+    unavailable = [nat_gateway_id for nat_gateway_id in candidates if nat_gateway_id not in available]
+    if unavailable:
+        logger.error("Standby NAT Gateways %s are not available, failover will try them last", unavailable)
+    put_metric("UnavailableStandbyNatGateways", len(unavailable), "Count")
+    return unavailable
+
+
+def order_nat_gateway_candidates(candidates):
+    """
+    Moves the candidates that the cached result of
+    validate_nat_gateway_candidates found unavailable to the end, so that a
+    failover doesn't spend a ReplaceRoute and its verification on them first.
+    They are kept as a last resort in case they have recovered since. Makes
+    no API calls.
+    """
+    entry = topology_cache.get(("nat_gateway_validation", *candidates))
+    unavailable = entry[0] if entry and entry[1] > time.monotonic() else []
+    return [c for c in candidates if c not in unavailable] + [c for c in candidates if c in unavailable]
+
+
+def inspect_routes(route_tables):
+    """
+    Describes route_tables with a single paginated query and returns the
+    default route of each as a dict with its target_type ("instance",
+    "nat_gateway", "network_interface" or "other"), target_id and state
+    ("active" or "blackhole"). Route tables without a default route are left
+    out.
+    """
+    paginator = get_client("ec2").get_paginator("describe_route_tables")
+    routes = {}
+    # A filter takes at most 200 values
+    for i in range(0, len(route_tables), 200):
+        pages = paginator.paginate(Filters=[{"Name": "route-table-id", "Values": route_tables[i:i + 200]}])
+        for page in pages:
+            for rtb in page["RouteTables"]:
+                for route in rtb.get("Routes", []):
+                    if route.get("DestinationCidrBlock") == "0.0.0.0/0":
+                        routes[rtb["RouteTableId"]] = describe_route_target(route)
+    return routes
+
+
+def describe_route_target(route):
+    # A route to an instance also names its network interface, so check it first
+    for target_type, key in (
+        ("instance", "InstanceId"),
+        ("nat_gateway", "NatGatewayId"),
+        ("network_interface", "NetworkInterfaceId"),
+    ):
+        if key in route:
+            return {"target_type": target_type, "target_id": route[key], "state": route.get("State")}
+    target_id = next((value for key, value in route.items() if key.endswith("Id")), None)
+    return {"target_type": "other", "target_id": target_id, "state": route.get("State")}
+
+
+def verify_routes(route_tables, target_id):
+    """
+    Returns the route tables whose default route does not actively point at
+    target_id, as a dict mapping each to a RouteVerificationError.
+    """
+    routes = inspect_routes(route_tables)
+    return {
+        rtb: RouteVerificationError(rtb, target_id, routes.get(rtb))
+        for rtb in route_tables
+        if routes.get(rtb, {}).get("target_id") != target_id or routes[rtb].get("state") != "active"
+    }
+
+
+def poll_route_verification(route_tables, target_id):
+    """
+    Like verify_routes, but describes mismatched route tables again with
+    backoff before reporting them.
+    """
+    delay = ROUTE_VERIFICATION_INITIAL_DELAY
+    unverified = verify_routes(route_tables, target_id)
+    for _ in range(ROUTE_VERIFICATION_ATTEMPTS - 1):
+        if not unverified:
+            break
+        time.sleep(delay)
+        delay *= 2
+        unverified = verify_routes(list(unverified), target_id)
+    return unverified
 
 
 def replace_route(route_table_id, target_id):
@@ -136,71 +810,233 @@ def replace_route(route_table_id, target_id):
 
     try:
         logger.info("Replacing existing route %s for route table %s", route_table_id, new_route_table)
-        ec2_client.replace_route(**new_route_table)
+        get_client("ec2").replace_route(**new_route_table)
     except botocore.exceptions.ClientError as error:
         logger.error("Unable to replace route")
         raise error
 
-def run_nat_instance_diagnostics(instance_id):
+
+def timed_replace_route(route_table_id, target_id):
+    with timed_phase("route_table_replacement", RouteTableId=route_table_id, TargetId=target_id):
+        replace_route(route_table_id, target_id)
+
+
+def replace_routes(route_tables, target_id, planned=False):
+    """
+    Points every route table in route_tables at target_id. Tables are replaced
+    concurrently, each retried by the client's standard retry mode, so the
+    total latency is close to a single ReplaceRoute call regardless of the
+    number of tables.
+
+    Afterwards the routes are inspected, and a table whose route still does
+    not actively point at target_id after a few attempts counts as failed
+    with a RouteVerificationError.
+
+    Returns a dict mapping each route table to None on success or to the error
+    that caused it to fail. Raises RouteReplacementError if any table failed,
+    after every table has been attempted. planned is passed on to
+    record_route_targets.
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(len(route_tables), ROUTE_REPLACEMENT_MAX_WORKERS)) as executor:
+        futures = {executor.submit(timed_replace_route, rtb, target_id): rtb for rtb in route_tables}
+        for future in as_completed(futures):
+            results[futures[future]] = future.exception()
+
+    failed = {rtb: error for rtb, error in results.items() if error is not None}
+    replaced = [rtb for rtb in route_tables if rtb not in failed]
+    if replaced:
+        # Replacement already succeeded, so a failed check is only logged
+        try:
+            with timed_phase("route_verification", RouteTableCount=len(replaced)):
+                failed.update(poll_route_verification(replaced, target_id))
+        except Exception as error:
+            logger.warning("Unable to verify routes to %s: %s", target_id, error)
+    logger.info("Replaced route to %s in %d of %d route tables", target_id, len(results) - len(failed), len(results))
+    record_route_targets([rtb for rtb in results if rtb not in failed], target_id, planned)
+    if failed:
+        for rtb, error in failed.items():
+            logger.error("Unable to replace route in %s: %s", rtb, error)
+        raise RouteReplacementError(failed)
+    return results
+
+
+def fail_over_to_nat_gateway(route_tables, subnet_id, target=None, planned=False):
+    """
+    Points route_tables at the preferred standby NAT Gateway for subnet_id. Any
+    tables that can't be replaced move on to the next candidate. Returns a dict
+    mapping each route table to the NAT Gateway it now uses. Set planned for
+    moves that aren't a failure, see record_route_targets.
+    """
+    with timed_phase("topology_lookup"):
+        vpc_id = get_vpc_id(route_tables[0], target)
+        candidates = order_nat_gateway_candidates(get_nat_gateway_candidates(vpc_id, subnet_id, target))
+
+    with timed_phase("route_replacement", RouteTableCount=len(route_tables)):
+        return replace_routes_with_fallback(route_tables, candidates, planned)
+
+
+def replace_routes_with_fallback(route_tables, candidates, planned=False):
+    targets = {}
+    remaining = list(route_tables)
+    for nat_gateway_id in candidates:
+        try:
+            replace_routes(remaining, nat_gateway_id, planned)
+            targets.update((rtb, nat_gateway_id) for rtb in remaining)
+            return targets
+        except RouteReplacementError as error:
+            # ReplaceRoute succeeded for route tables that only failed
+            # verification, and another NAT Gateway wouldn't fare any better
+            failed = {rtb: e for rtb, e in error.args[0].items() if not isinstance(e, RouteVerificationError)}
+            targets.update((rtb, nat_gateway_id) for rtb in remaining if rtb not in failed)
+            if not failed:
+                return targets
+            remaining = [rtb for rtb in remaining if rtb in failed]
+            logger.warning("Falling back from NAT Gateway %s for route tables %s", nat_gateway_id, remaining)
+
+    # The candidates may be stale; resolve them afresh next time
+    invalidate_topology_cache()
+    raise RouteReplacementError({rtb: "no NAT Gateway candidate succeeded" for rtb in remaining})
+
+def send_ssm_command(instance_id, commands, comment):
+    response = get_client("ssm").send_command(
+        InstanceIds=[instance_id],
+        DocumentName="AWS-RunShellScript",
+        TimeoutSeconds=SSM_TIMEOUT_SECONDS,
+        Parameters={"commands": commands},
+        Comment=comment,
+    )
+    return response['Command']['CommandId']
+
+
+def wait_for_ssm_command(command_id, instance_id, timeout=SSM_COMMAND_WAIT_SECONDS):
     """
-    Runs a basic diagnostic script via SSM on the NAT instance.
-    It checks if IP forwarding is enabled and lists the nftables NAT configuration.
-    Returns True if configuration is healthy, False otherwise.
+    Polls for the result of an SSM command with exponential backoff until it
+    reaches a terminal status and returns the invocation. Raises
+    SSMCommandTimeoutError if it is still pending after timeout seconds.
     """
-    ssm_client = boto3.client("ssm")
+    ssm_client = get_client("ssm")
+    deadline = time.monotonic() + timeout
+    delay = SSM_POLL_INITIAL_DELAY
+    while True:
+        time.sleep(delay)
+        try:
+            invocation = ssm_client.get_command_invocation(
+                CommandId=command_id,
+                InstanceId=instance_id,
+            )
+            if invocation['Status'] not in SSM_PENDING_STATUSES:
+                return invocation
+        except botocore.exceptions.ClientError as error:
+            # The invocation only becomes visible shortly after send_command returns
+            if error.response["Error"]["Code"] != "InvocationDoesNotExist":
+                raise
+
+        if time.monotonic() >= deadline:
+            raise SSMCommandTimeoutError(command_id)
+        delay = min(delay * 2, SSM_POLL_MAX_DELAY)
+
+
+def run_ssm_command(instance_id, commands, comment, timeout=SSM_COMMAND_WAIT_SECONDS):
+    command_id = send_ssm_command(instance_id, commands, comment)
+    return wait_for_ssm_command(command_id, instance_id, timeout)
 
-    diagnostic_script = [
-        "#!/bin/bash",
-        "set -e",
-        "echo 'ip_forward='$(cat /proc/sys/net/ipv4/ip_forward)",
-        "echo 'nft_nat_table='$(nft list table ip nat 2>/dev/null || echo 'nftables nat table not found')"
+
+def nat_health_check_script(check_urls):
+    """
+    Builds a shell script that checks Internet access and the NAT configuration
+    of the instance in one go and prints the results as a single JSON object.
+    The URLs are fetched in parallel, so that unreachable URLs take a single
+    REQUEST_TIMEOUT between them rather than one each, well within
+    SSM_COMMAND_WAIT_SECONDS.
+    """
+    script = ["#!/bin/bash", "results=$(mktemp -d)"]
+    for i, url in enumerate(check_urls):
+        script.append(
+            f"curl -s -o /dev/null -w '%{{http_code}}' --max-time {REQUEST_TIMEOUT} {url.strip()} > \"$results/{i}\" &"
+        )
+    script += ["wait", "http_codes=''"]
+    for i in range(len(check_urls)):
+        script.append(f"http_codes=\"$http_codes${{http_codes:+,}}\\\"$(cat \"$results/{i}\")\\\"\"")
+    script += [
+        "rm -rf \"$results\"",
+        "ip_forward=$(cat /proc/sys/net/ipv4/ip_forward 2>/dev/null || echo null)",
+        "if nft list table ip nat 2>/dev/null | grep -q masquerade; then masquerade=true; else masquerade=false; fi",
+        "conntrack_count=$(cat /proc/sys/net/netfilter/nf_conntrack_count 2>/dev/null || echo null)",
+        "conntrack_max=$(cat /proc/sys/net/netfilter/nf_conntrack_max 2>/dev/null || echo null)",
+        "printf '{\"http_codes\": [%s], \"ip_forward\": %s, \"nft_masquerade\": %s, "
+        "\"conntrack_count\": %s, \"conntrack_max\": %s}\\n' "
+        "\"$http_codes\" \"$ip_forward\" \"$masquerade\" \"$conntrack_count\" \"$conntrack_max\"",
     ]
+    return script
 
+
+def parse_nat_health(output):
+    """
+    Parses the JSON printed by nat_health_check_script. Returns None if the
+    output can't be parsed.
+    """
     try:
-        response = ssm_client.send_command(
-            InstanceIds=[instance_id],
-            DocumentName="AWS-RunShellScript",
-            Parameters={"commands": diagnostic_script},
-            Comment="Run NAT instance diagnostics",
-            TimeoutSeconds=SSM_TIMEOUT_SECONDS
-        )
-        command_id = response['Command']['CommandId']
-        time.sleep(5)  # Allow some time for the command to execute
+        return json.loads(output.strip().splitlines()[-1])
+    except (IndexError, ValueError) as error:
+        logger.warning("Unable to parse NAT instance health check output %r: %s", output, error)
+        return None
+
 
-        invocation = ssm_client.get_command_invocation(
-            CommandId=command_id,
-            InstanceId=instance_id,
+def run_nat_instance_diagnostics(instance_id, check_urls):
+    """
+    Runs a single health check via SSM on the NAT instance. It checks that the
+    instance can reach check_urls, that IP forwarding is enabled, that the
+    nftables NAT table masquerades, and that source/destination check is off.
+    Returns True if the instance is healthy, False otherwise.
+    """
+    try:
+        invocation = run_ssm_command(
+            instance_id, nat_health_check_script(check_urls), "Check NAT instance health via Lambda"
         )
+    except (botocore.exceptions.ClientError, SSMCommandTimeoutError) as e:
+        logger.error("SSM diagnostic command failed: %s", str(e))
+        return False
 
-        output = invocation.get('StandardOutputContent', '')
+    if invocation.get('StandardErrorContent'):
+        logger.warning("NAT instance diagnostic errors:\n%s", invocation['StandardErrorContent'])
 
-        if invocation.get('StandardErrorContent'):
-            logger.warning("NAT instance diagnostic errors:\n%s", invocation['StandardErrorContent'])
+    if invocation['Status'] != "Success":
+        logger.warning("NAT instance health check did not succeed (status %s).", invocation['Status'])
+        return False
 
-        # Check conditions
-        if "ip_forward=0" in output:
-            logger.warning("NAT instance has ip_forward=0 — IP forwarding is disabled.")
-            return False
+    health = parse_nat_health(invocation.get('StandardOutputContent', ''))
+    if health is None:
+        return False
 
-        if "masquerade" not in output:
-            logger.warning("NAT instance nftables missing 'masquerade' rule — SNAT may be broken.")
-            return False
+    logger.info("NAT instance health: %s", health)
 
-        if is_source_dest_check_enabled(instance_id) is True:
-            logger.warning("Source/destination check is ENABLED — this will break NAT functionality.")
-            return False
-        if is_source_dest_check_enabled(instance_id) is None:
-            logger.warning("Skipping NAT restore due to error checking source/dest.")
-            return False
+    # curl reports 000 when it could not get a response at all, and nothing
+    # when it could not run
+    if not all(str(code).isdigit() and 0 < int(code) < 500 for code in health.get("http_codes", [])):
+        logger.warning("NAT instance connectivity test failed: %s", health.get("http_codes"))
+        return False
 
-        return True
+    if health.get("ip_forward") != 1:
+        logger.warning("NAT instance has ip_forward=%s — IP forwarding is disabled.", health.get("ip_forward"))
+        return False
 
-    except botocore.exceptions.ClientError as e:
-        logger.error("SSM diagnostic command failed: %s", str(e))
+    if not health.get("nft_masquerade"):
+        logger.warning("NAT instance nftables missing 'masquerade' rule — SNAT may be broken.")
+        return False
+
+    source_dest_check = is_source_dest_check_enabled(instance_id)
+    if source_dest_check is True:
+        logger.warning("Source/destination check is ENABLED — this will break NAT functionality.")
+        return False
+    if source_dest_check is None:
+        logger.warning("Skipping NAT restore due to error checking source/dest.")
         return False
 
+    return True
+
 def is_source_dest_check_enabled(instance_id):
-    ec2 = boto3.client('ec2')
+    ec2 = get_client("ec2")
     try:
         response = ec2.describe_instances(InstanceIds=[instance_id])
         attr = response['Reservations'][0]['Instances'][0].get('SourceDestCheck', True)
@@ -209,136 +1045,650 @@ def is_source_dest_check_enabled(instance_id):
         logger.error(f"Error checking source/dest check: {e}")
         return None
 
-def are_any_routes_pointing_to_nat_gateway(route_table_ids):
-    ec2 = boto3.client('ec2')
-    try:
-        response = ec2.describe_route_tables(RouteTableIds=route_table_ids)
-        for rtb in response.get('RouteTables', []):
-            for route in rtb.get('Routes', []):
-                if route.get('DestinationCidrBlock') == "0.0.0.0/0" and 'NatGatewayId' in route and route.get('State') == 'active':
-                    return True
-        return False
-    except Exception as e:
-        logger.error(f"Error checking NAT Gateway routes: {e}")
-        return False
+def get_nat_gateway_targets(route_table_ids):
+    """
+    Returns the NAT Gateway that the default route of each of route_table_ids
+    points to, leaving out route tables that don't use a NAT Gateway.
+    """
+    return {
+        rtb: route["target_id"]
+        for rtb, route in inspect_routes(route_table_ids).items()
+        if route["target_type"] == "nat_gateway"
+    }
+
+
+def get_canary_route_tables(route_tables):
+    """
+    Returns the route tables to restore as canaries: those of the tester's own
+    subnets, so that its probes travel through the restored instance. Returns
+    None if the tester's path isn't known or isn't among route_tables, since
+    probes through a NAT Gateway would pass whatever the instance's state.
+    NAT_RESTORE_CANARY_ROUTE_TABLE_ID names the canary when TESTER_SUBNET_IDS
+    isn't set, and must be one of the tester's route tables when it is.
+    """
+    tester_route_tables = get_tester_route_tables()
+    configured = os.getenv("NAT_RESTORE_CANARY_ROUTE_TABLE_ID")
+    if tester_route_tables is None:
+        canaries = [configured] if configured else []
+    elif configured and configured not in tester_route_tables:
+        canaries = []
+    else:
+        canaries = tester_route_tables
+    if not canaries or not set(canaries) <= set(route_tables):
+        logger.warning(
+            "Canary route tables %s are not on the tester's path %s within %s",
+            canaries or configured, tester_route_tables, route_tables
+        )
+        return None
+    return canaries
+
+
+def verify_canary_restore(canaries, owners, check_urls):
+    """
+    Checks that the canary route tables now route through their NAT
+    instances, then probes check_urls from this function's own subnet, whose
+    traffic the canaries carry.
+    """
+    for instance_id in sorted({owners[rtb] for rtb in canaries}):
+        unverified = verify_routes([rtb for rtb in canaries if owners[rtb] == instance_id], instance_id)
+        if unverified:
+            logger.warning("Canary route tables %s do not route through %s", list(unverified), instance_id)
+            return False
+
+    time.sleep(CANARY_SETTLE_SECONDS)
+    return probe_connectivity(check_urls)
+
+
+def restore_canary(canaries, owners, check_urls):
+    """
+    Restores the canary route tables to their NAT instances and verifies
+    them, moving them back to their NAT Gateways if verification fails.
+    Returns whether the canaries were restored.
+    """
+    previous_targets = get_nat_gateway_targets(canaries)
+    with timed_phase("canary_restore", RouteTableCount=len(canaries)):
+        for instance_id in sorted({owners[rtb] for rtb in canaries}):
+            replace_routes([rtb for rtb in canaries if owners[rtb] == instance_id], instance_id)
+        verified = verify_canary_restore(canaries, owners, check_urls)
+    if verified:
+        logger.info("Canary route tables %s verified through NAT instance", canaries)
+        return True
+
+    logger.warning("Canary route tables %s failed verification, rolling back", canaries)
+    for nat_gateway_id in sorted(set(previous_targets.values())):
+        replace_routes([rtb for rtb, target_id in previous_targets.items() if target_id == nat_gateway_id], nat_gateway_id)
+    return False
 
-def attempt_nat_instance_restore():
-    ssm_client = boto3.client('ssm')
-    nat_instance_id = get_current_nat_instance_id(os.getenv("NAT_ASG_NAME"))
-    route_tables = os.getenv("ROUTE_TABLE_IDS_CSV", "").split(",")
+
+def attempt_nat_instance_restore(target=None, check_urls=None):
+    target = target or get_connectivity_target()
+    nat_instance_id = get_current_nat_instance_id(target.get("nat_asg_name"))
+    route_tables = target["route_table_ids"]
 
     if not nat_instance_id or not route_tables:
         logger.warning("NAT_INSTANCE_ID or ROUTE_TABLE_IDS_CSV not set. Skipping NAT restore.")
         return
 
-    logger.info("Attempting to restore route to NAT Instance: %s", nat_instance_id)
+    owners = get_route_table_owners(route_tables, target.get("nat_asg_name"), nat_instance_id)
+    instance_ids = sorted(set(owners.values()))
+    logger.info("Attempting to restore route to NAT Instance: %s", ", ".join(instance_ids))
 
     try:
-        check_urls = os.getenv("CHECK_URLS", ",".join(DEFAULT_CHECK_URLS)).split(",")
-        commands = []
-        for url in check_urls:
-            command = f"curl -s -o /dev/null -w '%{{http_code}}\\n' --max-time 5 {url.strip()}"
-            commands.append(command)
-        # Send SSM command to test connectivity
-        response = ssm_client.send_command(
-            InstanceIds=[nat_instance_id],
-            DocumentName="AWS-RunShellScript",
-            TimeoutSeconds=SSM_TIMEOUT_SECONDS,
-            Parameters={
-                "commands": commands
-            },
-            Comment="Check Internet access from NAT instance via Lambda",
-        )
-        command_id = response['Command']['CommandId']
-        time.sleep(5)  # Wait briefly before checking command result
-
-        # Poll command result
-        invocation = ssm_client.get_command_invocation(
-            CommandId=command_id,
-            InstanceId=nat_instance_id,
-        )
-        if invocation['Status'] == "Success":
-            output = invocation['StandardOutputContent'].strip()
-            http_codes = output.splitlines()
-            if all(int(code) < 500 for code in http_codes):
-                logger.info("NAT instance has Internet access, we can diagnose the NAT configuration.")
-                try:
-                    if not run_nat_instance_diagnostics(nat_instance_id):
-                        logger.warning("Skipping route restore due to failed NAT diagnostics.")
-                        return
-                except Exception as diag_error:
-                    logger.error("Unexpected error during NAT diagnostics: %s", str(diag_error))
-                    return
-                for rtb in route_tables:
-                    replace_route(rtb, nat_instance_id)
-                    logger.info("Route table %s now points to NAT instance %s", rtb, nat_instance_id)
+        check_urls = check_urls or os.getenv("CHECK_URLS", ",".join(DEFAULT_CHECK_URLS)).split(",")
+        with timed_phase("restore_health_check"):
+            healthy = all(run_nat_instance_diagnostics(instance_id, check_urls) for instance_id in instance_ids)
+        if not record_restore_health_check(route_tables, healthy):
+            if not healthy:
+                logger.warning("Skipping route restore due to failed NAT health check.")
+            return
+
+        logger.info("NAT instance has Internet access and a healthy NAT configuration.")
+        remaining = route_tables
+        if get_env_bool("NAT_RESTORE_CANARY", DEFAULT_NAT_RESTORE_CANARY):
+            canaries = get_canary_route_tables(route_tables)
+            if canaries is None:
+                logger.warning("Skipping route restore, canary verification is not possible")
                 return
-            else:
-                logger.warning("Invocation output: %s", invocation['StandardOutputContent'])
-        else:
-            logger.warning("NAT instance connectivity test failed or did not return expected result.")
-
-
-    except botocore.exceptions.ClientError as e:
-        logger.error("SSM command failed: %s", str(e))
+            # Rolling the canary back counts as a failed restore, so the next attempt backs off
+            if not restore_canary(canaries, owners, check_urls):
+                return
+            remaining = [rtb for rtb in route_tables if rtb not in canaries]
+        for instance_id in instance_ids:
+            shard = [rtb for rtb in remaining if owners[rtb] == instance_id]
+            if shard:
+                with timed_phase("route_replacement", RouteTableCount=len(shard)):
+                    replace_routes(shard, instance_id)
+                logger.info("Route tables %s now point to NAT instance %s", shard, instance_id)
     except Exception as ex:
         logger.error("Unexpected error during NAT restore: %s", str(ex))
 
-def check_connection(check_urls):
-    """
-    Checks connectivity to check_urls. If any of them succeed, return success.
-    If all fail, replaces the route table to point at a standby NAT Gateway and
-    return failure.
 
-    If ENABLE_NAT_RESTORE is set and we're currently using the NAT Gateway,
-    attempt to restore route to the NAT instance before checking connectivity.
+def probe_url(url, probe_type="http", timeout=REQUEST_TIMEOUT):
     """
-    route_tables = os.getenv("ROUTE_TABLE_IDS_CSV", "").split(",")
-    if not route_tables:
-        raise MissingEnvironmentVariableError("ROUTE_TABLE_IDS_CSV")
+    Probes url once. For "http" probes any HTTP response, including an error
+    status, counts as success since it proves the request made it out and back.
+    """
+    if probe_type in ("tcp", "tls"):
+        return probe_socket(url, timeout, tls=probe_type == "tls")
+    if probe_type == "session":
+        return probe_with_session(url, timeout)
 
-    restore_enabled = get_env_bool("ENABLE_NAT_RESTORE", DEFAULT_ENABLE_NAT_RESTORE)
+    import urllib.error
+    import urllib.request
+    try:
+        req = urllib.request.Request(url)
+        req.add_header('User-Agent', 'alternat/1.0')
+        urllib.request.urlopen(req, timeout=timeout)
+        logger.debug("Successfully connected to %s", url)
+        return True
+    except urllib.error.HTTPError as error:
+        logger.warning("Response error from %s: %s, treating as success", url, error)
+        return True
+    except urllib.error.URLError as error:
+        logger.error("error connecting to %s: %s", url, error)
+    except socket.timeout as error:
+        logger.error("timeout error connecting to %s: %s", url, error)
+    return False
 
-    # Step 1: Try failback to NAT instance if allowed and current route is NAT Gateway
-    if restore_enabled and are_any_routes_pointing_to_nat_gateway(route_tables):
+
+def probe_socket(url, timeout, tls=False):
+    """
+    Opens a TCP connection to the host and port of url and, if tls is set,
+    completes a TLS handshake. No request is sent.
+    """
+    import urllib.parse
+    parts = urllib.parse.urlsplit(url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    try:
+        with socket.create_connection((parts.hostname, port), timeout=timeout) as sock:
+            if tls:
+                with get_ssl_context().wrap_socket(sock, server_hostname=parts.hostname):
+                    pass
+        logger.debug("Successfully connected to %s", url)
+        return True
+    except OSError as error:
+        logger.error("error connecting to %s: %s", url, error)
+        return False
+
+
+class ProbeSession:
+    """
+    A kept-alive HTTP(S) connection to the host of a check URL. Each probe
+    sends a HEAD request, connecting first if needed, and returns the time in
+    milliseconds that the dns, connect, tls and first_byte stages took.
+    Stages skipped on a reused connection are left out.
+    """
+
+    def __init__(self, url):
+        import urllib.parse
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname
+        self.tls = parts.scheme == "https"
+        default_port = 443 if self.tls else 80
+        self.port = parts.port or default_port
+        self.path = parts.path or "/"
+        # The connection's own Host header would name the port even when it
+        # is the scheme's default, since it is a plain HTTPConnection
+        self.host_header = self.host if self.port == default_port else f"{self.host}:{self.port}"
+        self.connection = None
+
+    def resolve(self, timings):
+        start = time.perf_counter()
+        try:
+            # Positional arguments only, as disable_ipv6 expects
+            addresses = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        except OSError as error:
+            raise ProbeError("dns", error)
+        timings["dns"] = (time.perf_counter() - start) * 1000
+        return addresses
+
+    def connect(self, timeout, timings):
+        import http.client
+        addresses = self.resolve(timings)
+        start = time.perf_counter()
+        # Like socket.create_connection, but with the lookup timed separately
+        error = OSError(f"getaddrinfo returned no addresses for {self.host}")
+        for family, socktype, proto, _, address in addresses:
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.settimeout(timeout)
+                sock.connect(address)
+                break
+            except OSError as e:
+                sock.close()
+                error = e
+        else:
+            raise error
+        timings["connect"] = (time.perf_counter() - start) * 1000
+        if self.tls:
+            start = time.perf_counter()
+            try:
+                sock = get_ssl_context().wrap_socket(sock, server_hostname=self.host)
+            except Exception as error:
+                sock.close()
+                raise ProbeError("tls", error)
+            timings["tls"] = (time.perf_counter() - start) * 1000
+        self.connection = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+        self.connection.sock = sock
+
+    def probe(self, timeout):
+        import http.client
+        reused = self.connection is not None
+        timings = {}
+        if not reused:
+            try:
+                self.connect(timeout, timings)
+            except OSError as error:
+                raise ProbeError("connect", error)
+
+        start = time.perf_counter()
+        try:
+            self.connection.sock.settimeout(timeout)
+            self.connection.request("HEAD", self.path, headers={"Host": self.host_header, "User-Agent": "alternat/1.0"})
+            response = self.connection.getresponse()
+            timings["first_byte"] = (time.perf_counter() - start) * 1000
+            response.read()
+        except (OSError, http.client.HTTPException) as error:
+            self.close()
+            # The server may have closed an idle connection, so try a new one
+            if reused:
+                return self.probe(timeout)
+            raise ProbeError("first_byte", error)
+        if response.will_close:
+            self.close()
+        return timings
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+ssl_context = None
+
+
+def get_ssl_context():
+    # Loading the CA bundle is relatively slow, so share one context
+    global ssl_context
+    if ssl_context is None:
+        import ssl
+        ssl_context = ssl.create_default_context()
+    return ssl_context
+
+
+# Idle ProbeSessions for each check URL, kept until the end of the invocation
+probe_sessions = {}
+probe_sessions_lock = threading.Lock()
+
+
+def probe_with_session(url, timeout):
+    with probe_sessions_lock:
+        idle = probe_sessions.setdefault(url, [])
+        session = idle.pop() if idle else ProbeSession(url)
+    try:
+        timings = session.probe(timeout)
+    except ProbeError as error:
+        logger.error("error connecting to %s during %s: %s", url, error.stage, error.error)
+        put_metric("ProbeFailure", 1, "Count", phase="detection", Url=url, Stage=error.stage)
+        return False
+
+    logger.debug("Successfully connected to %s: %s", url, timings)
+    for stage, duration in timings.items():
+        put_metric(f"Probe{stage.title().replace('_', '')}Duration", duration, "Milliseconds", phase="detection", Url=url)
+    if session.connection is not None:
+        with probe_sessions_lock:
+            probe_sessions.setdefault(url, []).append(session)
+    return True
+
+
+def close_probe_sessions():
+    with probe_sessions_lock:
+        sessions = [session for idle in probe_sessions.values() for session in idle]
+        probe_sessions.clear()
+    for session in sessions:
+        session.close()
+
+
+# Recent (timestamp, round trip ms, succeeded) samples for each probed URL.
+# Kept at module level so they carry over between warm invocations.
+latency_samples = {}
+latency_samples_lock = threading.Lock()
+
+
+def timed_probe_url(url, probe_type, timeout):
+    start = time.perf_counter()
+    succeeded = probe_url(url, probe_type, timeout)
+    record_probe_latency(url, (time.perf_counter() - start) * 1000, succeeded)
+    return succeeded
+
+
+def record_probe_latency(url, rtt, succeeded):
+    with latency_samples_lock:
+        samples = latency_samples.setdefault(url, deque(maxlen=LATENCY_SAMPLES_PER_URL))
+        samples.append((time.monotonic(), rtt, succeeded))
+
+
+def get_latency_summary(url):
+    """
+    Returns the number of samples, p90 round trip time in ms of successful
+    probes, and error ratio of url over the last BROWNOUT_WINDOW seconds.
+    """
+    window = float(os.getenv("BROWNOUT_WINDOW", DEFAULT_BROWNOUT_WINDOW))
+    now = time.monotonic()
+    with latency_samples_lock:
+        samples = [sample for sample in latency_samples.get(url, ()) if now - sample[0] <= window]
+    rtts = sorted(rtt for _, rtt, succeeded in samples if succeeded)
+    return {
+        "samples": len(samples),
+        # Nearest rank, so a single slow probe in ten is tolerated
+        "p90": rtts[max(0, -(-9 * len(rtts) // 10) - 1)] if rtts else None,
+        "error_ratio": (len(samples) - len(rtts)) / len(samples) if samples else 0,
+    }
+
+
+def clear_latency_samples(check_urls):
+    with latency_samples_lock:
+        for url in check_urls:
+            latency_samples.pop(url, None)
+
+
+def is_browned_out(check_urls):
+    """
+    Returns whether every one of check_urls has enough recent samples and
+    exceeds the p90 latency or error ratio limit. A single slow site is
+    more likely the site's problem than the NAT instance's.
+    """
+    min_samples = int(os.getenv("BROWNOUT_MIN_SAMPLES", DEFAULT_BROWNOUT_MIN_SAMPLES))
+    p90_limit = float(os.getenv("BROWNOUT_P90_LATENCY", DEFAULT_BROWNOUT_P90_LATENCY))
+    error_ratio_limit = float(os.getenv("BROWNOUT_ERROR_RATIO", DEFAULT_BROWNOUT_ERROR_RATIO))
+    degraded = []
+    for url in check_urls:
+        summary = get_latency_summary(url)
+        if summary["samples"] < min_samples:
+            return False
+        put_metric("ProbeP90Latency", summary["p90"] or 0, "Milliseconds", phase="detection", Url=url)
+        if (summary["p90"] or 0) > p90_limit or summary["error_ratio"] > error_ratio_limit:
+            degraded.append((url, summary))
+    if len(degraded) == len(check_urls):
+        logger.warning("NAT instance browned out: %s", degraded)
+        return True
+    return False
+
+
+def check_brownout(target, check_urls):
+    """
+    Shifts BROWNOUT_SHIFT_FRACTION of target's route tables to the standby NAT
+    Gateway when probes through the NAT instance are browned out. Returns
+    False if every route table failed over.
+
+    Once the tester's own route table has shifted its probes go through the
+    NAT Gateway and say nothing about the instance, so samples only count
+    while the tester's path still goes through the instance, and are
+    discarded after every shift. Shifted route tables instead move back like
+    a NAT restore: after the restore hold-down, and once the instance passes
+    its health checks.
+    """
+    route_tables = target["route_table_ids"]
+    shifted = get_flagged_route_tables(route_tables, "brownout")
+    if (
+        shifted
+        and not is_restore_held_down(shifted)
+        and not is_shift_held_down(shifted)
+        and restore_after_brownout(target, shifted, check_urls)
+    ):
+        shifted = []
+
+    tester_route_tables = get_tester_route_tables()
+    if tester_route_tables is None:
+        on_instance = len(shifted) < len(route_tables)
+    else:
+        on_instance = not set(tester_route_tables) & set(shifted)
+    if not on_instance:
+        clear_latency_samples(check_urls)
+        return len(shifted) < len(route_tables)
+
+    if is_browned_out(check_urls):
+        fraction = float(os.getenv("BROWNOUT_SHIFT_FRACTION", DEFAULT_BROWNOUT_SHIFT_FRACTION))
+        newly_shifted = shift_to_nat_gateway(target, fraction, "brownout")
+        clear_latency_samples(check_urls)
+        if newly_shifted:
+            logger.warning("Shifted %s to NAT Gateway due to brownout", newly_shifted)
+        return len(get_flagged_route_tables(route_tables, "brownout")) < len(route_tables)
+    return True
+
+
+def restore_after_brownout(target, shifted, check_urls):
+    """
+    Moves route tables shifted by brownout detection back to the NAT instance
+    if it passes NAT_RESTORE_HEALTHY_CHECKS health checks. Returns whether
+    they moved.
+    """
+    owners = get_nat_instance_owners(shifted, target.get("nat_asg_name"))
+    if not owners:
+        return False
+    with timed_phase("restore_health_check"):
+        healthy = all(run_nat_instance_diagnostics(instance_id, check_urls) for instance_id in sorted(set(owners.values())))
+    if not record_restore_health_check(shifted, healthy):
+        return False
+    if shift_to_nat_instance(target, "brownout"):
+        logger.info("NAT instance passed its health checks after a brownout, shifted %s back", shifted)
+        clear_latency_samples(check_urls)
+    return True
+
+
+def probe_urls(check_urls, probe_type="http", timeout=REQUEST_TIMEOUT):
+    """
+    Probes all check_urls concurrently and returns True as soon as any of them
+    succeeds. Detection of a total failure is bounded by a single timeout
+    rather than one timeout per URL. A probe that raises counts as a failure
+    of its URL only.
+    """
+    if probe_type not in CONNECTIVITY_PROBE_TYPES:
+        raise UnknownProbeTypeError(probe_type)
+    # No URLs to probe must not read as a connectivity failure
+    if not check_urls:
+        raise MissingCheckUrlsError
+
+    executor = ThreadPoolExecutor(max_workers=len(check_urls))
+    try:
+        futures = {executor.submit(timed_probe_url, url, probe_type, timeout): url for url in check_urls}
+        for future in as_completed(futures):
+            # urllib lets some errors through unwrapped, such as a connection
+            # reset while reading the response
+            try:
+                if future.result():
+                    return True
+            except Exception as error:
+                logger.error("error connecting to %s: %s", futures[future], error)
+        return False
+    finally:
+        # Don't wait on slower probes once the outcome is known
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class FailureWindow:
+    """
+    Tracks consecutive connectivity check failures. Trips once threshold
+    failures have been recorded within window seconds; any success resets it.
+    """
+
+    def __init__(self, threshold, window):
+        self.threshold = threshold
+        self.window = window
+        self.failures = deque()
+
+    def record_success(self):
+        self.failures.clear()
+
+    def reset(self):
+        """Starts counting afresh, e.g. once the failures have been acted on."""
+        self.failures.clear()
+
+    def record_failure(self):
+        now = time.monotonic()
+        self.failures.append(now)
+        while now - self.failures[0] > self.window:
+            self.failures.popleft()
+        return len(self.failures) >= self.threshold
+
+
+class CheckScheduler:
+    """
+    Chooses the interval between connectivity check rounds. Starts at
+    fast_interval, moves to slow_interval once healthy_streak healthy rounds
+    have been recorded in a row, and back on any unhealthy round.
+    """
+
+    def __init__(self):
+        self.healthy_streak = 0
+
+    def next_interval(self, healthy, fast_interval):
+        if not healthy:
+            self.healthy_streak = 0
+            return fast_interval
+        self.healthy_streak += 1
+        streak = int(os.getenv("CONNECTIVITY_CHECK_HEALTHY_STREAK", DEFAULT_CONNECTIVITY_CHECK_HEALTHY_STREAK))
+        if self.healthy_streak < streak:
+            return fast_interval
+        return float(os.getenv("CONNECTIVITY_CHECK_SLOW_INTERVAL", DEFAULT_CONNECTIVITY_CHECK_SLOW_INTERVAL))
+
+
+# Kept at module level so that a healthy streak carries over between warm
+# invocations instead of every run starting at the fast interval.
+check_scheduler = CheckScheduler()
+
+
+def probe_connectivity(check_urls):
+    """
+    Probes check_urls from this function's subnet with the configured
+    CONNECTIVITY_PROBE_TYPE and CONNECTIVITY_CHECK_TIMEOUT.
+    """
+    probe_type = os.getenv("CONNECTIVITY_PROBE_TYPE", DEFAULT_CONNECTIVITY_PROBE_TYPE)
+    probe_timeout = float(os.getenv("CONNECTIVITY_CHECK_TIMEOUT", REQUEST_TIMEOUT))
+    return probe_urls(check_urls, probe_type, probe_timeout)
+
+
+def check_connection(check_urls, failure_window=None, target=None, timings=None):
+    """
+    Checks connectivity to check_urls. If any of them succeed, return success.
+    If all fail, replaces the route table to point at a standby NAT Gateway and
+    return failure.
+
+    The route tables, public subnet and NAT instance ASG come from target,
+    or from the environment of a single-AZ tester if no target is given.
+
+    When a failure_window is given, the route is only replaced once it trips;
+    failures below its threshold are logged and treated as success. The window
+    is reset once it trips, and route tables already using a NAT Gateway are
+    left alone, so that continued failures don't replace the route again.
+    With SHARD_ROUTE_TABLES, only the route tables of the NAT instance on the
+    tester's path fail over, see get_probed_route_tables.
+
+    If ENABLE_NAT_RESTORE is set and we're currently using the NAT Gateway,
+    attempt to restore route to the NAT instance before checking connectivity.
+
+    When a timings dict is given, the probe round trip in seconds is stored
+    in it under "probe", apart from the time spent on AWS calls.
+    """
+    target = target or get_connectivity_target()
+    route_tables = target["route_table_ids"]
+    if not route_tables:
+        raise MissingEnvironmentVariableError("ROUTE_TABLE_IDS_CSV")
+
+    restore_enabled = get_env_bool("ENABLE_NAT_RESTORE", DEFAULT_ENABLE_NAT_RESTORE)
+
+    # Step 1: Try failback to NAT instance if allowed and current route is NAT Gateway.
+    # Route tables deliberately moved to a NAT Gateway, by saturation failover,
+    # load sharing or brownout detection, are left to the feature that moved them.
+    held = get_flagged_route_tables(route_tables, *HELD_ROUTE_FLAGS) if restore_enabled else []
+    restorable = [rtb for rtb in route_tables if rtb not in held]
+    if restorable and restore_enabled and is_using_nat_gateway(restorable) and not is_restore_held_down(restorable):
         logger.info("ENABLE_NAT_RESTORE=true and route is NAT Gateway. Trying to restore NAT instance...")
-        attempt_nat_instance_restore()
+        attempt_nat_instance_restore(dict(target, route_table_ids=restorable), check_urls)
         time.sleep(5)
 
     # Step 2: Test connectivity
-    for url in check_urls:
-        try:
-            req = urllib.request.Request(url)
-            req.add_header('User-Agent', 'alternat/1.0')
-            urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT)
-            logger.debug("Successfully connected to %s", url)
-            return True
-        except urllib.error.HTTPError as error:
-            logger.warning("Response error from %s: %s, treating as success", url, error)
-            return True
-        except urllib.error.URLError as error:
-            logger.error("error connecting to %s: %s", url, error)
-        except socket.timeout as error:
-            logger.error("timeout error connecting to %s: %s", url, error)
+    probe_type = os.getenv("CONNECTIVITY_PROBE_TYPE", DEFAULT_CONNECTIVITY_PROBE_TYPE)
+    with timed_phase("detection", ProbeType=probe_type, UrlCount=len(check_urls)):
+        start = time.perf_counter()
+        connected = probe_connectivity(check_urls)
+        if timings is not None:
+            timings["probe"] = time.perf_counter() - start
+    if connected:
+        if failure_window:
+            failure_window.record_success()
+        if get_env_bool("ENABLE_BROWNOUT_DETECTION", DEFAULT_ENABLE_BROWNOUT_DETECTION):
+            return check_brownout(target, check_urls)
+        return True
+
+    if failure_window and not failure_window.record_failure():
+        logger.warning(
+            "Failed connectivity tests (%d of %d within %ss), not replacing route yet",
+            len(failure_window.failures), failure_window.threshold, failure_window.window
+        )
+        return True
+
+    if failure_window:
+        failure_window.reset()
+
+    # Route tables already moved to a NAT Gateway have nothing to fail over.
+    # Recorded route state can't tell, since a replacement NAT instance moves
+    # routes back to itself without recording it, so describe them afresh.
+    sharded = get_env_bool("SHARD_ROUTE_TABLES", DEFAULT_SHARD_ROUTE_TABLES)
+    tester_route_tables = get_tester_route_tables() if sharded else None
+    try:
+        routes = inspect_routes(sorted(set(route_tables) | set(tester_route_tables or [])))
+    except Exception as error:
+        logger.error("Unable to describe routes, failing over every route table: %s", error)
+        routes = None
+    if routes is not None:
+        route_tables = [
+            rtb for rtb in route_tables
+            if not (routes.get(rtb, {}).get("target_type") == "nat_gateway" and routes[rtb]["state"] == "active")
+        ]
+        if not route_tables:
+            logger.warning("Failed connectivity tests, but the route already uses a NAT Gateway")
+            return False
+
+    if sharded:
+        route_tables = get_probed_route_tables(route_tables, tester_route_tables, routes)
+        if not route_tables:
+            logger.warning("Failed connectivity tests, but no route table uses the NAT instance on the tester's path")
+            return False
 
     logger.warning("Failed connectivity tests! Replacing route")
 
-    public_subnet_id = os.getenv("PUBLIC_SUBNET_ID")
+    public_subnet_id = target.get("public_subnet_id")
     if not public_subnet_id:
         raise MissingEnvironmentVariableError("PUBLIC_SUBNET_ID")
 
-    vpc_id = get_vpc_id(route_tables[0])
+    fail_over_to_nat_gateway(route_tables, public_subnet_id, target)
+    # Every route table is restored together now that the instance is unhealthy
+    record_route_states({rtb: {flag: False for flag in HELD_ROUTE_FLAGS} for rtb in route_tables})
+    logger.info("Route replacement succeeded")
+    return False
 
-    nat_gateway_id = get_nat_gateway_id(vpc_id, public_subnet_id)
+def get_probed_route_tables(route_tables, tester_route_tables, routes):
+    """
+    Returns those of route_tables that route through the NAT instance the
+    tester's own route tables use, by routes from inspect_routes covering
+    both. When route tables are sharded across several NAT instances, the
+    tester's probes only say something about that instance. Returns
+    route_tables unchanged if the tester's route tables or routes aren't
+    known.
+    """
+    if tester_route_tables is None or routes is None:
+        logger.warning("Unable to tell which NAT instance is on the tester's path, failing over every shard")
+        return route_tables
+    targets = {rtb: route["target_id"] for rtb, route in routes.items()}
+    probed = {targets.get(rtb) for rtb in tester_route_tables if (targets.get(rtb) or "").startswith("i-")}
+    logger.info("The tester's probes went through NAT instances %s", sorted(probed))
+    return [rtb for rtb in route_tables if targets.get(rtb) in probed]
 
-    for rtb in route_tables:
-        replace_route(rtb, nat_gateway_id)
-        logger.info("Route replacement succeeded")
-    return False
 
 def get_current_nat_instance_id(asg_name):
     try:
-        autoscaling = boto3.client("autoscaling")
+        autoscaling = get_client("autoscaling")
         response = autoscaling.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
         instances = response['AutoScalingGroups'][0]['Instances']
         for instance in instances:
@@ -348,6 +1698,410 @@ def get_current_nat_instance_id(asg_name):
         logger.error(f"Failed to retrieve NAT instance ID from ASG {asg_name}: {e}")
         return None
 
+def get_saturation_counts(asg_name, instance_id=None):
+    """
+    Returns how many times each of SATURATION_METRICS was exceeded by the NAT
+    instances of asg_name, or only by instance_id if it is given, within the
+    last SATURATION_LOOKBACK seconds.
+
+    The counts are read from the JSON file at NAT_METRICS_FILE if it is set,
+    otherwise from the ethtool metrics the CloudWatch agent publishes. The
+    file may also hold the counts of each instance keyed by instance ID.
+    """
+    metrics_file = os.getenv("NAT_METRICS_FILE")
+    if metrics_file:
+        with open(metrics_file) as file:
+            counts = json.load(file)
+        if instance_id:
+            counts = counts.get(instance_id, counts)
+        return {metric: float(counts.get(metric, 0)) for metric in SATURATION_METRICS}
+
+    namespace = os.getenv("CLOUDWATCH_NAMESPACE", DEFAULT_CLOUDWATCH_NAMESPACE)
+    lookback = int(os.getenv("SATURATION_LOOKBACK", DEFAULT_SATURATION_LOOKBACK))
+    end = time.time()
+    instance_filter = f" InstanceId=\"{instance_id}\"" if instance_id else ""
+    # The agent also dimensions ethtool metrics by driver and interface, so
+    # search for every series of the ASG rather than naming each one.
+    response = get_client("cloudwatch").get_metric_data(
+        MetricDataQueries=[
+            {
+                "Id": f"m{i}",
+                "Expression": (
+                    f"SEARCH('{{{namespace},AutoScalingGroupName,InstanceId,driver,interface}} "
+                    f"MetricName=\"ethtool_{metric}\" AutoScalingGroupName=\"{asg_name}\"{instance_filter}', 'Maximum', 60)"
+                ),
+                "Label": metric,
+            }
+            for i, metric in enumerate(SATURATION_METRICS)
+        ],
+        StartTime=end - lookback,
+        EndTime=end,
+    )
+
+    # The counters are cumulative, so each series contributes its increase
+    counts = {metric: 0.0 for metric in SATURATION_METRICS}
+    for result in response["MetricDataResults"]:
+        metric = SATURATION_METRICS[int(result["Id"][1:])]
+        if result["Values"]:
+            counts[metric] += max(result["Values"]) - min(result["Values"])
+    return counts
+
+
+def get_flagged_route_tables(route_tables, *flags):
+    states = load_route_states(route_tables)
+    return [rtb for rtb in route_tables if any(states.get(rtb, {}).get(flag) for flag in flags)]
+
+
+def get_saturated_route_tables(route_tables):
+    return get_flagged_route_tables(route_tables, "saturated")
+
+
+def shift_to_nat_gateway(target, fraction, flag):
+    """
+    Moves the last fraction of target's route tables, at least one, to the
+    standby NAT Gateway and marks them with flag, so that they can be moved
+    back by shift_to_nat_instance. Returns the route tables moved.
+
+    The tester's own route tables only move when all of them do. Otherwise
+    its probes would go through the NAT Gateway while other route tables
+    still depend on the instance, whose failure would then go unnoticed.
+    """
+    route_tables = target["route_table_ids"]
+    shifted = get_flagged_route_tables(route_tables, flag)
+    count = max(1, round(fraction * len(route_tables)))
+    if count < len(route_tables):
+        tester_route_tables = get_tester_route_tables() or []
+        route_tables = [rtb for rtb in route_tables if rtb not in tester_route_tables]
+    to_shift = route_tables[max(0, len(route_tables) - count):]
+    to_shift = [rtb for rtb in to_shift if rtb not in shifted]
+    if to_shift:
+        fail_over_to_nat_gateway(to_shift, target.get("public_subnet_id"), target, planned=True)
+        record_route_states({rtb: {flag: True, "last_shifted": time.time()} for rtb in to_shift})
+    return to_shift
+
+
+def shift_to_nat_instance(target, flag):
+    """
+    Moves target's route tables marked with flag back to the NAT instances
+    that own them.
+    """
+    shifted = get_flagged_route_tables(target["route_table_ids"], flag)
+    if not shifted:
+        return []
+    owners = get_nat_instance_owners(shifted, target.get("nat_asg_name"))
+    if not owners:
+        return []
+    with timed_phase("route_replacement", RouteTableCount=len(shifted)):
+        for instance_id in sorted(set(owners.values())):
+            replace_routes([rtb for rtb in shifted if owners[rtb] == instance_id], instance_id, planned=True)
+    record_route_states({rtb: {flag: False} for rtb in shifted})
+    return shifted
+
+
+def get_saturation_holddown(saturation_shifts):
+    holddown = float(os.getenv("SATURATION_HOLDDOWN", DEFAULT_SATURATION_HOLDDOWN))
+    max_holddown = float(os.getenv("SATURATION_MAX_HOLDDOWN", DEFAULT_SATURATION_MAX_HOLDDOWN))
+    return min(holddown * 2 ** saturation_shifts, max_holddown)
+
+
+def is_saturation_held_down(route_tables):
+    states = [state for state in load_route_states(route_tables).values() if state.get("saturated")]
+    if not states:
+        return False
+    state = max(states, key=lambda state: state.get("last_saturated", 0))
+    remaining = state.get("last_saturated", 0) + get_saturation_holddown(state.get("saturation_shifts", 0)) - time.time()
+    if remaining > 0:
+        logger.info("NAT instance saturated recently, not shifting route tables back for another %.0fs", remaining)
+        return True
+    return False
+
+
+def check_saturation(target):
+    """
+    Shifts some or all of target's route tables to the standby NAT Gateway
+    while its NAT instance is exceeding its network allowances, and back to
+    the instance once they subside. With SHARD_ROUTE_TABLES each instance's
+    counts only move the route tables it owns.
+
+    Shifted route tables are held on the NAT Gateway for a hold-down that
+    backs off when the instance saturates again soon after they return. An
+    instance left without traffic can't exceed its allowances, so once every
+    route table is shifted its counts say nothing about recovery, and the
+    route tables only return when the hold-down expires.
+    """
+    owners = get_route_table_owners(target["route_table_ids"], target.get("nat_asg_name"), None)
+    for instance_id in sorted(set(owners.values()), key=str):
+        shard = [rtb for rtb in target["route_table_ids"] if owners[rtb] == instance_id]
+        check_shard_saturation(dict(target, route_table_ids=shard), instance_id)
+
+
+def check_shard_saturation(target, instance_id=None):
+    """
+    Does check_saturation for target's route tables by the counts of the NAT
+    instance instance_id, or of the whole ASG if it is None.
+    """
+    route_tables = target["route_table_ids"]
+    with timed_phase("saturation_check"):
+        counts = get_saturation_counts(target.get("nat_asg_name"), instance_id)
+    exceeded = sum(counts.values())
+    put_metric("AllowanceExceeded", exceeded, "Count", phase="saturation_check", InstanceId=instance_id)
+
+    threshold = float(os.getenv("SATURATION_THRESHOLD", DEFAULT_SATURATION_THRESHOLD))
+    if exceeded > threshold:
+        fraction = float(os.getenv("SATURATION_SHIFT_FRACTION", DEFAULT_SATURATION_SHIFT_FRACTION))
+        states = load_route_states(route_tables)
+        shifted = shift_to_nat_gateway(target, fraction, "saturated")
+        if shifted:
+            logger.warning("NAT instance exceeded network allowances %s, shifted %s to NAT Gateway", counts, shifted)
+            now = time.time()
+            max_holddown = float(os.getenv("SATURATION_MAX_HOLDDOWN", DEFAULT_SATURATION_MAX_HOLDDOWN))
+            updates = {}
+            for rtb in shifted:
+                state = states.get(rtb, {})
+                # Saturating again soon after shifting back lengthens the next hold-down
+                recent = now - state.get("last_unsaturated", 0) < max_holddown
+                shifts = state.get("saturation_shifts", 0) + 1 if recent else 0
+                updates[rtb] = {"last_saturated": now, "saturation_shifts": shifts}
+            record_route_states(updates)
+        return
+
+    if not get_saturated_route_tables(route_tables) or is_saturation_held_down(route_tables):
+        return
+    carrying = [rtb for rtb in route_tables if rtb not in get_flagged_route_tables(route_tables, *HELD_ROUTE_FLAGS)]
+    recovery_threshold = float(os.getenv("SATURATION_RECOVERY_THRESHOLD", DEFAULT_SATURATION_RECOVERY_THRESHOLD))
+    if carrying and exceeded > recovery_threshold:
+        return
+
+    shifted = shift_to_nat_instance(target, "saturated")
+    if shifted:
+        record_route_states({rtb: {"last_unsaturated": time.time()} for rtb in shifted})
+        if carrying:
+            logger.info("NAT instance network allowances subsided, shifted %s back to NAT instance", shifted)
+        else:
+            logger.info("Saturation hold-down expired, shifted %s back to idle NAT instance", shifted)
+
+
+def assign_route_tables(route_tables, weights, traffic=None, fixed=None):
+    """
+    Assigns each of route_tables to one of the targets in weights so that the
+    traffic each target carries is proportional to its weight. Route tables
+    carry the traffic given for them, or 1 each if traffic is not given.
+    Route tables in fixed keep the target it maps them to, and count towards
+    that target's share.
+    """
+    traffic = traffic or {}
+    fixed = fixed or {}
+    loads = {rtb: float(traffic.get(rtb, 1)) for rtb in route_tables}
+    total_weight = sum(weights.values())
+    total_load = sum(loads.values())
+    assigned = {target: 0.0 for target in weights}
+    assignment = {}
+    for rtb, target in fixed.items():
+        assignment[rtb] = target
+        assigned[target] = assigned.get(target, 0.0) + loads[rtb]
+    # Heaviest first, each to the target furthest below its share
+    for rtb in sorted((rtb for rtb in route_tables if rtb not in fixed), key=lambda rtb: (-loads[rtb], rtb)):
+        target = max(weights, key=lambda target: weights[target] / total_weight * total_load - assigned[target])
+        assignment[rtb] = target
+        assigned[target] += loads[rtb]
+    return assignment
+
+
+def get_route_table_traffic():
+    """
+    Returns the observed traffic of each route table from the JSON object in
+    ROUTE_TABLE_TRAFFIC, or the file it names, for example bytes per hour
+    aggregated from VPC flow logs.
+    """
+    traffic = os.getenv("ROUTE_TABLE_TRAFFIC")
+    if not traffic:
+        return {}
+    if not traffic.lstrip().startswith("{"):
+        with open(traffic) as file:
+            return json.load(file)
+    return json.loads(traffic)
+
+
+def rebalance_route_tables(target):
+    """
+    Splits target's route tables between its NAT instance and NAT Gateways by
+    LOAD_SHARING_WEIGHTS and observed traffic. Does nothing while any of the
+    route tables are failed over or shifted off a saturated instance, since
+    restore and check_saturation own those.
+
+    The tester's own route tables always stay on the NAT instance, so that
+    its probes keep detecting a failure of the instance for the route tables
+    left on it.
+    """
+    route_tables = target["route_table_ids"]
+    states = load_route_states(route_tables)
+    interval = float(os.getenv("LOAD_SHARING_INTERVAL", DEFAULT_LOAD_SHARING_INTERVAL))
+    last_rebalance = min(states.get(rtb, {}).get("last_rebalance", 0) for rtb in route_tables)
+    if time.time() - last_rebalance < interval:
+        return
+
+    current = get_nat_gateway_targets(route_tables)
+    unplanned = [rtb for rtb in current if not states.get(rtb, {}).get("load_shared")]
+    if unplanned or get_saturated_route_tables(route_tables):
+        logger.info("Route tables %s are failed over, not rebalancing", unplanned or route_tables)
+        return
+
+    owners = get_nat_instance_owners(route_tables, target.get("nat_asg_name"))
+    if not owners:
+        return
+    public_subnet_id = target.get("public_subnet_id")
+    candidates = get_nat_gateway_candidates(get_vpc_id(route_tables[0], target), public_subnet_id, target)
+    aliases = {"gateway": candidates[0]}
+    weights = {}
+    for name, weight in json.loads(os.getenv("LOAD_SHARING_WEIGHTS", DEFAULT_LOAD_SHARING_WEIGHTS)).items():
+        target_id = aliases.get(name, name)
+        if target_id != "instance" and target_id not in candidates:
+            logger.warning("NAT Gateway %s is not available, leaving it out of load sharing", name)
+            continue
+        weights[target_id] = weights.get(target_id, 0) + float(weight)
+    if sum(weights.values()) <= 0:
+        logger.warning("No positive LOAD_SHARING_WEIGHTS left for %s, keeping them on the NAT instance", route_tables)
+        weights = {"instance": 1}
+
+    tester_route_tables = get_tester_route_tables() or []
+    fixed = {rtb: "instance" for rtb in route_tables if rtb in tester_route_tables}
+    assignment = assign_route_tables(route_tables, weights, get_route_table_traffic(), fixed)
+    # Route tables assigned to the NAT instance go to the instance that owns them
+    destinations = {rtb: owners[rtb] if assigned == "instance" else assigned for rtb, assigned in assignment.items()}
+    with timed_phase("rebalance", RouteTableCount=len(route_tables)):
+        for target_id in sorted(set(destinations.values())):
+            moves = [
+                rtb for rtb, destination in destinations.items()
+                if destination == target_id and current.get(rtb, owners[rtb]) != target_id
+            ]
+            if moves:
+                logger.info("Rebalancing %s to %s", moves, target_id)
+                replace_routes(moves, target_id, planned=True)
+
+    now = time.time()
+    record_route_states({
+        rtb: {"load_shared": assigned != "instance", "last_rebalance": now}
+        for rtb, assigned in assignment.items()
+    })
+
+
+def get_nat_instance_ids(asg_name):
+    """Returns the InService NAT instances of asg_name, in a stable order."""
+    try:
+        autoscaling = get_client("autoscaling")
+        response = autoscaling.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])
+        instances = response['AutoScalingGroups'][0]['Instances']
+    except Exception as e:
+        logger.error(f"Failed to retrieve NAT instance IDs from ASG {asg_name}: {e}")
+        return []
+    return sorted(instance['InstanceId'] for instance in instances if instance['LifecycleState'] == 'InService')
+
+
+def shard_route_tables(route_tables, instance_ids):
+    """
+    Assigns each of route_tables to one of instance_ids by rendezvous hashing,
+    a form of consistent hashing: adding or removing an instance only moves
+    the route tables it gains or loses.
+    """
+    import hashlib
+
+    def score(rtb, instance_id):
+        return hashlib.sha256(f"{instance_id}:{rtb}".encode()).digest()
+    return {rtb: max(instance_ids, key=lambda instance_id: score(rtb, instance_id)) for rtb in route_tables}
+
+
+def get_route_table_owners(route_tables, asg_name, nat_instance_id):
+    """
+    Returns the NAT instance that should carry each of route_tables: its shard
+    owner when SHARD_ROUTE_TABLES is set, otherwise nat_instance_id.
+    """
+    if get_env_bool("SHARD_ROUTE_TABLES", DEFAULT_SHARD_ROUTE_TABLES):
+        instance_ids = get_nat_instance_ids(asg_name)
+        if instance_ids:
+            return shard_route_tables(route_tables, instance_ids)
+    return {rtb: nat_instance_id for rtb in route_tables}
+
+
+def get_nat_instance_owners(route_tables, asg_name):
+    """
+    Returns get_route_table_owners for the InService NAT instances of
+    asg_name, or None if there are none.
+    """
+    nat_instance_id = get_current_nat_instance_id(asg_name)
+    if not nat_instance_id:
+        return None
+    return get_route_table_owners(route_tables, asg_name, nat_instance_id)
+
+
+def get_default_route_targets(route_tables):
+    """
+    Returns the NAT instance or NAT Gateway that the default route of each of
+    route_tables points to.
+    """
+    return {rtb: route["target_id"] for rtb, route in inspect_routes(route_tables).items()}
+
+
+def rebalance_nat_instance_shards(target):
+    """
+    Moves target's route tables to their shard owners among the InService NAT
+    instances of its ASG. Route tables on a NAT instance that doesn't own
+    them always move. Route tables on a NAT Gateway only move when the set of
+    InService instances has changed, just as a single new NAT instance takes
+    every route table when it boots, and never when saturation failover or
+    load sharing put them there. Like a NAT restore, they also wait out the
+    restore hold-down.
+
+    An instance can be InService before its user data has configured NAT, so
+    owners that weren't InService at the last rebalance must pass
+    run_nat_instance_diagnostics first. Route tables that can't move yet keep
+    their previous shard_instances and are retried on the next run.
+    """
+    route_tables = target["route_table_ids"]
+    instance_ids = get_nat_instance_ids(target.get("nat_asg_name"))
+    if not instance_ids:
+        return
+
+    states = load_route_states(route_tables)
+    owners = shard_route_tables(route_tables, instance_ids)
+    current = get_default_route_targets(route_tables)
+    moves = {}
+    for rtb in route_tables:
+        state = states.get(rtb, {})
+        on_instance = (current.get(rtb) or "").startswith("i-")
+        instances_changed = state.get("shard_instances") != instance_ids
+        held = any(state.get(flag) for flag in HELD_ROUTE_FLAGS)
+        if current.get(rtb) != owners[rtb] and (on_instance or (instances_changed and not held)):
+            moves.setdefault(owners[rtb], []).append(rtb)
+
+    deferred = set()
+    on_gateway = [rtb for shard in moves.values() for rtb in shard if not (current.get(rtb) or "").startswith("i-")]
+    if on_gateway and is_restore_held_down(on_gateway):
+        deferred.update(on_gateway)
+
+    known = {instance_id for state in states.values() for instance_id in state.get("shard_instances") or []}
+    check_urls = target.get("check_urls") or os.getenv("CHECK_URLS", ",".join(DEFAULT_CHECK_URLS)).split(",")
+    for instance_id, shard in moves.items():
+        shard = [rtb for rtb in shard if rtb not in deferred]
+        if not shard:
+            continue
+        if instance_id not in known:
+            with timed_phase("restore_health_check"):
+                healthy = run_nat_instance_diagnostics(instance_id, check_urls)
+            if not healthy:
+                logger.warning("New NAT instance %s failed its health check, not moving %s to it yet", instance_id, shard)
+                deferred.update(shard)
+                continue
+        logger.info("Moving route tables %s to their shard owner %s", shard, instance_id)
+        with timed_phase("route_replacement", RouteTableCount=len(shard)):
+            # Moving route tables off a NAT Gateway restores them after a failover
+            restored = [rtb for rtb in shard if rtb in on_gateway]
+            if restored:
+                replace_routes(restored, instance_id)
+            if len(restored) < len(shard):
+                replace_routes([rtb for rtb in shard if rtb not in restored], instance_id, planned=True)
+    record_route_states({rtb: {"shard_instances": instance_ids} for rtb in route_tables if rtb not in deferred})
+
+
 def connectivity_test_handler(event, context):
     if not isinstance(event, dict):
         logger.error(f"Unknown event: {event}")
@@ -359,22 +2113,379 @@ def connectivity_test_handler(event, context):
 
     logger.debug("Starting NAT instance connectivity test")
 
-    check_interval = int(os.getenv("CONNECTIVITY_CHECK_INTERVAL", DEFAULT_CONNECTIVITY_CHECK_INTERVAL))
+    check_interval = float(os.getenv("CONNECTIVITY_CHECK_INTERVAL", DEFAULT_CONNECTIVITY_CHECK_INTERVAL))
     check_urls = "CHECK_URLS" in os.environ and os.getenv("CHECK_URLS").split(",") or DEFAULT_CHECK_URLS
 
     has_ipv6 = get_env_bool("HAS_IPV6", DEFAULT_HAS_IPV6)
     if not has_ipv6:
         disable_ipv6()
 
-    # Run connectivity checks for approximately 1 minute
-    run = 0
-    num_runs = 60 / check_interval
-    while run < num_runs:
-        if check_connection(check_urls):
-            time.sleep(check_interval)
-            run += 1
-        else:
-            break
+    try:
+        run_connectivity_checks(get_connectivity_targets(), check_urls, check_interval)
+    finally:
+        close_probe_sessions()
+
+
+def get_connectivity_target():
+    """
+    Returns the target of a tester that covers a single AZ, as configured in
+    its environment.
+    """
+    return {
+        "route_table_ids": os.getenv("ROUTE_TABLE_IDS_CSV", "").split(","),
+        "public_subnet_id": os.getenv("PUBLIC_SUBNET_ID"),
+        "nat_asg_name": os.getenv("NAT_ASG_NAME"),
+        "vpc_id": os.getenv("VPC_ID"),
+        "nat_gateway_id": os.getenv("NAT_GATEWAY_ID"),
+    }
+
+
+def get_connectivity_targets():
+    """
+    Returns the targets listed in the CONNECTIVITY_TEST_MANIFEST JSON, or the
+    single target from the environment if there is no manifest. Each manifest
+    entry has "route_table_ids" and "public_subnet_id", and optionally
+    "nat_asg_name", "check_urls", "vpc_id", "nat_gateway_id" and a "name" used
+    in logs. The function wide VPC_ID and NAT_GATEWAY_ID don't apply to
+    manifest targets, which may be in other VPCs.
+
+    The tester's probes only exercise the NAT path of its own subnets, so
+    every manifest target must be behind the same NAT instance as one of the
+    tester's route tables. Otherwise the target would fail over whenever the
+    tester's NAT instance fails, and never when its own does. Without
+    TESTER_SUBNET_IDS that can't be checked, so only a single target, which
+    must be the tester's own, is accepted.
+    """
+    manifest = os.getenv("CONNECTIVITY_TEST_MANIFEST")
+    if not manifest:
+        return [get_connectivity_target()]
+
+    targets = json.loads(manifest)
+    for target in targets:
+        if not target.get("route_table_ids"):
+            raise MissingRouteTableError(target)
+        if not target.get("public_subnet_id"):
+            raise MissingAZSubnetError(target)
+        if "check_urls" in target and not target["check_urls"]:
+            raise MissingCheckUrlsError(target)
+
+    tester_route_tables = get_tester_route_tables()
+    if tester_route_tables is None:
+        if len(targets) > 1:
+            logger.error("TESTER_SUBNET_IDS not set, unable to check that manifest targets share the tester's NAT path")
+            raise UnprobeableTargetError(targets)
+        return targets
+    probed_subnets = {
+        target["public_subnet_id"] for target in targets if set(target["route_table_ids"]) & set(tester_route_tables)
+    }
+    for target in targets:
+        if target["public_subnet_id"] not in probed_subnets:
+            raise UnprobeableTargetError(target)
+    return targets
+
+
+def get_tester_route_tables():
+    """
+    Returns the route tables of the subnets in TESTER_SUBNET_IDS, the subnets
+    the connectivity tester runs in, or None if it isn't set.
+    """
+    subnet_ids = [subnet_id for subnet_id in os.getenv("TESTER_SUBNET_IDS", "").split(",") if subnet_id]
+    if not subnet_ids:
+        return None
+    return get_cached_topology(("tester_route_tables", tuple(subnet_ids)), describe_subnet_route_tables, subnet_ids)
+
+
+def describe_subnet_route_tables(subnet_ids):
+    """
+    Returns the route tables associated with subnet_ids, including the VPC's
+    main route table for subnets without an explicit association.
+    """
+    ec2_client = get_client("ec2")
+    vpc_id = ec2_client.describe_subnets(SubnetIds=subnet_ids[:1])["Subnets"][0]["VpcId"]
+    associated = {}
+    main_route_table = None
+    paginator = ec2_client.get_paginator("describe_route_tables")
+    for page in paginator.paginate(Filters=[{"Name": "vpc-id", "Values": [vpc_id]}]):
+        for rtb in page["RouteTables"]:
+            for association in rtb.get("Associations", []):
+                if association.get("Main"):
+                    main_route_table = rtb["RouteTableId"]
+                elif association.get("SubnetId") in subnet_ids:
+                    associated[association["SubnetId"]] = rtb["RouteTableId"]
+    route_tables = set(associated.values())
+    if len(associated) < len(set(subnet_ids)) and main_route_table:
+        route_tables.add(main_route_table)
+    return sorted(route_tables)
+
+
+def run_route_table_maintenance(targets):
+    """
+    Runs the enabled saturation, shard and load sharing checks for every
+    target, logging rather than raising their errors so that connectivity
+    checks still run.
+    """
+    if get_env_bool("ENABLE_SATURATION_FAILOVER", DEFAULT_ENABLE_SATURATION_FAILOVER):
+        for target in targets:
+            try:
+                check_saturation(target)
+            except Exception as error:
+                logger.error("Saturation check for %s failed: %s", target.get("name", target["route_table_ids"]), error)
+    if get_env_bool("SHARD_ROUTE_TABLES", DEFAULT_SHARD_ROUTE_TABLES):
+        for target in targets:
+            try:
+                rebalance_nat_instance_shards(target)
+            except Exception as error:
+                logger.error("Rebalancing shards of %s failed: %s", target.get("name", target["route_table_ids"]), error)
+    if get_env_bool("ENABLE_LOAD_SHARING", DEFAULT_ENABLE_LOAD_SHARING):
+        for target in targets:
+            try:
+                rebalance_route_tables(target)
+            except Exception as error:
+                logger.error("Rebalancing %s failed: %s", target.get("name", target["route_table_ids"]), error)
+
+
+def timed_check_connection(check_urls, failure_window, target):
+    """Returns the result of check_connection and the round trip of its probes."""
+    timings = {}
+    connected = check_connection(check_urls, failure_window, target, timings=timings)
+    return connected, timings.get("probe", 0.0)
+
+
+def run_connectivity_checks(targets, check_urls, check_interval):
+    """
+    Checks connectivity for every target each check_interval seconds for about
+    a minute. Targets are checked concurrently, at most
+    CONNECTIVITY_TEST_MAX_CONCURRENCY at a time, each with its own failure
+    window. A target that fails over, or raises, is not checked again during
+    this run; the others carry on. The first error is raised at the end.
+
+    With ENABLE_ADAPTIVE_CHECK_INTERVAL, check_scheduler stretches the interval
+    while every target is healthy, and the run ends as soon as the next check
+    would fall due after the next scheduled invocation has started, which then
+    takes it over. At the slow interval this cuts the run time, not just the
+    number of probes. Both the minute and the early end are measured in wall
+    clock time, so the time spent checking counts as well as the sleeps.
+    """
+    adaptive = get_env_bool("ENABLE_ADAPTIVE_CHECK_INTERVAL", DEFAULT_ENABLE_ADAPTIVE_CHECK_INTERVAL)
+    slow_probe = float(os.getenv("CONNECTIVITY_CHECK_SLOW_PROBE", DEFAULT_CONNECTIVITY_CHECK_SLOW_PROBE))
+    failure_windows = [
+        FailureWindow(
+            int(os.getenv("CONNECTIVITY_FAILURE_THRESHOLD", DEFAULT_CONNECTIVITY_FAILURE_THRESHOLD)),
+            float(os.getenv("CONNECTIVITY_FAILURE_WINDOW", DEFAULT_CONNECTIVITY_FAILURE_WINDOW)),
+        )
+        for _ in targets
+    ]
+    for target in targets:
+        if target["route_table_ids"][0] and target.get("public_subnet_id"):
+            prefetch_topology(target["route_table_ids"], target["public_subnet_id"], target)
+
+    run_route_table_maintenance(targets)
+
+    max_concurrency = int(os.getenv("CONNECTIVITY_TEST_MAX_CONCURRENCY", DEFAULT_CONNECTIVITY_TEST_MAX_CONCURRENCY))
+    errors = []
+    active = list(range(len(targets)))
+    with ThreadPoolExecutor(max_workers=min(len(targets), max_concurrency)) as executor:
+        # Run connectivity checks for approximately 1 minute. Probes, route
+        # replacement and state store calls take time too, so only counting
+        # the sleeps would overlap the next invocation at short intervals.
+        deadline = time.monotonic() + CONNECTIVITY_TEST_PERIOD
+        while active and time.monotonic() < deadline:
+            futures = {
+                executor.submit(
+                    timed_check_connection, targets[i].get("check_urls", check_urls), failure_windows[i], targets[i]
+                ): i
+                for i in active
+            }
+            healthy = True
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    connected, duration = future.result()
+                    # Failures below the failure threshold still count as unhealthy
+                    healthy = healthy and not failure_windows[i].failures and duration <= slow_probe
+                    if connected:
+                        continue
+                except Exception as error:
+                    logger.error("Connectivity test for %s failed: %s", targets[i].get("name", i), error)
+                    errors.append(error)
+                healthy = False
+                active.remove(i)
+
+            if active:
+                interval = check_scheduler.next_interval(healthy, check_interval) if adaptive else check_interval
+                remaining = deadline - time.monotonic()
+                if adaptive:
+                    put_metric("ConnectivityCheckInterval", interval, "Seconds", phase="detection")
+                    if interval >= remaining:
+                        break
+                # A check due after the deadline would be left to the next invocation anyway
+                time.sleep(max(0, min(interval, remaining)))
+
+    if errors:
+        raise errors[0]
+
+class ConnectivityMonitor:
+    """
+    Continuously checks connectivity for every target from an asyncio event
+    loop, as an alternative to the connectivity tester Lambda for long running
+    containers. Each target is checked in its own task, with check_connection
+    run in a worker thread of the monitor's own pool, one per target plus one
+    for maintenance, so a slow or failing target doesn't delay the others.
+    Unlike a tester invocation, a target keeps being checked after it fails
+    over, so that NAT restore can move it back. A target's maintenance and
+    checks hold its lock, so they never move its route tables at once.
+    """
+
+    def __init__(self, targets, check_urls):
+        import asyncio
+
+        self.targets = targets
+        self.check_urls = check_urls
+        self.stopping = asyncio.Event()
+        self.last_checked = {}
+        self.server = None
+        # The loop's default executor can have fewer workers than targets
+        self.executor = ThreadPoolExecutor(max_workers=len(targets) + 1)
+        # Maintenance reads route state before moving route tables, so a
+        # failover by the target's check must not land in between
+        self.locks = [threading.Lock() for _ in targets]
+
+    def name(self, i):
+        return self.targets[i].get("name", ",".join(self.targets[i]["route_table_ids"]))
+
+    def stop(self):
+        if not self.stopping.is_set():
+            logger.info("Stopping connectivity monitor")
+            self.stopping.set()
+
+    async def run_in_thread(self, func, *args):
+        import asyncio
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def run_locked(self, i, func, *args):
+        """Runs func holding target i's lock, from a worker thread."""
+        with self.locks[i]:
+            return func(*args)
+
+    async def sleep(self, seconds):
+        """Sleeps for seconds, or returns True early once the monitor is stopping."""
+        import asyncio
+
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        return self.stopping.is_set()
+
+    async def monitor_target(self, i, check_interval):
+        target = self.targets[i]
+        check_urls = target.get("check_urls", self.check_urls)
+        failure_window = FailureWindow(
+            int(os.getenv("CONNECTIVITY_FAILURE_THRESHOLD", DEFAULT_CONNECTIVITY_FAILURE_THRESHOLD)),
+            float(os.getenv("CONNECTIVITY_FAILURE_WINDOW", DEFAULT_CONNECTIVITY_FAILURE_WINDOW)),
+        )
+        scheduler = CheckScheduler()
+        adaptive = get_env_bool("ENABLE_ADAPTIVE_CHECK_INTERVAL", DEFAULT_ENABLE_ADAPTIVE_CHECK_INTERVAL)
+        slow_probe = float(os.getenv("CONNECTIVITY_CHECK_SLOW_PROBE", DEFAULT_CONNECTIVITY_CHECK_SLOW_PROBE))
+        while not self.stopping.is_set():
+            try:
+                connected, duration = await self.run_in_thread(
+                    self.run_locked, i, timed_check_connection, check_urls, failure_window, target
+                )
+                healthy = connected and not failure_window.failures and duration <= slow_probe
+            except Exception as error:
+                logger.error("Connectivity test for %s failed: %s", self.name(i), error)
+                healthy = False
+            else:
+                self.last_checked[i] = time.monotonic()
+            interval = scheduler.next_interval(healthy, check_interval) if adaptive else check_interval
+            await self.sleep(interval)
+
+    async def run_maintenance(self):
+        interval = float(os.getenv("MONITOR_MAINTENANCE_INTERVAL", DEFAULT_MONITOR_MAINTENANCE_INTERVAL))
+        while not self.stopping.is_set():
+            for i, target in enumerate(self.targets):
+                await self.run_in_thread(self.run_locked, i, run_route_table_maintenance, [target])
+            await self.sleep(interval)
+
+    def health(self):
+        """Returns whether every target completed a check recently, and the age of each target's last check."""
+        stale_after = float(os.getenv("MONITOR_STALE_AFTER", DEFAULT_MONITOR_STALE_AFTER))
+        now = time.monotonic()
+        ages = {self.name(i): now - self.last_checked[i] if i in self.last_checked else None for i in range(len(self.targets))}
+        return all(age is not None and age <= stale_after for age in ages.values()), ages
+
+    async def handle_health_request(self, reader, writer):
+        """Answers any HTTP request with 200 while healthy and 503 otherwise."""
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+        except Exception:
+            pass
+        healthy, ages = self.health()
+        body = json.dumps({"healthy": healthy, "last_checked_seconds_ago": ages}).encode()
+        status = b"200 OK" if healthy else b"503 Service Unavailable"
+        writer.write(
+            b"HTTP/1.1 " + status + b"\r\nContent-Type: application/json\r\n"
+            + b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def run(self, check_interval):
+        """
+        Runs until stop is called. In-flight checks are allowed to finish, so
+        a route replacement is never abandoned halfway.
+        """
+        import asyncio
+
+        for target in self.targets:
+            if target["route_table_ids"][0] and target.get("public_subnet_id"):
+                await self.run_in_thread(prefetch_topology, target["route_table_ids"], target["public_subnet_id"], target)
+
+        self.server = server = await asyncio.start_server(
+            self.handle_health_request,
+            os.getenv("MONITOR_HEALTH_HOST", DEFAULT_MONITOR_HEALTH_HOST),
+            int(os.getenv("MONITOR_HEALTH_PORT", DEFAULT_MONITOR_HEALTH_PORT)),
+        )
+        try:
+            await asyncio.gather(
+                self.run_maintenance(),
+                *(self.monitor_target(i, check_interval) for i in range(len(self.targets))),
+            )
+        finally:
+            server.close()
+            await server.wait_closed()
+            self.executor.shutdown(wait=True)
+            close_probe_sessions()
+        logger.info("Connectivity monitor stopped")
+
+
+def run_monitor():
+    """
+    Entry point of the long running connectivity monitor, configured like
+    the connectivity tester. Stops gracefully on SIGTERM or SIGINT.
+    """
+    import asyncio
+    import signal
+
+    logging.basicConfig()
+    check_interval = float(os.getenv("CONNECTIVITY_CHECK_INTERVAL", DEFAULT_CONNECTIVITY_CHECK_INTERVAL))
+    check_urls = "CHECK_URLS" in os.environ and os.getenv("CHECK_URLS").split(",") or DEFAULT_CHECK_URLS
+    if not get_env_bool("HAS_IPV6", DEFAULT_HAS_IPV6):
+        disable_ipv6()
+
+    async def main():
+        monitor = ConnectivityMonitor(get_connectivity_targets(), check_urls)
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, monitor.stop)
+        await monitor.run(check_interval)
+
+    asyncio.run(main())
+
 
 def get_env_bool(var_name, default_value=False):
     value = os.getenv(var_name, default_value)
@@ -389,7 +2500,7 @@ def complete_asg_lifecycle_action(
     lifecycle_action_result,
     ignore_validation_error=True,
 ):
-    autoscaling_client = boto3.client("autoscaling")
+    autoscaling_client = get_client("autoscaling")
     try:
         autoscaling_client.complete_lifecycle_action(
             AutoScalingGroupName=auto_scaling_group_name,
@@ -407,7 +2518,201 @@ def complete_asg_lifecycle_action(
     return True
 
 
-def handler(event, _):
+def get_asg_route_tables(asg):
+    """
+    Returns the route tables managed for the AZ of the NAT instance ASG, along
+    with the public subnet that holds its standby NAT Gateway.
+    """
+    availability_zone, vpc_zone_identifier = get_az_and_vpc_zone_identifier(asg)
+    public_subnet_id = vpc_zone_identifier.split(",")[0]
+    az = availability_zone.upper().replace("-", "_")
+    route_tables = az in os.environ and os.getenv(az).split(",")
+    if not route_tables:
+        raise MissingEnvironmentVariableError
+    return route_tables, public_subnet_id
+
+
+def get_route_tables_using_instance(route_tables, instance_id):
+    try:
+        routes = inspect_routes(route_tables)
+    except botocore.exceptions.ClientError as error:
+        logger.error("Unable to describe route tables")
+        raise error
+    return [rtb for rtb in route_tables if routes.get(rtb, {}).get("target_id") == instance_id]
+
+
+def get_nat_instance_asg(instance_id):
+    """
+    Returns the name of the ASG of instance_id if it is a NAT instance, or None
+    for any other instance.
+    """
+    try:
+        response = get_client("ec2").describe_instances(InstanceIds=[instance_id])
+    except botocore.exceptions.ClientError as error:
+        logger.error("Unable to describe instance %s", instance_id)
+        raise error
+
+    instance = response["Reservations"][0]["Instances"][0]
+    tags = {tag["Key"]: tag["Value"] for tag in instance.get("Tags", [])}
+    if tags.get(NAT_INSTANCE_TAG) != "true":
+        return None
+    return tags.get("aws:autoscaling:groupName")
+
+
+def get_impaired_instances(instance_ids):
+    """Returns those of instance_ids whose instance or system status check fails."""
+    try:
+        response = get_client("ec2").describe_instance_status(InstanceIds=instance_ids, IncludeAllInstances=True)
+    except botocore.exceptions.ClientError as error:
+        logger.error("Unable to describe the status of instances %s", instance_ids)
+        raise error
+
+    return [
+        status["InstanceId"]
+        for status in response["InstanceStatuses"]
+        if "impaired" in (status.get("InstanceStatus", {}).get("Status"), status.get("SystemStatus", {}).get("Status"))
+    ]
+
+
+def get_alarm_dimensions(detail):
+    dimensions = {}
+    for metric in detail.get("configuration", {}).get("metrics", []):
+        dimensions.update(metric.get("metricStat", {}).get("metric", {}).get("dimensions", {}))
+    return dimensions
+
+
+def instance_event_handler(event, _):
+    """
+    Fails over immediately on EventBridge events signalling that a NAT instance
+    is going away or impaired, without waiting for the next connectivity test:
+
+    - EC2 instance state changes to stopping, stopped, shutting-down or
+      terminated. Only route tables still pointing at that instance move.
+    - CloudWatch alarms entering ALARM with an InstanceId or
+      AutoScalingGroupName dimension, such as a StatusCheckFailed alarm.
+      Only route tables using the alarmed instance move, or with
+      SHARD_ROUTE_TABLES, those using an instance of the ASG that EC2
+      reports as impaired.
+    """
+    detail_type = event.get("detail-type")
+    detail = event.get("detail", {})
+    instance_id = None
+
+    if event.get("source") == "aws.ec2" and detail_type == EC2_STATE_CHANGE_DETAIL_TYPE:
+        if detail.get("state") not in FAILOVER_INSTANCE_STATES:
+            logger.debug("Ignoring instance state %s", detail.get("state"))
+            return
+        instance_id = detail["instance-id"]
+        asg = get_nat_instance_asg(instance_id)
+    elif event.get("source") == "aws.cloudwatch" and detail_type == CLOUDWATCH_ALARM_DETAIL_TYPE:
+        if detail.get("state", {}).get("value") != "ALARM":
+            logger.debug("Ignoring alarm state %s", detail.get("state"))
+            return
+        dimensions = get_alarm_dimensions(detail)
+        asg = dimensions.get(AUTO_SCALING_GROUP_NAME_KEY)
+        if not asg and "InstanceId" in dimensions:
+            instance_id = dimensions["InstanceId"]
+            asg = get_nat_instance_asg(instance_id)
+    else:
+        logger.error(f"Unable to handle unknown event type: {json.dumps(event)}")
+        raise UnknownEventTypeError
+
+    if not asg:
+        logger.info("Event does not concern a NAT instance, ignoring")
+        return
+
+    logger.warning("Received %s for NAT instance ASG %s, replacing route", detail_type, asg)
+    with timed_phase("asg_lookup"):
+        route_tables, public_subnet_id = get_asg_route_tables(asg)
+        instance_ids = [instance_id] if instance_id else []
+        # An alarm on the whole ASG doesn't say which of several sharded
+        # instances is impaired, so ask EC2
+        sharded = get_env_bool("SHARD_ROUTE_TABLES", DEFAULT_SHARD_ROUTE_TABLES)
+        if not instance_id and sharded:
+            nat_instance_ids = get_nat_instance_ids(asg)
+            if len(nat_instance_ids) > 1:
+                instance_ids = get_impaired_instances(nat_instance_ids)
+                if not instance_ids:
+                    logger.warning("No NAT instance of %s is impaired, leaving failover to the connectivity tester", asg)
+                    return
+        if instance_ids:
+            route_tables = [rtb for failed in instance_ids for rtb in get_route_tables_using_instance(route_tables, failed)]
+    if not route_tables:
+        logger.info("No route tables use instances %s, nothing to replace", instance_ids)
+        return
+
+    fail_over_to_nat_gateway(route_tables, public_subnet_id)
+    logger.info("Route replacement succeeded")
+
+
+def process_lifecycle_message(message):
+    asg = message[AUTO_SCALING_GROUP_NAME_KEY]
+    instance_id = message.get(EC2_INSTANCE_ID_KEY)
+
+    with timed_phase("asg_lookup"):
+        route_tables, public_subnet_id = get_asg_route_tables(asg)
+        # While other NAT instances are InService, only the terminating
+        # instance's shards fail over
+        sharded = get_env_bool("SHARD_ROUTE_TABLES", DEFAULT_SHARD_ROUTE_TABLES)
+        if sharded and instance_id and set(get_nat_instance_ids(asg)) - {instance_id}:
+            route_tables = get_route_tables_using_instance(route_tables, instance_id)
+
+    if route_tables:
+        fail_over_to_nat_gateway(route_tables, public_subnet_id)
+        logger.info("Route replacement succeeded")
+
+    with timed_phase("lifecycle_completion"):
+        complete_asg_lifecycle_action(
+            asg, message[LIFECYCLE_HOOK_NAME_KEY], message[LIFECYCLE_ACTION_TOKEN_KEY], "CONTINUE"
+        )
+
+
+def process_lifecycle_messages(messages):
+    """
+    Processes the lifecycle messages of each ASG in turn, and different ASGs
+    concurrently. Returns the errors of messages that failed.
+    """
+    by_asg = {}
+    for message in messages:
+        by_asg.setdefault(message[AUTO_SCALING_GROUP_NAME_KEY], []).append(message)
+
+    def process(asg_messages):
+        errors = []
+        for message in asg_messages:
+            token = message[LIFECYCLE_ACTION_TOKEN_KEY]
+            try:
+                process_lifecycle_message(message)
+                mark_lifecycle_token_processed(token)
+            except Exception as error:
+                logger.error("Lifecycle action %s for %s failed: %s", token, message[AUTO_SCALING_GROUP_NAME_KEY], error)
+                errors.append(error)
+        return errors
+
+    with ThreadPoolExecutor(max_workers=len(by_asg)) as executor:
+        return [error for errors in executor.map(process, by_asg.values()) for error in errors]
+
+
+def is_lifecycle_token_processed(token):
+    with processed_lifecycle_tokens_lock:
+        expiry = processed_lifecycle_tokens.get(token)
+        return expiry is not None and expiry > time.monotonic()
+
+
+def mark_lifecycle_token_processed(token):
+    with processed_lifecycle_tokens_lock:
+        now = time.monotonic()
+        for expired in [t for t, expiry in processed_lifecycle_tokens.items() if expiry <= now]:
+            del processed_lifecycle_tokens[expired]
+        processed_lifecycle_tokens[token] = now + LIFECYCLE_TOKEN_TTL
+
+
+def handler(event, context):
+    # EventBridge failover events are delivered to the same function as the
+    # lifecycle hook so that they share its route table configuration
+    if "source" in event:
+        return instance_event_handler(event, context)
+
+    messages = {}
     try:
         for record in event["Records"]:
             message = json.loads(record["Sns"]["Message"])
@@ -415,9 +2720,7 @@ def handler(event, _):
                 LIFECYCLE_HOOK_NAME_KEY in message
                 and AUTO_SCALING_GROUP_NAME_KEY in message
             ):
-                asg = message[AUTO_SCALING_GROUP_NAME_KEY]
-                lifecycle_hook_name = message[LIFECYCLE_HOOK_NAME_KEY]
-                lifecycle_action_token = message[LIFECYCLE_ACTION_TOKEN_KEY]
+                messages.setdefault(message[LIFECYCLE_ACTION_TOKEN_KEY], message)
             else:
                 logger.error("Failed to find lifecycle message to parse")
                 raise LifecycleMessageError
@@ -425,26 +2728,35 @@ def handler(event, _):
         logger.error("Error: %s", error)
         raise error
 
-    availability_zone, vpc_zone_identifier = get_az_and_vpc_zone_identifier(asg)
-    public_subnet_id = vpc_zone_identifier.split(",")[0]
-    az = availability_zone.upper().replace("-", "_")
-    route_tables = az in os.environ and os.getenv(az).split(",")
-    if not route_tables:
-        raise MissingEnvironmentVariableError
-    vpc_id = get_vpc_id(route_tables[0])
+    # SNS may deliver a message more than once
+    pending = [message for token, message in messages.items() if not is_lifecycle_token_processed(token)]
+    if len(pending) < len(event["Records"]):
+        logger.info("Skipping %d duplicate lifecycle messages", len(event["Records"]) - len(pending))
+    if not pending:
+        return
 
-    nat_gateway_id = get_nat_gateway_id(vpc_id, public_subnet_id)
+    errors = process_lifecycle_messages(pending)
+    if errors:
+        raise errors[0]
 
-    for rtb in route_tables:
-        replace_route(rtb, nat_gateway_id)
-        logger.info("Route replacement succeeded")
 
-    complete_asg_lifecycle_action(
-        asg, lifecycle_hook_name, lifecycle_action_token, "CONTINUE"
-    )
+class UnknownEventTypeError(Exception): pass
 
 
-class UnknownEventTypeError(Exception): pass
+class UnknownProbeTypeError(Exception): pass
+
+
+class MissingCheckUrlsError(Exception): pass
+
+
+class UnprobeableTargetError(Exception): pass
+
+
+class ProbeError(Exception):
+    def __init__(self, stage, error):
+        super().__init__(stage, error)
+        self.stage = stage
+        self.error = error
 
 
 class MissingVpcConfigError(Exception): pass
@@ -468,7 +2780,20 @@ class MissingNatGatewayError(Exception): pass
 class MissingRouteTableError(Exception): pass
 
 
+class RouteReplacementError(Exception): pass
+
+
+class RouteVerificationError(Exception): pass
+
+
+class SSMCommandTimeoutError(Exception): pass
+
+
 class LifecycleMessageError(Exception): pass
 
 
 class MissingEnvironmentVariableError(Exception): pass
+
+
+if __name__ == "__main__":
+    run_monitor()
@@ -0,0 +1,287 @@
+"""
+Measures end to end latency of the failover paths against moto, with
+injectable AWS API latency and failure rates and simulated check URLs.
+
+Run like this : `AWS_DEFAULT_REGION='us-east-1' python benchmark_failover.py`
+
+Pass `--output results.json` to save a run and `--baseline results.json` to
+compare a later run against it.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import time
+import urllib.error
+
+import boto3
+import botocore
+import mock
+
+from moto import mock_aws
+
+from test_replace_route import setup_networking, setup_nat_asg, EXAMPLE_AMI_ID
+
+sys.path.append('..')
+
+# Probe timeout used in place of REQUEST_TIMEOUT so that scenarios with
+# unresponsive URLs don't take minutes to run.
+PROBE_TIMEOUT = 0.2
+
+# Response time of the one check URL that still works in the slow success
+# scenarios, well within PROBE_TIMEOUT.
+SLOW_RESPONSE = PROBE_TIMEOUT / 2
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of samples."""
+    ordered = sorted(samples)
+    rank = max(1, int(round(pct / 100 * len(ordered))))
+    return ordered[rank - 1]
+
+
+class FaultInjector:
+    """
+    Patches every botocore API call to add latency and fail a fraction of calls
+    with a throttling error, as a degraded control plane would.
+    """
+
+    def __init__(self, latency, failure_rate, overrides=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.overrides = overrides or {}
+        self.orig_make_api_call = botocore.client.BaseClient._make_api_call
+
+    def make_api_call(self, client, operation_name, kwarg):
+        time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'RequestLimitExceeded', 'Message': 'Injected failure'}},
+                operation_name
+            )
+        if operation_name in self.overrides:
+            return self.overrides[operation_name](kwarg)
+        return self.orig_make_api_call(client, operation_name, kwarg)
+
+    def bypass(self):
+        """Calls the API without injected latency or failures, e.g. to reset state between iterations."""
+        return mock.patch("botocore.client.BaseClient._make_api_call", new=self.orig_make_api_call)
+
+    def patch(self):
+        injector = self
+
+        def make_api_call(client, operation_name, kwarg):
+            return injector.make_api_call(client, operation_name, kwarg)
+        return mock.patch("botocore.client.BaseClient._make_api_call", new=make_api_call)
+
+
+def fake_urlopen(behaviours):
+    """
+    Simulates check URLs that "hang" until the probe times out, "refuse"
+    immediately, or respond after the given number of seconds.
+    """
+    def urlopen(req, timeout):
+        behaviour = behaviours[req.full_url]
+        if behaviour == "hang":
+            time.sleep(timeout)
+            raise socket.timeout()
+        if behaviour == "refuse":
+            raise urllib.error.URLError("connection refused")
+        time.sleep(float(behaviour))
+        return mock.Mock()
+    return urlopen
+
+
+def measure(app, args, run, reset=None):
+    """
+    Times args.iterations calls of run, calling reset untimed before each one.
+    Calls that raise, for example due to injected API failures, are still
+    timed and counted as errors.
+    """
+    samples = []
+    errors = 0
+    for _ in range(args.iterations):
+        if reset:
+            reset()
+        # Otherwise every lifecycle message after the first is a duplicate
+        app.processed_lifecycle_tokens.clear()
+        if not args.warm:
+            app.topology_cache.clear()
+            app.clients.clear()
+            app.memory_state_store.items.clear()
+            app.latency_samples.clear()
+        start = time.perf_counter()
+        try:
+            run()
+        except Exception:
+            errors += 1
+        samples.append(time.perf_counter() - start)
+    return samples, errors
+
+
+def setup_route_tables(count):
+    """
+    Builds on setup_networking with count private route tables, all routing
+    through the NAT instance's network interface.
+    """
+    mocked_networking = setup_networking()
+    ec2_client = boto3.client("ec2")
+    eni = ec2_client.create_network_interface(SubnetId=mocked_networking["public_subnet"])
+    mocked_networking["eni"] = eni["NetworkInterface"]["NetworkInterfaceId"]
+    route_tables = [mocked_networking["route_table"], mocked_networking["route_table_two"]]
+    while len(route_tables) < count:
+        route_table = ec2_client.create_route_table(VpcId=mocked_networking["vpc"])["RouteTable"]["RouteTableId"]
+        ec2_client.create_route(
+            DestinationCidrBlock="0.0.0.0/0",
+            NetworkInterfaceId=mocked_networking["eni"],
+            RouteTableId=route_table,
+        )
+        route_tables.append(route_table)
+    mocked_networking["route_tables"] = route_tables[:count]
+    return mocked_networking
+
+
+def reset_route_tables(app, injector, mocked_networking):
+    """
+    Points every route table back at the NAT instance's network interface
+    and forgets the recorded route state, so that each iteration fails over
+    rather than finding the routes already on the NAT Gateway.
+    """
+    ec2_client = boto3.client("ec2")
+    with injector.bypass():
+        for route_table in mocked_networking["route_tables"]:
+            ec2_client.replace_route(
+                DestinationCidrBlock="0.0.0.0/0",
+                NetworkInterfaceId=mocked_networking["eni"],
+                RouteTableId=route_table,
+            )
+    app.memory_state_store.items.clear()
+
+
+def bench_handler(args, route_table_count):
+    import app
+
+    mocked_networking = setup_route_tables(route_table_count)
+    setup_nat_asg(mocked_networking)
+    az = f"{os.environ['AWS_DEFAULT_REGION']}a".upper().replace("-", "_")
+
+    with open(os.path.join(os.path.dirname(__file__), "../sns-event.json"), "r") as file:
+        event = json.loads(file.read())
+
+    # CompleteLifecycleAction is not implemented by Moto
+    injector = FaultInjector(args.api_latency, args.failure_rate, {"CompleteLifecycleAction": lambda kwarg: {}})
+    with mock.patch.dict(os.environ, {az: ",".join(mocked_networking["route_tables"])}), injector.patch():
+        return measure(app, args, lambda: app.handler(event, {}))
+
+
+def bench_check_connection(args, route_table_count, url_behaviours):
+    import app
+
+    mocked_networking = setup_route_tables(route_table_count)
+    behaviours = {f"https://check-{i}.example.com": b for i, b in enumerate(url_behaviours)}
+    env = {
+        "ROUTE_TABLE_IDS_CSV": ",".join(mocked_networking["route_tables"]),
+        "PUBLIC_SUBNET_ID": mocked_networking["public_subnet"],
+        "ENABLE_NAT_RESTORE": "false",
+        "CONNECTIVITY_CHECK_TIMEOUT": str(PROBE_TIMEOUT),
+    }
+
+    injector = FaultInjector(args.api_latency, args.failure_rate)
+    with mock.patch.dict(os.environ, env), injector.patch():
+        with mock.patch("urllib.request.urlopen", side_effect=fake_urlopen(behaviours)):
+            return measure(
+                app, args,
+                lambda: app.check_connection(list(behaviours)),
+                lambda: reset_route_tables(app, injector, mocked_networking),
+            )
+
+
+def bench_nat_instance_restore(args, route_table_count):
+    import app
+
+    mocked_networking = setup_route_tables(route_table_count)
+    ec2_client = boto3.client("ec2")
+    instance_id = ec2_client.run_instances(
+        ImageId=EXAMPLE_AMI_ID, MinCount=1, MaxCount=1, SubnetId=mocked_networking["public_subnet"]
+    )["Instances"][0]["InstanceId"]
+    ec2_client.modify_instance_attribute(InstanceId=instance_id, SourceDestCheck={"Value": False})
+
+    healthy_output = json.dumps({
+        "http_codes": ["200", "200"], "ip_forward": 1, "nft_masquerade": True,
+        "conntrack_count": 0, "conntrack_max": 262144,
+    })
+    injector = FaultInjector(args.api_latency, args.failure_rate, {
+        "GetCommandInvocation": lambda kwarg: {"Status": "Success", "StandardOutputContent": healthy_output},
+    })
+    env = {"ROUTE_TABLE_IDS_CSV": ",".join(mocked_networking["route_tables"])}
+    with mock.patch.dict(os.environ, env), injector.patch():
+        with mock.patch("app.get_current_nat_instance_id", return_value=instance_id):
+            return measure(app, args, app.attempt_nat_instance_restore)
+
+
+def scenarios(args):
+    for count in args.route_tables:
+        yield f"handler rtb={count}", lambda count=count: bench_handler(args, count)
+    for count in args.route_tables:
+        for url_count in args.urls:
+            # Half the URLs hang until the probe timeout, the rest refuse immediately
+            behaviours = ["hang" if i % 2 == 0 else "refuse" for i in range(url_count)]
+            yield (
+                f"check_connection rtb={count} urls={url_count}",
+                lambda count=count, behaviours=behaviours: bench_check_connection(args, count, behaviours),
+            )
+            # Only the last URL works, slowly, so detection must not wait on the others
+            behaviours = behaviours[:-1] + [str(SLOW_RESPONSE)]
+            yield (
+                f"check_connection rtb={count} urls={url_count} slow success",
+                lambda count=count, behaviours=behaviours: bench_check_connection(args, count, behaviours),
+            )
+    for count in args.route_tables:
+        yield f"attempt_nat_instance_restore rtb={count}", lambda count=count: bench_nat_instance_restore(args, count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--route-tables", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--urls", type=int, nargs="+", default=[1, 2, 5])
+    parser.add_argument("--api-latency", type=float, default=0.02, help="Seconds added to every AWS API call")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of AWS API calls that are throttled")
+    parser.add_argument("--warm", action="store_true", help="Keep cached clients and topology between iterations")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare results against a previous --output file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.disable(logging.CRITICAL)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    results = {}
+    print(f"{'scenario':<48} {'p50':>9} {'p99':>9} {'errors':>7} {'baseline p50':>13}")
+    for name, run in scenarios(args):
+        with mock_aws():
+            samples, errors = run()
+        results[name] = {"p50": percentile(samples, 50), "p99": percentile(samples, 99), "errors": errors}
+        previous = baseline.get(name, {}).get("p50")
+        comparison = f"{previous * 1000:>11.1f}ms" if previous is not None else f"{'-':>13}"
+        print(
+            f"{name:<48} {results[name]['p50'] * 1000:>7.1f}ms {results[name]['p99'] * 1000:>7.1f}ms "
+            f"{errors:>7} {comparison}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
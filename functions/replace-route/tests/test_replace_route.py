@@ -11,6 +11,12 @@ import logging
 import mock
 import socket
 import sure
+import threading
+import pytest
+import subprocess
+import time
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import botocore
@@ -26,6 +32,40 @@ logging.getLogger('botocore').setLevel(logging.CRITICAL)
 
 EXAMPLE_AMI_ID = "ami-12c6146b"
 
+# Seconds app may take to import in a fresh interpreter. It stays well under
+# this as long as boto3 and friends are only imported when first needed.
+IMPORT_TIME_BUDGET = 0.15
+
+
+@pytest.fixture(autouse=True)
+def reset_app_state():
+    # Only reset app once a test has imported it
+    if "app" in sys.modules:
+        sys.modules["app"].topology_cache.clear()
+        sys.modules["app"].clients.clear()
+        sys.modules["app"].memory_state_store.items.clear()
+        sys.modules["app"].processed_lifecycle_tokens.clear()
+        sys.modules["app"].latency_samples.clear()
+        sys.modules["app"].check_scheduler.healthy_streak = 0
+        sys.modules["app"].close_probe_sessions()
+
+
+@pytest.fixture
+def fake_sleep():
+    """
+    Patches time.sleep to return at once, while time.monotonic advances as if
+    it had slept, so that loops bounded by a deadline still end.
+    """
+    slept = [0]
+    monotonic = time.monotonic
+
+    def sleep(seconds):
+        slept[0] += seconds
+
+    with mock.patch('time.sleep', side_effect=sleep) as mock_sleep:
+        with mock.patch('time.monotonic', side_effect=lambda: monotonic() + slept[0]):
+            yield mock_sleep
+
 
 @mock_aws
 def setup_networking():
@@ -98,6 +138,43 @@ def setup_networking():
     }
 
 
+def setup_nat_asg(mocked_networking, size=1):
+    ec2_client = boto3.client("ec2")
+    template = ec2_client.create_launch_template(
+        LaunchTemplateName="test_launch_template",
+        LaunchTemplateData={"ImageId": EXAMPLE_AMI_ID, "InstanceType": "t2.micro"},
+    )["LaunchTemplate"]
+
+    autoscaling_client = boto3.client("autoscaling")
+    autoscaling_client.create_auto_scaling_group(
+        AutoScalingGroupName="alternat-asg",
+        VPCZoneIdentifier=mocked_networking["public_subnet"],
+        MinSize=size,
+        MaxSize=size,
+        LaunchTemplate={
+            "LaunchTemplateId": template["LaunchTemplateId"],
+            "Version": str(template["LatestVersionNumber"]),
+        },
+    )
+    instances = autoscaling_client.describe_auto_scaling_groups(
+        AutoScalingGroupNames=["alternat-asg"]
+    )["AutoScalingGroups"][0]["Instances"]
+    return [instance["InstanceId"] for instance in instances]
+
+
+def setup_nat_instance(mocked_networking):
+    ec2_client = boto3.client("ec2")
+    instance_id = ec2_client.run_instances(
+        ImageId=EXAMPLE_AMI_ID, MinCount=1, MaxCount=1, SubnetId=mocked_networking["public_subnet"]
+    )["Instances"][0]["InstanceId"]
+    target = {
+        "route_table_ids": [mocked_networking["route_table"], mocked_networking["route_table_two"]],
+        "public_subnet_id": mocked_networking["public_subnet"],
+        "nat_asg_name": "alternat-nat-asg",
+    }
+    return instance_id, target
+
+
 def verify_nat_gateway_route(mocked_networking):
     ec2_client = boto3.client("ec2")
 
@@ -176,6 +253,579 @@ def test_handler(monkeypatch):
     verify_nat_gateway_route(mocked_networking)
 
 
+def test_handler_batch(monkeypatch):
+    import app
+
+    def record(asg, token):
+        message = {
+            "LifecycleHookName": "NATInstanceTerminationLifeCycleHook",
+            "AutoScalingGroupName": asg,
+            "LifecycleActionToken": token,
+            "EC2InstanceId": f"i-{token}",
+        }
+        return {"Sns": {"Message": json.dumps(message)}}
+
+    event = {"Records": [record("asg-a", "1"), record("asg-b", "2"), record("asg-a", "1"), record("asg-a", "3")]}
+    started = threading.Barrier(2, timeout=5)
+    processed = []
+
+    def fake_process(message):
+        # Both ASGs must be in flight at once to get past the barrier
+        if message["LifecycleActionToken"] in ("1", "2"):
+            started.wait()
+        processed.append(message["LifecycleActionToken"])
+
+    with mock.patch('app.process_lifecycle_message', side_effect=fake_process):
+        app.handler(event, {})
+        # Duplicates are collapsed, and each ASG's messages keep their order
+        assert sorted(processed) == ["1", "2", "3"]
+        assert processed.index("1") < processed.index("3")
+
+        # A redelivery does nothing
+        app.handler({"Records": [record("asg-b", "2")]}, {})
+        assert len(processed) == 3
+
+    # A failure doesn't stop other ASGs, and is retried on redelivery
+    with mock.patch('app.process_lifecycle_message', side_effect=[RuntimeError("boom"), None]) as mock_process:
+        with pytest.raises(RuntimeError):
+            app.handler({"Records": [record("asg-c", "4"), record("asg-d", "5")]}, {})
+        assert mock_process.call_count == 2
+    with mock.patch('app.process_lifecycle_message') as mock_process:
+        app.handler({"Records": [record("asg-c", "4"), record("asg-d", "5")]}, {})
+        assert mock_process.call_count == 1
+
+
+@mock_aws
+def test_instance_event_handler(monkeypatch):
+    mocked_networking = setup_networking()
+    ec2_client = boto3.client("ec2")
+    instance_id = setup_nat_asg(mocked_networking)[0]
+    ec2_client.create_tags(Resources=[instance_id], Tags=[{"Key": "alterNATInstance", "Value": "true"}])
+
+    # Only the first route table uses the NAT instance
+    ec2_client.replace_route(
+        RouteTableId=mocked_networking["route_table"],
+        DestinationCidrBlock="0.0.0.0/0",
+        InstanceId=instance_id,
+    )
+
+    az = f"{os.environ['AWS_DEFAULT_REGION']}a".upper().replace("-", "_")
+    monkeypatch.setenv(az, ",".join([mocked_networking["route_table"], mocked_networking["route_table_two"]]))
+
+    import app
+    from app import handler
+
+    script_dir = os.path.dirname(__file__)
+    with open(os.path.join(script_dir, "../ec2-state-change-event.json"), "r") as file:
+        state_change_event = json.loads(file.read())
+    state_change_event["detail"]["instance-id"] = instance_id
+
+    with mock.patch('app.replace_route', wraps=app.replace_route) as mock_replace_route:
+        # Running instances and other instances are ignored
+        handler(dict(state_change_event, detail={"instance-id": instance_id, "state": "running"}), {})
+        other_instance = ec2_client.run_instances(ImageId=EXAMPLE_AMI_ID, MinCount=1, MaxCount=1)["Instances"][0]["InstanceId"]
+        handler(dict(state_change_event, detail={"instance-id": other_instance, "state": "stopping"}), {})
+        mock_replace_route.assert_not_called()
+
+        handler(state_change_event, {})
+        mock_replace_route.assert_called_once_with(mocked_networking["route_table"], mocked_networking["nat_gw"])
+
+        # An alarm on the ASG fails over every route table in its AZ
+        mock_replace_route.reset_mock()
+        handler({
+            "source": "aws.cloudwatch",
+            "detail-type": "CloudWatch Alarm State Change",
+            "detail": {
+                "state": {"value": "ALARM"},
+                "configuration": {"metrics": [{"metricStat": {"metric": {
+                    "namespace": "AWS/EC2",
+                    "name": "StatusCheckFailed",
+                    "dimensions": {"AutoScalingGroupName": "alternat-asg"},
+                }}}]},
+            },
+        }, {})
+        assert mock_replace_route.call_count == 2
+
+    verify_nat_gateway_route(mocked_networking)
+
+
+@mock_aws
+@mock.patch('time.sleep')
+def test_replace_routes(mock_sleep):
+    import botocore.awsrequest
+    from app import get_client, replace_routes, RouteReplacementError
+
+    sent = []
+
+    class ThrottledBody:
+        def stream(self, **kwargs):
+            yield b"<Response><Errors><Error><Code>RequestLimitExceeded</Code><Message>Test error</Message></Error></Errors></Response>"
+
+    def fake_send(request, **kwargs):
+        sent.append(request)
+        if "rtb-broken" in str(request.body):
+            return botocore.awsrequest.AWSResponse(request.url, 503, {}, ThrottledBody())
+        body = mock.Mock(stream=lambda **kwargs: iter([b"<ReplaceRouteResponse><return>true</return></ReplaceRouteResponse>"]))
+        return botocore.awsrequest.AWSResponse(request.url, 200, {}, body)
+
+    get_client("ec2").meta.events.register("before-send.ec2.ReplaceRoute", fake_send)
+    with mock.patch('app.poll_route_verification', return_value={}):
+        try:
+            replace_routes(["rtb-1", "rtb-broken"], "nat-123")
+            assert False, "Expected RouteReplacementError"
+        except RouteReplacementError as error:
+            assert list(error.args[0]) == ["rtb-broken"]
+    # The healthy table is still replaced, and the throttled one is only sent
+    # as often as the client's own retries allow
+    assert len([request for request in sent if "rtb-1" in str(request.body)]) == 1
+    assert len([request for request in sent if "rtb-broken" in str(request.body)]) == 3
+
+
+@mock_aws
+def test_inspect_routes():
+    import app
+    mocked_networking = setup_networking()
+    ec2_client = boto3.client("ec2")
+    instance_id, target = setup_nat_instance(mocked_networking)
+    route_tables = target["route_table_ids"]
+    app.replace_routes([route_tables[0]], instance_id)
+    app.replace_routes([route_tables[1]], mocked_networking["nat_gw"])
+    empty = ec2_client.create_route_table(VpcId=mocked_networking["vpc"])["RouteTable"]["RouteTableId"]
+
+    with mock.patch.object(app.get_client("ec2"), 'describe_route_tables', wraps=app.get_client("ec2").describe_route_tables) as mock_describe:
+        routes = app.inspect_routes(route_tables + [empty])
+        assert mock_describe.call_count == 1
+    assert routes == {
+        route_tables[0]: {"target_type": "instance", "target_id": instance_id, "state": "active"},
+        route_tables[1]: {"target_type": "nat_gateway", "target_id": mocked_networking["nat_gw"], "state": "active"},
+    }
+
+    # A replacement that doesn't take effect fails verification, after describing it again with backoff
+    assert app.verify_routes(route_tables, instance_id).keys() == {route_tables[1]}
+    with mock.patch('app.replace_route'), mock.patch('time.sleep') as mock_sleep:
+        with pytest.raises(app.RouteReplacementError) as error:
+            app.replace_routes(route_tables, instance_id)
+        assert [c.args[0] for c in mock_sleep.call_args_list] == [0.25, 0.5, 1]
+    assert list(error.value.args[0]) == [route_tables[1]]
+    assert isinstance(error.value.args[0][route_tables[1]], app.RouteVerificationError)
+
+    # A stale describe that catches up passes
+    stale = {route_tables[1]: app.RouteVerificationError(route_tables[1], instance_id, None)}
+    with mock.patch('app.verify_routes', side_effect=[stale, {}]), mock.patch('time.sleep'):
+        app.replace_routes(route_tables, instance_id)
+
+
+@mock_aws
+def test_fail_over_to_nat_gateway():
+    from app import fail_over_to_nat_gateway, get_nat_gateway_candidates, replace_route, RouteReplacementError, RouteVerificationError
+    mocked_networking = setup_networking()
+    ec2_client = boto3.client("ec2")
+
+    # A second standby NAT Gateway in another subnet of the same AZ
+    az = f"{os.environ['AWS_DEFAULT_REGION']}a"
+    other_subnet = ec2_client.create_subnet(
+        VpcId=mocked_networking["vpc"], CidrBlock="10.1.4.0/24", AvailabilityZone=az
+    )["Subnet"]["SubnetId"]
+    other_nat_gw = ec2_client.create_nat_gateway(
+        SubnetId=other_subnet,
+        AllocationId=ec2_client.allocate_address(Domain="vpc")["AllocationId"],
+    )["NatGateway"]["NatGatewayId"]
+
+    # The gateway in the NAT instance's public subnet is preferred
+    candidates = get_nat_gateway_candidates(mocked_networking["vpc"], mocked_networking["public_subnet"])
+    assert candidates == [mocked_networking["nat_gw"], other_nat_gw]
+
+    route_tables = [mocked_networking["route_table"], mocked_networking["route_table_two"]]
+    targets = fail_over_to_nat_gateway(route_tables, mocked_networking["public_subnet"])
+    assert targets == {rtb: mocked_networking["nat_gw"] for rtb in route_tables}
+    verify_nat_gateway_route(mocked_networking)
+
+    # Route tables that can't use the preferred gateway fall back to the next one
+    def fake_replace_route(route_table_id, target_id):
+        if route_table_id == mocked_networking["route_table_two"] and target_id == mocked_networking["nat_gw"]:
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'InvalidNatGatewayID.NotFound', 'Message': 'Test error'}},
+                'ReplaceRoute'
+            )
+        replace_route(route_table_id, target_id)
+
+    with mock.patch('time.sleep'):
+        with mock.patch('app.replace_route', side_effect=fake_replace_route):
+            targets = fail_over_to_nat_gateway(route_tables, mocked_networking["public_subnet"])
+            assert targets == {
+                mocked_networking["route_table"]: mocked_networking["nat_gw"],
+                mocked_networking["route_table_two"]: other_nat_gw,
+            }
+
+        with mock.patch('app.replace_route', side_effect=fake_replace_route):
+            with mock.patch('app.get_nat_gateway_candidates', return_value=[mocked_networking["nat_gw"]]):
+                with pytest.raises(RouteReplacementError):
+                    fail_over_to_nat_gateway(route_tables, mocked_networking["public_subnet"])
+
+        # A route table that was replaced but can't be verified doesn't fall back
+        unverified = {route_tables[1]: RouteVerificationError(route_tables[1], mocked_networking["nat_gw"], None)}
+        with mock.patch('app.poll_route_verification', return_value=unverified):
+            with mock.patch('app.get_nat_gateway_candidates', return_value=[mocked_networking["nat_gw"]]):
+                targets = fail_over_to_nat_gateway(route_tables, mocked_networking["public_subnet"])
+        assert targets == {rtb: mocked_networking["nat_gw"] for rtb in route_tables}
+
+
+@mock_aws
+def test_nat_gateway_candidates_cross_az(monkeypatch):
+    from app import get_nat_gateway_candidates
+    mocked_networking = setup_networking()
+    ec2_client = boto3.client("ec2")
+
+    # A NAT Gateway in another AZ is only used when cross-AZ fallback is enabled
+    other_az_subnet = ec2_client.create_subnet(
+        VpcId=mocked_networking["vpc"], CidrBlock="10.1.5.0/24", AvailabilityZone=f"{os.environ['AWS_DEFAULT_REGION']}b"
+    )["Subnet"]["SubnetId"]
+    other_az_nat_gw = ec2_client.create_nat_gateway(
+        SubnetId=other_az_subnet,
+        AllocationId=ec2_client.allocate_address(Domain="vpc")["AllocationId"],
+    )["NatGateway"]["NatGatewayId"]
+
+    candidates = get_nat_gateway_candidates(mocked_networking["vpc"], mocked_networking["public_subnet"])
+    assert candidates == [mocked_networking["nat_gw"]]
+
+    monkeypatch.setenv("ENABLE_CROSS_AZ_FALLBACK", "true")
+    candidates = get_nat_gateway_candidates(mocked_networking["vpc"], mocked_networking["public_subnet"])
+    assert candidates == [mocked_networking["nat_gw"], other_az_nat_gw]
+
+
+@mock_aws
+def test_configured_nat_gateway_candidates(monkeypatch):
+    import app
+    mocked_networking = setup_networking()
+    monkeypatch.setenv("NAT_GATEWAY_CANDIDATES", json.dumps({
+        mocked_networking["public_subnet"]: [mocked_networking["nat_gw"], "nat-0deleted"],
+    }))
+
+    # The configured ranking makes a failover a pure lookup
+    with mock.patch.object(app.get_client("ec2"), "describe_nat_gateways") as mock_describe:
+        candidates = app.get_nat_gateway_candidates(mocked_networking["vpc"], mocked_networking["public_subnet"])
+        mock_describe.assert_not_called()
+    assert candidates == [mocked_networking["nat_gw"], "nat-0deleted"]
+
+    # The tester checks the candidates ahead of any failure
+    with mock.patch('app.validate_nat_gateway_candidates', wraps=app.validate_nat_gateway_candidates) as mock_validate:
+        app.prefetch_topology([mocked_networking["route_table"]], mocked_networking["public_subnet"])
+        mock_validate.assert_called_once_with(candidates)
+    assert app.validate_nat_gateway_candidates(candidates) == ["nat-0deleted"]
+
+    # Failover tries a standby known to be unavailable last
+    monkeypatch.setenv("NAT_GATEWAY_CANDIDATES", json.dumps({
+        mocked_networking["public_subnet"]: ["nat-0deleted", mocked_networking["nat_gw"]],
+    }))
+    app.prefetch_topology([mocked_networking["route_table"]], mocked_networking["public_subnet"])
+    with mock.patch('app.replace_route', wraps=app.replace_route) as mock_replace_route:
+        targets = app.fail_over_to_nat_gateway([mocked_networking["route_table"]], mocked_networking["public_subnet"])
+    mock_replace_route.assert_called_once_with(mocked_networking["route_table"], mocked_networking["nat_gw"])
+    assert targets == {mocked_networking["route_table"]: mocked_networking["nat_gw"]}
+
+
+def test_shard_route_tables():
+    from app import shard_route_tables
+    route_tables = [f"rtb-{i}" for i in range(100)]
+
+    shards = shard_route_tables(route_tables, ["i-1", "i-2"])
+    assert 30 < list(shards.values()).count("i-1") < 70
+
+    # A new instance only takes route tables, it never shuffles the others
+    grown = shard_route_tables(route_tables, ["i-1", "i-2", "i-3"])
+    assert all(grown[rtb] in (shards[rtb], "i-3") for rtb in route_tables)
+    assert 15 < list(grown.values()).count("i-3") < 50
+
+
+@mock_aws
+def test_nat_instance_shards(monkeypatch, tmp_path):
+    import app
+    mocked_networking = setup_networking()
+    ec2_client = boto3.client("ec2")
+    setup_nat_asg(mocked_networking, size=2)
+    instance_ids = app.get_nat_instance_ids("alternat-asg")
+    assert len(instance_ids) == 2
+
+    route_tables = [mocked_networking["route_table"], mocked_networking["route_table_two"]]
+    for i in range(2, 8):
+        route_table = ec2_client.create_route_table(VpcId=mocked_networking["vpc"])["RouteTable"]["RouteTableId"]
+        ec2_client.create_route(
+            DestinationCidrBlock="0.0.0.0/0", NatGatewayId=mocked_networking["nat_gw"], RouteTableId=route_table
+        )
+        route_tables.append(route_table)
+    target = {
+        "route_table_ids": route_tables,
+        "public_subnet_id": mocked_networking["public_subnet"],
+        "nat_asg_name": "alternat-asg",
+    }
+    monkeypatch.setenv("SHARD_ROUTE_TABLES", "true")
+
+    # New instances only take route tables once they pass a health check
+    owners = app.shard_route_tables(route_tables, instance_ids)
+    before = app.get_default_route_targets(route_tables)
+    with mock.patch('app.run_nat_instance_diagnostics', return_value=False):
+        app.rebalance_nat_instance_shards(target)
+    assert app.get_default_route_targets(route_tables) == before
+
+    # Then every route table moves to its owner
+    with mock.patch('app.run_nat_instance_diagnostics', return_value=True) as mock_diagnostics:
+        app.rebalance_nat_instance_shards(target)
+        assert sorted(c.args[0] for c in mock_diagnostics.call_args_list) == sorted(instance_ids)
+    assert app.get_default_route_targets(route_tables) == owners
+
+    # The termination of one instance only fails over its own shard
+    terminating = instance_ids[0]
+    az = f"{os.environ['AWS_DEFAULT_REGION']}a".upper().replace("-", "_")
+    monkeypatch.setenv(az, ",".join(route_tables))
+    with open(os.path.join(os.path.dirname(__file__), "../sns-event.json"), "r") as file:
+        event = json.loads(file.read())
+    message = json.loads(event["Records"][0]["Sns"]["Message"])
+    message["AutoScalingGroupName"] = "alternat-asg"
+    message["EC2InstanceId"] = terminating
+    event["Records"][0]["Sns"]["Message"] = json.dumps(message)
+
+    with mock.patch('app.complete_asg_lifecycle_action'):
+        app.handler(event, {})
+    targets = app.get_default_route_targets(route_tables)
+    for rtb in route_tables:
+        expected = mocked_networking["nat_gw"] if owners[rtb] == terminating else owners[rtb]
+        assert targets[rtb] == expected
+
+    # Route tables a restore moved to the wrong instance go back to their owner,
+    # which has already passed its health check
+    app.replace_routes(route_tables, instance_ids[1])
+    with mock.patch('app.run_nat_instance_diagnostics') as mock_diagnostics:
+        app.rebalance_nat_instance_shards(target)
+        mock_diagnostics.assert_not_called()
+    targets = app.get_default_route_targets(route_tables)
+    assert {rtb: targets[rtb] for rtb in route_tables if owners[rtb] == terminating} == {
+        rtb: terminating for rtb in route_tables if owners[rtb] == terminating
+    }
+
+    # A saturated instance only shifts its own shard, which goes back to it
+    saturated = instance_ids[1]
+    metrics_file = tmp_path / "metrics.json"
+    monkeypatch.setenv("NAT_METRICS_FILE", str(metrics_file))
+    metrics_file.write_text(json.dumps({saturated: {"conntrack_allowance_exceeded": 101}, terminating: {}}))
+    app.check_saturation(target)
+    assert app.get_saturated_route_tables(route_tables) == [rtb for rtb in route_tables if owners[rtb] == saturated]
+
+    metrics_file.write_text(json.dumps({}))
+    monkeypatch.setenv("SATURATION_HOLDDOWN", "0")
+    app.check_saturation(target)
+    assert app.get_saturated_route_tables(route_tables) == []
+    assert app.get_default_route_targets(route_tables) == owners
+
+    # An alarm on the ASG only fails over the impaired instance's shard
+    assert app.get_impaired_instances(instance_ids) == []
+    alarm = {
+        "source": "aws.cloudwatch",
+        "detail-type": "CloudWatch Alarm State Change",
+        "detail": {
+            "state": {"value": "ALARM"},
+            "configuration": {"metrics": [{"metricStat": {"metric": {
+                "namespace": "AWS/EC2",
+                "name": "StatusCheckFailed",
+                "dimensions": {"AutoScalingGroupName": "alternat-asg"},
+            }}}]},
+        },
+    }
+    with mock.patch('app.get_impaired_instances', return_value=[saturated]):
+        app.handler(alarm, {})
+    targets = app.get_default_route_targets(route_tables)
+    for rtb in route_tables:
+        assert targets[rtb] == (mocked_networking["nat_gw"] if owners[rtb] == saturated else owners[rtb])
+
+    # Failed probes only fail over the shard of the instance on the tester's path
+    for instance_id in instance_ids:
+        app.replace_routes([rtb for rtb in route_tables if owners[rtb] == instance_id], instance_id)
+    tester_route_table = next(rtb for rtb in route_tables if owners[rtb] == terminating)
+    with mock.patch('app.get_tester_route_tables', return_value=[tester_route_table]):
+        with mock.patch('app.probe_urls', return_value=False):
+            assert app.check_connection(["https://www.example.com"], target=target) == False
+    targets = app.get_default_route_targets(route_tables)
+    for rtb in route_tables:
+        assert targets[rtb] == (mocked_networking["nat_gw"] if owners[rtb] == terminating else owners[rtb])
+
+
+@mock_aws
+def test_topology_cache(monkeypatch):
+    import app
+    from app import get_vpc_id, get_nat_gateway_candidates, invalidate_topology_cache
+    mocked_networking = setup_networking()
+
+    with mock.patch('app.describe_vpc_id', wraps=app.describe_vpc_id) as mock_describe_vpc_id:
+        with mock.patch('app.describe_nat_gateway_candidates', wraps=app.describe_nat_gateway_candidates) as mock_describe_nat_gateway_candidates:
+            for _ in range(2):
+                vpc_id = get_vpc_id(mocked_networking["route_table"])
+                assert vpc_id == mocked_networking["vpc"]
+                assert get_nat_gateway_candidates(vpc_id, mocked_networking["public_subnet"]) == [mocked_networking["nat_gw"]]
+            assert mock_describe_vpc_id.call_count == 1
+            assert mock_describe_nat_gateway_candidates.call_count == 1
+
+            invalidate_topology_cache()
+            get_vpc_id(mocked_networking["route_table"])
+            assert mock_describe_vpc_id.call_count == 2
+
+            # Expired entries are resolved again
+            monkeypatch.setenv("TOPOLOGY_CACHE_TTL", "0")
+            invalidate_topology_cache()
+            get_vpc_id(mocked_networking["route_table"])
+            get_vpc_id(mocked_networking["route_table"])
+            assert mock_describe_vpc_id.call_count == 4
+
+            # A VPC ID provided at deploy time skips the lookup entirely
+            monkeypatch.setenv("VPC_ID", "vpc-from-terraform")
+            assert get_vpc_id(mocked_networking["route_table"]) == "vpc-from-terraform"
+            assert mock_describe_vpc_id.call_count == 4
+
+            # Connectivity targets use their own VPC ID rather than the function wide one
+            assert get_vpc_id(mocked_networking["route_table"], {"vpc_id": "vpc-from-manifest"}) == "vpc-from-manifest"
+            assert get_vpc_id(mocked_networking["route_table"], {}) == mocked_networking["vpc"]
+
+
+@mock_aws
+def test_route_state(monkeypatch):
+    import app
+    mocked_networking = setup_networking()
+    route_tables = [mocked_networking["route_table"], mocked_networking["route_table_two"]]
+
+    # Without recorded state the route tables are described, and what is found is recorded
+    with mock.patch('app.inspect_routes', wraps=app.inspect_routes) as mock_describe:
+        assert not app.is_using_nat_gateway(route_tables)
+        assert not app.is_using_nat_gateway(route_tables)
+        mock_describe.assert_called_once_with(route_tables)
+
+    # Replacing routes records their target, so later checks skip the lookup
+    app.replace_routes(route_tables, mocked_networking["nat_gw"])
+    with mock.patch('app.inspect_routes', wraps=app.inspect_routes) as mock_describe:
+        assert app.is_using_nat_gateway(route_tables)
+        mock_describe.assert_not_called()
+
+        # Stale state is ignored
+        monkeypatch.setenv("ROUTE_STATE_MAX_AGE", "0")
+        assert app.is_using_nat_gateway(route_tables)
+        mock_describe.assert_called_once_with(route_tables)
+
+    # The NAT instance isn't restored within the hold-down after a failover
+    assert app.is_restore_held_down(route_tables)
+    monkeypatch.setenv("NAT_RESTORE_HOLDDOWN", "0")
+    assert not app.is_restore_held_down(route_tables)
+
+    # Errors from the store never fail a replacement
+    with mock.patch.object(app.memory_state_store, 'update', side_effect=RuntimeError("unavailable")):
+        app.replace_routes(route_tables, mocked_networking["nat_gw"])
+
+    # A replacement NAT instance takes its routes back without recording it, so
+    # failed probes describe the routes rather than trusting the state
+    monkeypatch.setenv("ROUTE_STATE_MAX_AGE", "300")
+    instance_id, target = setup_nat_instance(mocked_networking)
+    for rtb in route_tables:
+        boto3.client("ec2").replace_route(RouteTableId=rtb, DestinationCidrBlock="0.0.0.0/0", InstanceId=instance_id)
+    assert app.is_using_nat_gateway(route_tables)
+    with mock.patch('app.probe_urls', return_value=False), mock.patch('time.sleep'):
+        assert app.check_connection(["https://www.example.com"], target=target) == False
+    verify_nat_gateway_route(mocked_networking)
+
+
+@mock_aws
+def test_dynamodb_state_store(monkeypatch):
+    import app
+    boto3.client("dynamodb").create_table(
+        TableName="alternat-state",
+        KeySchema=[{"AttributeName": "RouteTableId", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "RouteTableId", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    monkeypatch.setenv("STATE_TABLE_NAME", "alternat-state")
+
+    store = app.get_state_store()
+    assert isinstance(store, app.DynamoDBStateStore)
+    assert store.get(["rtb-1"]) == {}
+
+    store.update({"rtb-1": {"target": "nat-1", "last_failover": 1}})
+    # Updates only set their own fields, without reading the rest first
+    with mock.patch.object(store, 'get') as mock_get:
+        store.update({"rtb-1": {"target": "i-1", "last_restore": 2}, "rtb-2": {"target": "i-1", "shard_instances": ["i-1"]}})
+        mock_get.assert_not_called()
+    assert store.get(["rtb-1", "rtb-2", "rtb-3"]) == {
+        "rtb-1": {"target": "i-1", "last_failover": 1, "last_restore": 2},
+        "rtb-2": {"target": "i-1", "shard_instances": ["i-1"]},
+    }
+
+
+@mock_aws
+def test_get_client():
+    from app import get_client, CLIENT_CONFIG_OPTIONS
+
+    ssm_client = get_client("ssm")
+    assert get_client("ssm") is ssm_client
+    assert get_client("autoscaling") is not ssm_client
+    assert ssm_client.meta.config.connect_timeout == CLIENT_CONFIG_OPTIONS["connect_timeout"]
+    assert ssm_client.meta.config.retries["mode"] == "standard"
+
+
+def test_import_time():
+    # Measured in a fresh interpreter, as a Lambda cold start would be
+    script = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "import app\n"
+        "seconds = time.perf_counter() - start\n"
+        "print(json.dumps({'seconds': seconds, 'modules': [m for m in ('boto3', 'ssl', 'urllib.request') if m in sys.modules]}))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=os.path.join(os.path.dirname(__file__), ".."),
+        capture_output=True, text=True, check=True,
+    )
+    measured = json.loads(result.stdout)
+    assert measured["modules"] == []
+    assert measured["seconds"] < IMPORT_TIME_BUDGET
+
+
+@mock_aws
+def test_phase_metrics(monkeypatch, capsys):
+    from app import fail_over_to_nat_gateway
+    mocked_networking = setup_networking()
+    route_tables = [mocked_networking["route_table"], mocked_networking["route_table_two"]]
+
+    # Metrics are off by default
+    fail_over_to_nat_gateway(route_tables, mocked_networking["public_subnet"])
+    assert capsys.readouterr().out == ""
+
+    monkeypatch.setenv("ENABLE_METRICS", "true")
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "alternat-autoscaling-hook")
+    fail_over_to_nat_gateway(route_tables, mocked_networking["public_subnet"])
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    phases = sorted(record["Phase"] for record in records)
+    assert phases == [
+        "route_replacement", "route_table_replacement", "route_table_replacement", "route_verification", "topology_lookup"
+    ]
+    for record in records:
+        metric_directive = record["_aws"]["CloudWatchMetrics"][0]
+        assert metric_directive["Namespace"] == "alterNAT"
+        assert metric_directive["Dimensions"] == [["FunctionName", "Phase"]]
+        assert metric_directive["Metrics"] == [{"Name": "PhaseDuration", "Unit": "Milliseconds"}]
+        assert record["FunctionName"] == "alternat-autoscaling-hook"
+        assert record["PhaseDuration"] >= 0
+        assert record["Succeeded"] == True
+    assert sorted(r["RouteTableId"] for r in records if r["Phase"] == "route_table_replacement") == sorted(route_tables)
+
+
+def test_put_metric_from_threads(monkeypatch, capsys):
+    from app import put_metric
+    monkeypatch.setenv("ENABLE_METRICS", "true")
+
+    # Records written concurrently stay on lines of their own
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        for i in range(1000):
+            executor.submit(put_metric, "ProbeFailure", i, "Count", phase="detection")
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert sorted(record["ProbeFailure"] for record in records) == list(range(1000))
+
+
 @mock_aws
 def get_role():
     iam = boto3.client("iam")
@@ -205,9 +855,8 @@ def _process_lambda(func_str):
 
 
 @mock_aws
-@mock.patch('time.sleep')
 @mock.patch('urllib.request.urlopen')
-def test_connectivity_test_handler(mock_urlopen, mock_sleep, monkeypatch):
+def test_connectivity_test_handler(mock_urlopen, fake_sleep, monkeypatch):
     from app import connectivity_test_handler
     mocked_networking = setup_networking()
 
@@ -236,6 +885,301 @@ def test_connectivity_test_handler(mock_urlopen, mock_sleep, monkeypatch):
     verify_nat_gateway_route(mocked_networking)
 
 
+@mock_aws
+def test_connectivity_test_manifest(fake_sleep, monkeypatch):
+    import app
+    from app import connectivity_test_handler, MissingAZSubnetError, MissingCheckUrlsError, UnprobeableTargetError
+    mocked_networking = setup_networking()
+
+    script_dir = os.path.dirname(__file__)
+    with open(os.path.join(script_dir, "../cloudwatch-event.json"), "r") as file:
+        cloudwatch_event = file.read()
+
+    monkeypatch.setenv("ENABLE_NAT_RESTORE", "false")
+    monkeypatch.setenv("TESTER_SUBNET_IDS", mocked_networking["private_subnet"])
+    monkeypatch.setenv("CONNECTIVITY_TEST_MANIFEST", json.dumps([
+        {
+            "name": "healthy",
+            "route_table_ids": [mocked_networking["route_table"]],
+            "public_subnet_id": mocked_networking["public_subnet"],
+            "check_urls": ["https://healthy.example.com"],
+        },
+        {
+            "name": "broken",
+            "route_table_ids": [mocked_networking["route_table_two"]],
+            "public_subnet_id": mocked_networking["public_subnet"],
+            "check_urls": ["https://broken.example.com"],
+        },
+    ]))
+
+    def fake_urlopen(req, timeout):
+        if req.full_url == "https://broken.example.com":
+            raise socket.timeout()
+        return mock.Mock()
+
+    with mock.patch('urllib.request.urlopen', side_effect=fake_urlopen):
+        with mock.patch('app.replace_route', wraps=app.replace_route) as mock_replace_route:
+            connectivity_test_handler(event=json.loads(cloudwatch_event), context=None)
+
+    # Only the affected target fails over, and the healthy one keeps being checked
+    mock_replace_route.assert_called_once_with(mocked_networking["route_table_two"], mocked_networking["nat_gw"])
+    assert fake_sleep.call_count == 12
+
+    monkeypatch.setenv("CONNECTIVITY_TEST_MANIFEST", json.dumps([{"route_table_ids": ["rtb-12345"]}]))
+    with pytest.raises(MissingAZSubnetError):
+        connectivity_test_handler(event=json.loads(cloudwatch_event), context=None)
+
+    monkeypatch.setenv("CONNECTIVITY_TEST_MANIFEST", json.dumps([
+        {"route_table_ids": ["rtb-12345"], "public_subnet_id": "subnet-12345", "check_urls": []}
+    ]))
+    with pytest.raises(MissingCheckUrlsError):
+        connectivity_test_handler(event=json.loads(cloudwatch_event), context=None)
+
+    # Every target must share the NAT path of the tester's own subnets
+    targets = [
+        {"route_table_ids": [mocked_networking["route_table"]], "public_subnet_id": mocked_networking["public_subnet"]},
+        {"route_table_ids": [mocked_networking["route_table_two"]], "public_subnet_id": mocked_networking["public_subnet"]},
+    ]
+    monkeypatch.setenv("CONNECTIVITY_TEST_MANIFEST", json.dumps(targets))
+    assert app.get_connectivity_targets() == targets
+
+    targets[1]["public_subnet_id"] = "subnet-in-another-az"
+    monkeypatch.setenv("CONNECTIVITY_TEST_MANIFEST", json.dumps(targets))
+    with pytest.raises(UnprobeableTargetError):
+        connectivity_test_handler(event=json.loads(cloudwatch_event), context=None)
+
+    # Without the tester's subnets that can't be checked, so only a single target is accepted
+    monkeypatch.delenv("TESTER_SUBNET_IDS")
+    with pytest.raises(UnprobeableTargetError):
+        app.get_connectivity_targets()
+    monkeypatch.setenv("CONNECTIVITY_TEST_MANIFEST", json.dumps(targets[:1]))
+    assert app.get_connectivity_targets() == targets[:1]
+
+
+@mock_aws
+@mock.patch('time.sleep')
+def test_connectivity_failure_threshold(mock_sleep, monkeypatch):
+    import app
+    from app import check_connection, FailureWindow
+    mocked_networking = setup_networking()
+
+    monkeypatch.setenv("ROUTE_TABLE_IDS_CSV", ",".join([mocked_networking["route_table"], mocked_networking["route_table_two"]]))
+    monkeypatch.setenv("PUBLIC_SUBNET_ID", mocked_networking["public_subnet"])
+    monkeypatch.setenv("ENABLE_NAT_RESTORE", "false")
+
+    failure_window = FailureWindow(threshold=3, window=10)
+    with mock.patch('app.probe_urls', side_effect=[False, False, True, False, False, False]):
+        with mock.patch('app.replace_route', wraps=app.replace_route) as mock_replace_route:
+            # Two failures followed by a success resets the count
+            for _ in range(3):
+                assert check_connection(["https://www.example.com"], failure_window) == True
+            assert check_connection(["https://www.example.com"], failure_window) == True
+            assert check_connection(["https://www.example.com"], failure_window) == True
+            mock_replace_route.assert_not_called()
+
+            # The third consecutive failure trips the window
+            assert check_connection(["https://www.example.com"], failure_window) == False
+            assert mock_replace_route.call_count == 2
+
+
+def test_connectivity_test_period(fake_sleep):
+    import app
+    target = {"route_table_ids": ["rtb-12345"], "public_subnet_id": "subnet-12345"}
+
+    # Time spent probing counts towards the minute, not just the sleeps
+    def slow_probe(check_urls):
+        time.sleep(10)
+        return True
+
+    with mock.patch('app.probe_connectivity', side_effect=slow_probe) as mock_probe:
+        with mock.patch('app.prefetch_topology'):
+            app.run_connectivity_checks([target], ["https://www.example.com"], 5)
+    assert mock_probe.call_count == 4
+
+
+def test_adaptive_check_interval(fake_sleep, monkeypatch, capsys):
+    import app
+    target = {"route_table_ids": ["rtb-12345"], "public_subnet_id": "subnet-12345"}
+    monkeypatch.setenv("ENABLE_ADAPTIVE_CHECK_INTERVAL", "true")
+    monkeypatch.setenv("CONNECTIVITY_CHECK_HEALTHY_STREAK", "3")
+    monkeypatch.setenv("ENABLE_METRICS", "true")
+    monkeypatch.setenv("CONNECTIVITY_FAILURE_THRESHOLD", "3")
+
+    # Backs off after a healthy streak and tightens on the first failed probe
+    results = iter([True] * 4 + [False] + [True] * 20)
+    with mock.patch('app.probe_connectivity', side_effect=lambda check_urls: next(results)):
+        with mock.patch('app.prefetch_topology'):
+            app.run_connectivity_checks([target], ["https://www.example.com"], 5)
+    delays = [c.args[0] for c in fake_sleep.call_args_list]
+    assert delays == [5, 5, 20, 20, 5]
+    assert '"ConnectivityCheckInterval": 20.0' in capsys.readouterr().out
+
+    # At the slow interval the run ends once the next check would be after the next invocation starts
+    fake_sleep.reset_mock()
+    with mock.patch('app.probe_connectivity', return_value=True) as mock_probe:
+        app.run_connectivity_checks([target], ["https://www.example.com"], 5)
+        assert mock_probe.call_count == 4
+    delays = [c.args[0] for c in fake_sleep.call_args_list]
+    assert delays == [5, 20, 20]
+    assert sum(delays) < 60
+
+    # The time spent checking brings the early end forward
+    fake_sleep.reset_mock()
+    app.check_scheduler.healthy_streak = 0
+    monkeypatch.setenv("CONNECTIVITY_CHECK_SLOW_PROBE", "5")
+
+    def slow_probe(check_urls):
+        time.sleep(4)
+        return True
+
+    with mock.patch('app.probe_connectivity', side_effect=slow_probe) as mock_probe:
+        app.run_connectivity_checks([target], ["https://www.example.com"], 5)
+        assert mock_probe.call_count == 4
+    assert [c.args[0] for c in fake_sleep.call_args_list if c.args[0] != 4] == [5, 5, 20]
+
+    # A slow probe also keeps the interval fast
+    fake_sleep.reset_mock()
+    monkeypatch.setenv("CONNECTIVITY_CHECK_SLOW_PROBE", "0")
+    with mock.patch('app.probe_connectivity', return_value=True):
+        app.run_connectivity_checks([target], ["https://www.example.com"], 5)
+    assert {c.args[0] for c in fake_sleep.call_args_list} == {5}
+
+
+@mock_aws
+def test_timed_check_connection_times_probes_only(monkeypatch):
+    import app
+    mocked_networking = setup_networking()
+    instance_id, target = setup_nat_instance(mocked_networking)
+    monkeypatch.setenv("ENABLE_NAT_RESTORE", "true")
+    described = []
+
+    def slow_describe(**kwargs):
+        described.append(kwargs)
+        time.sleep(0.5)
+
+    # A slow describe_route_tables doesn't make a fast probe slow
+    app.get_client("ec2").meta.events.register("before-call.ec2.DescribeRouteTables", slow_describe)
+    with mock.patch('app.probe_connectivity', return_value=True):
+        connected, duration = app.timed_check_connection(["https://www.example.com"], None, target)
+    assert connected
+    assert described
+    assert duration < 0.5
+
+
+def test_connectivity_monitor(monkeypatch):
+    import asyncio
+    import app
+    target = {"name": "az-a", "route_table_ids": ["rtb-12345"], "public_subnet_id": "subnet-12345"}
+    monkeypatch.setenv("MONITOR_HEALTH_PORT", "0")
+
+    async def get_health(monitor):
+        port = monitor.server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        return response
+
+    async def scenario(monitor, check_connection):
+        task = asyncio.create_task(monitor.run(0.01))
+        while check_connection.call_count < 3:
+            await asyncio.sleep(0.01)
+        response = await get_health(monitor)
+        monitor.stop()
+        await asyncio.wait_for(task, 5)
+        return response
+
+    # A target that fails over keeps being checked, and the monitor reports
+    # healthy once every target has completed a check
+    with mock.patch('app.prefetch_topology'), mock.patch('app.run_route_table_maintenance'):
+        with mock.patch('app.check_connection', side_effect=[False] + [True] * 100) as mock_check_connection:
+            monitor = app.ConnectivityMonitor([target], ["https://www.example.com"])
+            response = asyncio.run(scenario(monitor, mock_check_connection))
+    assert response.startswith(b"HTTP/1.1 200 OK")
+    assert json.loads(response.split(b"\r\n\r\n")[1])["healthy"] == True
+
+    # Checks that raise don't count as completed, and stop the monitor being healthy
+    with mock.patch('app.prefetch_topology'), mock.patch('app.run_route_table_maintenance'):
+        with mock.patch('app.check_connection', side_effect=app.RouteReplacementError("failed")) as mock_check_connection:
+            monitor = app.ConnectivityMonitor([target], ["https://www.example.com"])
+            response = asyncio.run(scenario(monitor, mock_check_connection))
+    assert response.startswith(b"HTTP/1.1 503")
+    assert json.loads(response.split(b"\r\n\r\n")[1])["last_checked_seconds_ago"] == {"az-a": None}
+
+    # Every target gets its own worker, so slow checks don't queue behind each other
+    targets = [dict(target, name=f"az-{i}") for i in range(8)]
+    started = threading.Barrier(len(targets), timeout=5)
+
+    def slow_check_connection(check_urls, failure_window, target, timings=None):
+        started.wait()
+        return True
+
+    async def check_all_targets(monitor):
+        task = asyncio.create_task(monitor.run(0.01))
+        while len(monitor.last_checked) < len(targets):
+            await asyncio.sleep(0.01)
+        monitor.stop()
+        await asyncio.wait_for(task, 10)
+
+    with mock.patch('app.prefetch_topology'), mock.patch('app.run_route_table_maintenance'):
+        with mock.patch('app.check_connection', side_effect=slow_check_connection):
+            monitor = app.ConnectivityMonitor(targets, ["https://www.example.com"])
+            asyncio.run(check_all_targets(monitor))
+
+    # Probes that keep failing fail over once, not on every check after the window trips
+    monkeypatch.setenv("CONNECTIVITY_FAILURE_THRESHOLD", "3")
+
+    async def keep_failing(monitor, probe):
+        task = asyncio.create_task(monitor.run(0.01))
+        while probe.call_count < 20:
+            await asyncio.sleep(0.01)
+        monitor.stop()
+        await asyncio.wait_for(task, 5)
+
+    with mock.patch('app.prefetch_topology'), mock.patch('app.run_route_table_maintenance'):
+        with mock.patch('app.probe_connectivity', return_value=False) as mock_probe, \
+                mock.patch('app.fail_over_to_nat_gateway') as mock_fail_over, \
+                mock.patch('app.inspect_routes', side_effect=lambda route_tables: {
+                    rtb: {"target_type": "nat_gateway" if mock_fail_over.called else "instance", "state": "active"}
+                    for rtb in route_tables
+                }):
+            monitor = app.ConnectivityMonitor([target], ["https://www.example.com"])
+            asyncio.run(keep_failing(monitor, mock_probe))
+    mock_fail_over.assert_called_once_with(["rtb-12345"], "subnet-12345", target)
+
+    # A failover waits for a rebalance of the same target to finish, rather
+    # than landing between its reads and its moves
+    monkeypatch.setenv("ENABLE_LOAD_SHARING", "true")
+    monkeypatch.setenv("MONITOR_MAINTENANCE_INTERVAL", "0.01")
+    events = []
+
+    def slow_rebalance(target):
+        events.append("rebalance")
+        time.sleep(0.1)
+        events.append("rebalanced")
+
+    def fail_over(check_urls, failure_window, target, timings=None):
+        events.append("failover")
+        return False
+
+    async def rebalance_twice(monitor, rebalance):
+        task = asyncio.create_task(monitor.run(0.01))
+        while rebalance.call_count < 2:
+            await asyncio.sleep(0.01)
+        monitor.stop()
+        await asyncio.wait_for(task, 5)
+
+    with mock.patch('app.prefetch_topology'), \
+            mock.patch('app.rebalance_route_tables', side_effect=slow_rebalance) as mock_rebalance, \
+            mock.patch('app.check_connection', side_effect=fail_over):
+        monitor = app.ConnectivityMonitor([target], ["https://www.example.com"])
+        asyncio.run(rebalance_twice(monitor, mock_rebalance))
+    assert events.count("failover") > 1
+    for i, event in enumerate(events):
+        if event == "rebalance":
+            assert events[i + 1] == "rebalanced"
+
+
 def test_disable_ipv6():
     with mock.patch('socket.getaddrinfo') as mock_getaddrinfo:
         from app import disable_ipv6
@@ -247,6 +1191,124 @@ def test_disable_ipv6():
         assert call_args[2] == socket.AF_INET, "Did not find AF_INET family in args to getaddrinfo"
 
 
+def test_probe_urls():
+    from app import probe_urls, MissingCheckUrlsError
+
+    slow_url_released = threading.Event()
+
+    def fake_urlopen(req, timeout):
+        if req.full_url == "https://slow.example.com":
+            # Simulates a hung endpoint; the fast success must not wait on it
+            slow_url_released.wait(timeout=5)
+            raise socket.timeout()
+        if req.full_url == "https://down.example.com":
+            raise urllib.error.URLError("connection refused")
+        if req.full_url == "https://reset.example.com":
+            raise ConnectionResetError("connection reset by peer")
+        if req.full_url == "https://late.example.com":
+            time.sleep(0.2)
+        return mock.Mock()
+
+    with mock.patch('urllib.request.urlopen', side_effect=fake_urlopen):
+        start = time.monotonic()
+        assert probe_urls(["https://slow.example.com", "https://www.example.com"]) == True
+        assert time.monotonic() - start < 1, "probe_urls waited on the slow URL"
+        slow_url_released.set()
+
+        assert probe_urls(["https://down.example.com", "https://down.example.com"]) == False
+
+        # An unwrapped error only fails its own URL
+        assert probe_urls(["https://reset.example.com", "https://late.example.com"]) == True
+        assert probe_urls(["https://reset.example.com", "https://down.example.com"]) == False
+
+    with pytest.raises(MissingCheckUrlsError):
+        probe_urls([])
+
+
+def test_probe_socket():
+    from app import probe_urls
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    port = server.getsockname()[1]
+    try:
+        assert probe_urls([f"http://127.0.0.1:{port}"], probe_type="tcp", timeout=1) == True
+    finally:
+        server.close()
+
+    # Nothing is listening on the port once the server is closed
+    assert probe_urls([f"http://127.0.0.1:{port}"], probe_type="tcp", timeout=1) == False
+
+
+def test_probe_session(monkeypatch, capsys):
+    import http.server
+    import app
+
+    connections = []
+    hosts = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            connections.append(self.client_address)
+            super().setup()
+
+        def do_HEAD(self):
+            hosts.append(self.headers["Host"])
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    monkeypatch.setenv("ENABLE_METRICS", "true")
+    try:
+        # The first probe connects, later ones reuse the connection
+        for _ in range(3):
+            assert app.probe_urls([url], probe_type="session", timeout=1) == True
+        assert len(connections) == 1
+        metrics = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        names = [
+            name for m in metrics for name in ("ProbeDnsDuration", "ProbeConnectDuration", "ProbeFirstByteDuration") if name in m
+        ]
+        assert names.count("ProbeDnsDuration") == 1
+        assert names.count("ProbeConnectDuration") == 1
+        assert names.count("ProbeFirstByteDuration") == 3
+
+        # The Host header only names the port when it isn't the scheme's default
+        assert hosts[0] == f"127.0.0.1:{server.server_address[1]}"
+        assert app.ProbeSession("https://www.example.com/").host_header == "www.example.com"
+        assert app.ProbeSession("http://www.example.com:8080/").host_header == "www.example.com:8080"
+
+        # A connection the server dropped is replaced transparently
+        app.probe_sessions[url][0].connection.sock.close()
+        assert app.probe_urls([url], probe_type="session", timeout=1) == True
+        assert len(connections) == 2
+
+        app.close_probe_sessions()
+        assert app.probe_sessions == {}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # Failures report the stage that failed
+    capsys.readouterr()
+    assert app.probe_urls([url], probe_type="session", timeout=1) == False
+    failure = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert failure["ProbeFailure"] == 1 and failure["Stage"] == "connect"
+
+    # As do failed lookups
+    with mock.patch('socket.getaddrinfo', side_effect=socket.gaierror("Name or service not known")):
+        assert app.probe_urls([url], probe_type="session", timeout=1) == False
+    failure = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert failure["Stage"] == "dns"
+
+
 @mock_aws
 def test_is_source_dest_check_enabled():
     mocked_networking = setup_networking()
@@ -281,7 +1343,7 @@ def test_is_source_dest_check_enabled():
 
 
 @mock_aws
-def test_are_any_routes_pointing_to_nat_gateway():
+def test_is_using_nat_gateway():
     mocked_networking = setup_networking()
     ec2_client = boto3.client("ec2")
 
@@ -299,14 +1361,33 @@ def test_are_any_routes_pointing_to_nat_gateway():
             NatGatewayId=mocked_networking["nat_gw"]
         )
 
-    from app import are_any_routes_pointing_to_nat_gateway
+    from app import inspect_routes, is_using_nat_gateway
 
     # Now our setup has routes with NAT gateway, should return True
     route_tables = [mocked_networking["route_table"], mocked_networking["route_table_two"]]
-    assert are_any_routes_pointing_to_nat_gateway(route_tables) == True
+    assert is_using_nat_gateway(route_tables) == True
+    assert {route["target_type"] for route in inspect_routes(route_tables).values()} == {"nat_gateway"}
 
     # Test with invalid route table
-    assert are_any_routes_pointing_to_nat_gateway(["rtb-invalid"]) == False
+    assert is_using_nat_gateway(["rtb-invalid"]) == False
+    assert inspect_routes(["rtb-invalid"]) == {}
+
+
+def test_nat_health_check_script(monkeypatch, tmp_path):
+    from app import nat_health_check_script, parse_nat_health
+
+    # A curl that takes a second and answers with the last digit of the URL
+    curl = tmp_path / "curl"
+    curl.write_text('#!/bin/bash\nsleep 1\nurl="${@: -1}"\nprintf "20${url: -1}"\n')
+    curl.chmod(0o755)
+    script = tmp_path / "health.sh"
+    script.write_text("\n".join(nat_health_check_script([f"https://example.com/{i}" for i in range(4)])))
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+
+    start = time.monotonic()
+    output = subprocess.run(["bash", str(script)], capture_output=True, text=True, check=True).stdout
+    assert time.monotonic() - start < 3, "the URLs were not fetched in parallel"
+    assert parse_nat_health(output)["http_codes"] == ["200", "201", "202", "203"]
 
 
 @mock_aws
@@ -314,22 +1395,30 @@ def test_are_any_routes_pointing_to_nat_gateway():
 def test_run_nat_instance_diagnostics(mock_sleep):
     from app import run_nat_instance_diagnostics
 
-    # Common text fragments for building diagnostic outputs
-    nft_table_start = "nft_nat_table=table ip nat {\nchain postrouting {\ntype nat hook postrouting priority 100; policy accept;"
-    masquerade_rule = "\nip saddr 10.0.0.0/8 oifname \"eth0\" counter packets 0 bytes 0 masquerade"
-    nft_table_end = "\n}\n}\n"
+    check_urls = ["https://www.example.com", "https://www.google.com"]
 
-    # Build diagnostic outputs
-    good_nft_output = nft_table_start + masquerade_rule + nft_table_end
-    missing_masquerade_output = nft_table_start + nft_table_end
+    def health_output(http_codes=("200", "200"), ip_forward=1, nft_masquerade=True):
+        return json.dumps({
+            "http_codes": list(http_codes),
+            "ip_forward": ip_forward,
+            "nft_masquerade": nft_masquerade,
+            "conntrack_count": 42,
+            "conntrack_max": 262144,
+        }) + "\n"
 
-    # Test scenarios: (description, ssm_output, source_dest_check, expected_result)
+    # Test scenarios: (description, ssm_status, ssm_output, source_dest_check, expected_result)
     test_cases = [
-        ("successful diagnostics", f"ip_forward=1\n{good_nft_output}", False, True),
-        ("ip_forward=0 failure", f"ip_forward=0\n{good_nft_output}", False, False),
-        ("missing masquerade rule failure", f"ip_forward=1\n{missing_masquerade_output}", False, False),
-        ("source/dest check enabled failure", f"ip_forward=1\n{good_nft_output}", True, False),
-        ("error in source/dest check", f"ip_forward=1\n{good_nft_output}", None, False),
+        ("successful diagnostics", "Success", health_output(), False, True),
+        ("client error responses are reachable", "Success", health_output(http_codes=("404", "200")), False, True),
+        ("server error response", "Success", health_output(http_codes=("200", "503")), False, False),
+        ("no response at all", "Success", health_output(http_codes=("000", "200")), False, False),
+        ("curl did not run", "Success", health_output(http_codes=("", "200")), False, False),
+        ("ip_forward=0 failure", "Success", health_output(ip_forward=0), False, False),
+        ("missing masquerade rule failure", "Success", health_output(nft_masquerade=False), False, False),
+        ("source/dest check enabled failure", "Success", health_output(), True, False),
+        ("error in source/dest check", "Success", health_output(), None, False),
+        ("failed command", "Failed", health_output(), False, False),
+        ("unparseable output", "Success", "curl: command not found\n", False, False),
     ]
 
     with mock.patch('boto3.client') as mock_boto_client:
@@ -337,94 +1426,94 @@ def test_run_nat_instance_diagnostics(mock_sleep):
         mock_boto_client.return_value = mock_ssm
         mock_ssm.send_command.return_value = {'Command': {'CommandId': 'test-command-id'}}
 
-        for description, ssm_output, source_dest_check, expected_result in test_cases:
+        for description, ssm_status, ssm_output, source_dest_check, expected_result in test_cases:
             mock_ssm.get_command_invocation.return_value = {
-                'Status': 'Success',
+                'Status': ssm_status,
                 'StandardOutputContent': ssm_output,
                 'StandardErrorContent': ''
             }
 
-            with mock.patch('app.is_source_dest_check_enabled', return_value=source_dest_check):
-                result = run_nat_instance_diagnostics('i-12345678')
+            with mock.patch('app.is_source_dest_check_enabled', return_value=source_dest_check) as mock_source_dest:
+                result = run_nat_instance_diagnostics('i-12345678', check_urls)
                 assert result == expected_result, f"Failed test case: {description}"
+                assert mock_source_dest.call_count <= 1, f"Source/dest check queried more than once: {description}"
+
+        # A single SSM command covers connectivity and configuration
+        commands = mock_ssm.send_command.call_args.kwargs["Parameters"]["commands"]
+        assert any("https://www.google.com" in command for command in commands)
+        assert any("ip_forward" in command for command in commands)
 
         # Test SSM command failure separately
         mock_ssm.send_command.side_effect = botocore.exceptions.ClientError(
             {'Error': {'Code': 'InvalidInstanceId', 'Message': 'Test error'}},
             'SendCommand'
         )
-        result = run_nat_instance_diagnostics('i-12345678')
+        result = run_nat_instance_diagnostics('i-12345678', check_urls)
         assert result == False
 
 
-@mock_aws
 @mock.patch('time.sleep')
-def test_attempt_nat_instance_restore(mock_sleep, monkeypatch):
-    from app import attempt_nat_instance_restore
+def test_wait_for_ssm_command(mock_sleep):
+    from app import wait_for_ssm_command, SSMCommandTimeoutError
 
-    # Need to mock boto3.client to avoid calling AWS API
-    with mock.patch('boto3.client') as mock_boto_client:
-        # Mock AWS clients
-        mock_ssm = mock.MagicMock()
-        mock_ec2 = mock.MagicMock()
+    not_yet_visible = botocore.exceptions.ClientError(
+        {'Error': {'Code': 'InvocationDoesNotExist', 'Message': 'Test error'}},
+        'GetCommandInvocation'
+    )
+
+    with mock.patch('app.get_client') as mock_get_client:
+        mock_ssm = mock_get_client.return_value
+
+        # Tolerates the invocation not existing yet and keeps polling while it runs
+        mock_ssm.get_command_invocation.side_effect = [
+            not_yet_visible,
+            {'Status': 'InProgress'},
+            {'Status': 'Success', 'StandardOutputContent': '200'},
+        ]
+        invocation = wait_for_ssm_command('test-command-id', 'i-12345678')
+        assert invocation['Status'] == 'Success'
+        delays = [c.args[0] for c in mock_sleep.call_args_list]
+        assert delays == [0.25, 0.5, 1]
+
+        # Gives up once the deadline passes
+        mock_ssm.get_command_invocation.side_effect = None
+        mock_ssm.get_command_invocation.return_value = {'Status': 'InProgress'}
+        with pytest.raises(SSMCommandTimeoutError):
+            wait_for_ssm_command('test-command-id', 'i-12345678', timeout=0)
+
+        # Other errors are raised immediately
+        mock_ssm.get_command_invocation.side_effect = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'InvalidCommandId', 'Message': 'Test error'}},
+            'GetCommandInvocation'
+        )
+        with pytest.raises(botocore.exceptions.ClientError):
+            wait_for_ssm_command('test-command-id', 'i-12345678')
 
-        def get_boto_client(service):
-            if service == 'ssm':
-                return mock_ssm
-            elif service == 'ec2':
-                return mock_ec2
-            return mock.MagicMock()
 
-        mock_boto_client.side_effect = get_boto_client
+@mock_aws
+@mock.patch('time.sleep')
+def test_attempt_nat_instance_restore(mock_sleep, monkeypatch):
+    from app import attempt_nat_instance_restore
 
     # Setup environment
     route_tables = ['rtb-12345', 'rtb-67890']
     monkeypatch.setenv("ROUTE_TABLE_IDS_CSV", ",".join(route_tables))
     monkeypatch.setenv("NAT_ASG_NAME", "test-nat-asg")
 
-    # Mock successful test and diagnostic
     with mock.patch('app.get_current_nat_instance_id', return_value='i-test123'):
-        with mock.patch('app.run_nat_instance_diagnostics', return_value=True):
-            # Mock successful connectivity test
-            mock_ssm.send_command.return_value = {
-                'Command': {'CommandId': 'test-command-id'}
-            }
-            mock_ssm.get_command_invocation.return_value = {
-                'Status': 'Success',
-                'StandardOutputContent': '200\n200',
-                'StandardErrorContent': ''
-            }
-
-            # Mock replace_route
-            with mock.patch('app.replace_route') as mock_replace_route:
-                # Test successful restore
+        # Test successful restore
+        with mock.patch('app.run_nat_instance_diagnostics', return_value=True) as mock_diagnostics:
+            with mock.patch('app.replace_route') as mock_replace_route, mock.patch('app.verify_routes', return_value={}):
                 attempt_nat_instance_restore()
 
+                mock_diagnostics.assert_called_once()
                 # Verify replace_route called for both route tables
                 assert mock_replace_route.call_count == 2
                 mock_replace_route.assert_any_call(route_tables[0], 'i-test123')
                 mock_replace_route.assert_any_call(route_tables[1], 'i-test123')
 
-    # Test when NAT instance has no internet
-    with mock.patch('app.get_current_nat_instance_id', return_value='i-test123'):
-        mock_ssm.get_command_invocation.return_value = {
-            'Status': 'Success',
-            'StandardOutputContent': '404\n500',
-            'StandardErrorContent': ''
-        }
-        with mock.patch('app.replace_route') as mock_replace_route:
-            attempt_nat_instance_restore()
-            # Should not call replace_route
-            assert mock_replace_route.call_count == 0
-
-    # Test when diagnostics fail
-    with mock.patch('app.get_current_nat_instance_id', return_value='i-test123'):
+        # Test when the health check fails
         with mock.patch('app.run_nat_instance_diagnostics', return_value=False):
-            mock_ssm.get_command_invocation.return_value = {
-                'Status': 'Success',
-                'StandardOutputContent': '200\n200',
-                'StandardErrorContent': ''
-            }
             with mock.patch('app.replace_route') as mock_replace_route:
                 attempt_nat_instance_restore()
                 # Should not call replace_route
@@ -433,7 +1522,70 @@ def test_attempt_nat_instance_restore(mock_sleep, monkeypatch):
 
 @mock_aws
 @mock.patch('time.sleep')
-def test_nat_restore_option(mock_sleep, monkeypatch):
+def test_nat_restore_policy(mock_sleep, monkeypatch):
+    import app
+    mocked_networking = setup_networking()
+    ec2_client = boto3.client("ec2")
+    instance_id, target = setup_nat_instance(mocked_networking)
+    route_tables = target["route_table_ids"]
+    monkeypatch.setenv("ROUTE_TABLE_IDS_CSV", ",".join(route_tables))
+    monkeypatch.setenv("NAT_RESTORE_HEALTHY_CHECKS", "3")
+
+    def routes_to_instance():
+        response = ec2_client.describe_route_tables(RouteTableIds=route_tables)
+        return {
+            rtb["RouteTableId"]: any(route.get("InstanceId") == instance_id for route in rtb["Routes"])
+            for rtb in response["RouteTables"]
+        }
+
+    app.replace_routes(route_tables, mocked_networking["nat_gw"])
+    with mock.patch('app.get_current_nat_instance_id', return_value=instance_id):
+        # Routes are only restored after 3 consecutive healthy checks
+        with mock.patch('app.run_nat_instance_diagnostics', side_effect=[True, True, False, True, True, True]):
+            for _ in range(5):
+                app.attempt_nat_instance_restore()
+            assert not any(routes_to_instance().values())
+            app.attempt_nat_instance_restore()
+            assert all(routes_to_instance().values())
+
+        # Failing over soon after a restore doubles the hold-down
+        app.replace_routes(route_tables, mocked_networking["nat_gw"])
+        state = app.load_route_states(route_tables)[route_tables[0]]
+        assert state["restore_failures"] == 1
+        assert app.get_restore_holddown(state["restore_failures"]) == 600
+        assert app.is_restore_held_down(route_tables)
+
+        # A canary off the tester's path is refused, since probes wouldn't go through it
+        monkeypatch.setenv("NAT_RESTORE_HEALTHY_CHECKS", "1")
+        monkeypatch.setenv("NAT_RESTORE_CANARY", "true")
+        monkeypatch.setenv("TESTER_SUBNET_IDS", mocked_networking["private_subnet"])
+        monkeypatch.setenv("NAT_RESTORE_CANARY_ROUTE_TABLE_ID", route_tables[1])
+        with mock.patch('app.run_nat_instance_diagnostics', return_value=True):
+            with mock.patch('app.probe_urls') as mock_probe:
+                app.attempt_nat_instance_restore()
+                mock_probe.assert_not_called()
+        assert not any(routes_to_instance().values())
+
+        # In canary mode the tester's route table is rolled back if probes through it fail
+        monkeypatch.delenv("NAT_RESTORE_CANARY_ROUTE_TABLE_ID")
+        with mock.patch('app.run_nat_instance_diagnostics', return_value=True):
+            with mock.patch('app.probe_urls', return_value=False) as mock_probe:
+                app.attempt_nat_instance_restore(check_urls=["https://canary.example.com"])
+                mock_probe.assert_called_once_with(["https://canary.example.com"], "http", app.REQUEST_TIMEOUT)
+        assert not any(routes_to_instance().values())
+        assert app.load_route_states(route_tables)[route_tables[0]]["restore_failures"] == 2
+
+        # And the rest follow a canary that passes
+        with mock.patch('app.run_nat_instance_diagnostics', return_value=True):
+            with mock.patch('app.probe_urls', return_value=True):
+                with mock.patch('app.replace_route', wraps=app.replace_route) as mock_replace_route:
+                    app.attempt_nat_instance_restore()
+                    assert [c.args[0] for c in mock_replace_route.call_args_list] == route_tables
+        assert all(routes_to_instance().values())
+
+
+@mock_aws
+def test_nat_restore_option(fake_sleep, monkeypatch):
     from app import connectivity_test_handler
     mocked_networking = setup_networking()
 
@@ -468,8 +1620,293 @@ def test_nat_restore_option(mock_sleep, monkeypatch):
         monkeypatch.setenv("ENABLE_NAT_RESTORE", "true")
 
         # Mock that we're using NAT Gateway
-        with mock.patch('app.are_any_routes_pointing_to_nat_gateway', return_value=True):
+        with mock.patch('app.is_using_nat_gateway', return_value=True):
             # Mock the attempt_nat_instance_restore function
             with mock.patch('app.attempt_nat_instance_restore') as mock_restore:
                 connectivity_test_handler(event=json.loads(cloudwatch_event), context=Context())
                 mock_restore.assert_called_once()  # Should try to restore
+
+
+@mock_aws
+def test_get_saturation_counts(monkeypatch):
+    import app
+    results = [
+        {"Id": "m0", "Values": [30.0, 10.0]},
+        {"Id": "m0", "Values": [5.0]},
+        {"Id": "m2", "Values": [7.0, 2.0, 4.0]},
+        {"Id": "m1", "Values": []},
+    ]
+    with mock.patch.object(app.get_client("cloudwatch"), "get_metric_data", return_value={"MetricDataResults": results}) as mock_get:
+        counts = app.get_saturation_counts("alternat-nat-asg")
+    assert counts == {"conntrack_allowance_exceeded": 20, "bw_out_allowance_exceeded": 0, "pps_allowance_exceeded": 5}
+    assert 'AutoScalingGroupName="alternat-nat-asg"' in mock_get.call_args.kwargs["MetricDataQueries"][0]["Expression"]
+
+
+@mock_aws
+def test_check_saturation(monkeypatch, tmp_path):
+    import app
+    mocked_networking = setup_networking()
+    ec2_client = boto3.client("ec2")
+    instance_id, target = setup_nat_instance(mocked_networking)
+    route_tables = target["route_table_ids"]
+    metrics_file = tmp_path / "metrics.json"
+    monkeypatch.setenv("NAT_METRICS_FILE", str(metrics_file))
+    monkeypatch.setenv("SATURATION_SHIFT_FRACTION", "0.5")
+
+    # Below the threshold nothing moves
+    metrics_file.write_text(json.dumps({"conntrack_allowance_exceeded": 60, "pps_allowance_exceeded": 40}))
+    with mock.patch('app.fail_over_to_nat_gateway') as mock_fail_over:
+        app.check_saturation(target)
+        mock_fail_over.assert_not_called()
+
+    # Above it, half the route tables shift to the NAT Gateway
+    metrics_file.write_text(json.dumps({"conntrack_allowance_exceeded": 60, "bw_out_allowance_exceeded": 41}))
+    app.check_saturation(target)
+    assert app.get_nat_gateway_targets(route_tables) == {route_tables[1]: mocked_networking["nat_gw"]}
+    assert app.get_saturated_route_tables(route_tables) == [route_tables[1]]
+
+    # Restore leaves shifted route tables alone
+    monkeypatch.setenv("ENABLE_NAT_RESTORE", "true")
+    with mock.patch('app.probe_urls', return_value=True):
+        with mock.patch('app.attempt_nat_instance_restore') as mock_restore:
+            app.check_connection(["https://www.example.com"], target=target)
+            mock_restore.assert_not_called()
+
+    def expire_holddown():
+        states = app.load_route_states(route_tables)
+        app.record_route_states({
+            rtb: {"last_saturated": states[rtb]["last_saturated"] - 10000} for rtb in app.get_saturated_route_tables(route_tables)
+        })
+
+    # Even once load subsides they stay shifted for the hold-down
+    metrics_file.write_text(json.dumps({}))
+    with mock.patch('app.get_current_nat_instance_id', return_value=instance_id):
+        app.check_saturation(target)
+        assert app.get_saturated_route_tables(route_tables) == [route_tables[1]]
+
+        # After which they shift back to the NAT instance
+        expire_holddown()
+        app.check_saturation(target)
+    routes = ec2_client.describe_route_tables(RouteTableIds=[route_tables[1]])["RouteTables"][0]["Routes"]
+    assert any(route.get("InstanceId") == instance_id for route in routes)
+    assert app.get_saturated_route_tables(route_tables) == []
+
+    # Saturating again soon after doubles the hold-down
+    metrics_file.write_text(json.dumps({"conntrack_allowance_exceeded": 101}))
+    monkeypatch.setenv("SATURATION_SHIFT_FRACTION", "1")
+    app.check_saturation(target)
+    states = app.load_route_states(route_tables)
+    assert states[route_tables[1]]["saturation_shifts"] == 1
+    assert states[route_tables[0]]["saturation_shifts"] == 0
+    assert app.get_saturation_holddown(1) == 1200
+
+    # With every route table shifted the idle instance's counts are ignored, and the hold-down alone decides
+    metrics_file.write_text(json.dumps({"conntrack_allowance_exceeded": 5}))
+    expire_holddown()
+    with mock.patch('app.get_current_nat_instance_id', return_value=instance_id):
+        app.check_saturation(target)
+    assert app.get_saturated_route_tables(route_tables) == []
+
+    # A partial shift keeps the tester's own route table on the instance
+    metrics_file.write_text(json.dumps({"conntrack_allowance_exceeded": 101}))
+    monkeypatch.setenv("SATURATION_SHIFT_FRACTION", "0.5")
+    with mock.patch('app.get_tester_route_tables', return_value=[route_tables[1]]):
+        app.check_saturation(target)
+    assert app.get_saturated_route_tables(route_tables) == [route_tables[0]]
+
+
+def test_assign_route_tables():
+    from app import assign_route_tables
+    route_tables = [f"rtb-{i}" for i in range(6)]
+
+    assignment = assign_route_tables(route_tables, {"i-1": 2, "nat-1": 1})
+    assert sorted(assignment.values()).count("i-1") == 4
+
+    # Observed traffic outweighs the number of route tables
+    traffic = {"rtb-0": 100, "rtb-1": 30, "rtb-2": 30, "rtb-3": 30, "rtb-4": 5, "rtb-5": 5}
+    assignment = assign_route_tables(route_tables, {"i-1": 1, "nat-1": 1}, traffic)
+    assert [rtb for rtb, target in assignment.items() if target == "i-1"] == ["rtb-0"]
+
+    # Fixed route tables count towards their target's share
+    assignment = assign_route_tables(route_tables, {"i-1": 1, "nat-1": 1}, traffic, {"rtb-1": "i-1"})
+    assert assignment["rtb-1"] == "i-1"
+    assert assignment["rtb-0"] == "nat-1"
+
+
+@mock_aws
+def test_rebalance_route_tables(monkeypatch):
+    import app
+    mocked_networking = setup_networking()
+    instance_id, target = setup_nat_instance(mocked_networking)
+    route_tables = target["route_table_ids"]
+    app.replace_routes(route_tables, instance_id)
+    monkeypatch.setenv("LOAD_SHARING_WEIGHTS", json.dumps({"instance": 1, "gateway": 1}))
+    monkeypatch.setenv("ROUTE_TABLE_TRAFFIC", json.dumps({route_tables[0]: 10, route_tables[1]: 1}))
+
+    with mock.patch('app.get_current_nat_instance_id', return_value=instance_id):
+        app.rebalance_route_tables(target)
+        assert app.get_nat_gateway_targets(route_tables) == {route_tables[1]: mocked_networking["nat_gw"]}
+        assert app.get_flagged_route_tables(route_tables, "load_shared") == [route_tables[1]]
+
+        # Rebalancing waits for the interval
+        monkeypatch.setenv("ROUTE_TABLE_TRAFFIC", json.dumps({route_tables[0]: 1, route_tables[1]: 10}))
+        with mock.patch('app.replace_routes') as mock_replace_routes:
+            app.rebalance_route_tables(target)
+            mock_replace_routes.assert_not_called()
+
+        monkeypatch.setenv("LOAD_SHARING_INTERVAL", "0")
+        app.rebalance_route_tables(target)
+        assert app.get_nat_gateway_targets(route_tables) == {route_tables[0]: mocked_networking["nat_gw"]}
+
+        # Planned moves are neither failovers nor restores, so they don't hold down a NAT restore
+        states = app.load_route_states(route_tables)
+        assert all(state.get("restore_failures", 0) == 0 for state in states.values())
+        assert not app.is_restore_held_down(route_tables)
+
+        # Restore leaves the load shared route table on its NAT Gateway
+        monkeypatch.setenv("ENABLE_NAT_RESTORE", "true")
+        with mock.patch('app.probe_urls', return_value=True):
+            with mock.patch('app.attempt_nat_instance_restore') as mock_restore:
+                app.check_connection(["https://www.example.com"], target=target)
+                mock_restore.assert_not_called()
+
+        # A failover takes precedence until the route tables are restored
+        app.replace_routes(route_tables, mocked_networking["nat_gw"])
+        app.record_route_states({rtb: {"load_shared": False} for rtb in route_tables})
+        with mock.patch('app.replace_routes') as mock_replace_routes:
+            app.rebalance_route_tables(target)
+            mock_replace_routes.assert_not_called()
+
+
+@mock_aws
+def test_rebalance_keeps_tester_route_tables(monkeypatch):
+    import app
+    mocked_networking = setup_networking()
+    instance_id, target = setup_nat_instance(mocked_networking)
+    route_tables = target["route_table_ids"]
+    app.replace_routes(route_tables, instance_id)
+    monkeypatch.setenv("LOAD_SHARING_WEIGHTS", json.dumps({"instance": 1, "gateway": 1}))
+    monkeypatch.setenv("ROUTE_TABLE_TRAFFIC", json.dumps({route_tables[0]: 10, route_tables[1]: 1}))
+
+    # The tester's route table would go to the NAT Gateway, but stays on the instance
+    with mock.patch('app.get_tester_route_tables', return_value=[route_tables[1]]):
+        with mock.patch('app.get_current_nat_instance_id', return_value=instance_id):
+            app.rebalance_route_tables(target)
+    assert app.get_default_route_targets(route_tables) == {
+        route_tables[0]: mocked_networking["nat_gw"],
+        route_tables[1]: instance_id,
+    }
+
+
+@mock_aws
+def test_rebalance_without_usable_weights(monkeypatch):
+    import app
+    mocked_networking = setup_networking()
+    instance_id, target = setup_nat_instance(mocked_networking)
+    route_tables = target["route_table_ids"]
+    app.replace_routes(route_tables, instance_id)
+    monkeypatch.setenv("LOAD_SHARING_INTERVAL", "0")
+    monkeypatch.setenv("ROUTE_TABLE_TRAFFIC", json.dumps({route_tables[0]: 10, route_tables[1]: 1}))
+
+    with mock.patch('app.get_current_nat_instance_id', return_value=instance_id):
+        monkeypatch.setenv("LOAD_SHARING_WEIGHTS", json.dumps({"instance": 1, "gateway": 1}))
+        app.rebalance_route_tables(target)
+        assert app.get_nat_gateway_targets(route_tables) == {route_tables[1]: mocked_networking["nat_gw"]}
+
+        # All weights zero: the load shared route table goes back to the NAT instance
+        monkeypatch.setenv("LOAD_SHARING_WEIGHTS", json.dumps({"instance": 0, "gateway": 0}))
+        app.rebalance_route_tables(target)
+        assert app.get_nat_gateway_targets(route_tables) == {}
+        assert app.get_flagged_route_tables(route_tables, "load_shared") == []
+
+        # Every NAT Gateway filtered out and no instance weight
+        monkeypatch.setenv("LOAD_SHARING_WEIGHTS", json.dumps({"nat-0123456789abcdef0": 1}))
+        app.rebalance_route_tables(target)
+        assert app.get_nat_gateway_targets(route_tables) == {}
+
+
+def test_get_latency_summary(monkeypatch):
+    import app
+    for rtt in range(1, 11):
+        app.record_probe_latency("https://www.example.com", rtt * 100, True)
+    app.record_probe_latency("https://www.example.com", 5000, False)
+    summary = app.get_latency_summary("https://www.example.com")
+    assert summary["samples"] == 11
+    assert summary["p90"] == 900
+    assert summary["error_ratio"] == 1 / 11
+
+    # Samples older than the window are ignored
+    monkeypatch.setenv("BROWNOUT_WINDOW", "0")
+    assert app.get_latency_summary("https://www.example.com")["samples"] == 0
+
+
+@mock_aws
+def test_check_brownout(monkeypatch):
+    import app
+    mocked_networking = setup_networking()
+    ec2_client = boto3.client("ec2")
+    instance_id, target = setup_nat_instance(mocked_networking)
+    route_tables = target["route_table_ids"]
+    check_urls = ["https://www.example.com", "https://www.google.com"]
+    monkeypatch.setenv("ENABLE_BROWNOUT_DETECTION", "true")
+    monkeypatch.setenv("BROWNOUT_SHIFT_FRACTION", "0.5")
+    monkeypatch.setenv("BROWNOUT_MIN_SAMPLES", "3")
+
+    def record(rtts):
+        for url, rtt in zip(check_urls, rtts):
+            for _ in range(3):
+                app.record_probe_latency(url, rtt, True)
+
+    # One slow URL is not a brownout
+    record([3000, 100])
+    assert app.check_brownout(target, check_urls)
+    assert app.get_flagged_route_tables(route_tables, "brownout") == []
+
+    # Every URL slow shifts half the route tables
+    app.latency_samples.clear()
+    record([3000, 2500])
+    assert app.check_brownout(target, check_urls)
+    assert app.get_nat_gateway_targets(route_tables) == {route_tables[1]: mocked_networking["nat_gw"]}
+    assert app.get_flagged_route_tables(route_tables, "brownout") == [route_tables[1]]
+    assert app.latency_samples == {}
+
+    # Restore leaves them alone
+    monkeypatch.setenv("ENABLE_NAT_RESTORE", "true")
+    with mock.patch('app.probe_urls', return_value=True):
+        with mock.patch('app.attempt_nat_instance_restore') as mock_restore:
+            app.check_connection(check_urls, target=target)
+            mock_restore.assert_not_called()
+
+    # Probes from a tester whose route table shifted go through the NAT Gateway,
+    # and don't show the instance recovering
+    tester_subnet = ec2_client.create_subnet(VpcId=mocked_networking["vpc"], CidrBlock="10.1.6.0/24")["Subnet"]["SubnetId"]
+    ec2_client.associate_route_table(RouteTableId=route_tables[1], SubnetId=tester_subnet)
+    monkeypatch.setenv("TESTER_SUBNET_IDS", tester_subnet)
+    record([100, 100])
+    with mock.patch('app.get_current_nat_instance_id', return_value=instance_id):
+        with mock.patch('app.run_nat_instance_diagnostics', return_value=True) as mock_diagnostics:
+            assert app.check_brownout(target, check_urls)
+            mock_diagnostics.assert_not_called()
+    assert app.get_flagged_route_tables(route_tables, "brownout") == [route_tables[1]]
+    assert app.latency_samples == {}
+
+    # They shift back after the restore hold-down, once the instance is healthy
+    monkeypatch.setenv("NAT_RESTORE_HOLDDOWN", "0")
+    with mock.patch('app.get_current_nat_instance_id', return_value=instance_id):
+        with mock.patch('app.run_nat_instance_diagnostics', return_value=False):
+            assert app.check_brownout(target, check_urls)
+        assert app.get_flagged_route_tables(route_tables, "brownout") == [route_tables[1]]
+        with mock.patch('app.run_nat_instance_diagnostics', return_value=True):
+            assert app.check_brownout(target, check_urls)
+    routes = ec2_client.describe_route_tables(RouteTableIds=[route_tables[1]])["RouteTables"][0]["Routes"]
+    assert any(route.get("InstanceId") == instance_id for route in routes)
+    assert app.get_flagged_route_tables(route_tables, "brownout") == []
+
+    # A full shift is reported as a failover, and then ignores the tester's probes
+    monkeypatch.setenv("NAT_RESTORE_HOLDDOWN", "300")
+    monkeypatch.setenv("BROWNOUT_SHIFT_FRACTION", "1")
+    record([3000, 3000])
+    assert not app.check_brownout(target, check_urls)
+    record([100, 100])
+    assert not app.check_brownout(target, check_urls)
+    assert app.latency_samples == {}
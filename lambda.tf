@@ -6,6 +6,27 @@ locals {
   }
   has_ipv6_env_var = { "HAS_IPV6" = var.lambda_has_ipv6 }
   lambda_runtime   = "python3.12"
+  shard_env_var    = { "SHARD_ROUTE_TABLES" = var.nat_instances_per_az > 1 }
+
+  state_table_env_var = var.enable_state_table ? {
+    "STATE_TABLE_NAME" = aws_dynamodb_table.alternat_state[0].name
+  } : {}
+
+  # Ranked standby NAT Gateways for each NAT instance's public subnet, so that
+  # failover doesn't have to look them up. Other zones' NAT Gateways are only
+  # candidates when cross-AZ fallback is enabled.
+  cross_az_fallback = contains(
+    ["t", "true", "y", "yes", "1"],
+    lower(try(var.lambda_environment_variables["ENABLE_CROSS_AZ_FALLBACK"], "false")),
+  )
+  nat_gateway_candidates_env_var = var.create_nat_gateways ? {
+    "NAT_GATEWAY_CANDIDATES" = jsonencode({
+      for obj in var.vpc_az_maps : obj.public_subnet_id => concat(
+        [aws_nat_gateway.main[obj.az].id],
+        local.cross_az_fallback ? [for az, ngw in aws_nat_gateway.main : ngw.id if az != obj.az] : [],
+      )
+    })
+  } : {}
 }
 
 resource "archive_file" "lambda" {
@@ -37,7 +58,13 @@ resource "aws_lambda_function" "alternat_autoscaling_hook" {
   environment {
     variables = merge(
       local.autoscaling_func_env_vars,
-      { NAT_GATEWAY_ID = var.nat_gateway_id },
+      {
+        NAT_GATEWAY_ID = var.nat_gateway_id
+        VPC_ID         = var.vpc_id
+      },
+      local.state_table_env_var,
+      local.shard_env_var,
+      local.nat_gateway_candidates_env_var,
       var.lambda_environment_variables,
     )
   }
@@ -64,9 +91,12 @@ data "aws_iam_policy_document" "alternat_lambda_permissions" {
     sid    = "alterNATDescribePermissions"
     effect = "Allow"
     actions = [
+      "ec2:DescribeInstances",
+      "ec2:DescribeInstanceStatus",
       "ec2:DescribeNatGateways",
       "ec2:DescribeRouteTables",
       "ec2:DescribeSubnets",
+      "cloudwatch:GetMetricData",
     ]
     resources = ["*"]
   }
@@ -166,14 +196,24 @@ resource "aws_lambda_function" "alternat_connectivity_tester" {
   environment {
     variables = merge(
       {
-        ROUTE_TABLE_IDS_CSV = join(",", each.value.route_table_ids),
-        PUBLIC_SUBNET_ID    = each.value.public_subnet_id
-        CHECK_URLS          = join(",", var.connectivity_test_check_urls)
-        NAT_GATEWAY_ID      = var.nat_gateway_id
-        NAT_ASG_NAME        = aws_autoscaling_group.nat_instance[each.key].name
-        ENABLE_NAT_RESTORE  = var.enable_nat_restore
+        ROUTE_TABLE_IDS_CSV        = join(",", each.value.route_table_ids),
+        PUBLIC_SUBNET_ID           = each.value.public_subnet_id
+        TESTER_SUBNET_IDS          = join(",", each.value.private_subnet_ids)
+        CHECK_URLS                 = join(",", var.connectivity_test_check_urls)
+        NAT_GATEWAY_ID             = var.nat_gateway_id
+        VPC_ID                     = var.vpc_id
+        NAT_ASG_NAME               = aws_autoscaling_group.nat_instance[each.key].name
+        ENABLE_NAT_RESTORE         = var.enable_nat_restore
+        CLOUDWATCH_NAMESPACE       = var.cloudwatch_namespace
+        ENABLE_SATURATION_FAILOVER = var.enable_saturation_failover
+        ENABLE_LOAD_SHARING        = var.enable_load_sharing
+        ENABLE_BROWNOUT_DETECTION  = var.enable_brownout_detection
+        LOAD_SHARING_WEIGHTS       = jsonencode(var.load_sharing_weights)
       },
       local.has_ipv6_env_var,
+      local.state_table_env_var,
+      local.shard_env_var,
+      local.nat_gateway_candidates_env_var,
       var.lambda_environment_variables,
     )
   }
@@ -228,6 +268,97 @@ resource "aws_lambda_permission" "allow_cloudwatch_to_call_connectivity_tester"
   source_arn    = aws_cloudwatch_event_rule.every_minute.arn
 }
 
+# Fail over immediately when a NAT instance stops or fails its status checks.
+# The autoscaling hook function handles these events and ignores instances
+# that are not NAT instances.
+resource "aws_cloudwatch_event_rule" "nat_instance_state_change" {
+  count = var.enable_event_driven_failover ? 1 : 0
+
+  name_prefix = "alternat-instance-state-change-"
+  description = "NAT instance stopping or terminating"
+  event_pattern = jsonencode({
+    source      = ["aws.ec2"]
+    detail-type = ["EC2 Instance State-change Notification"]
+    detail = {
+      state = ["stopping", "stopped", "shutting-down", "terminated"]
+    }
+  })
+  tags = var.tags
+}
+
+resource "aws_cloudwatch_metric_alarm" "nat_instance_status_check" {
+  for_each = var.enable_event_driven_failover ? aws_autoscaling_group.nat_instance : {}
+
+  alarm_name          = "alternat-status-check-failed-${each.key}"
+  alarm_description   = "alterNAT instance in ${each.key} failed its status checks"
+  namespace           = "AWS/EC2"
+  metric_name         = "StatusCheckFailed"
+  statistic           = "Maximum"
+  period              = 60
+  evaluation_periods  = 1
+  threshold           = 1
+  comparison_operator = "GreaterThanOrEqualToThreshold"
+  treat_missing_data  = "notBreaching"
+  dimensions = {
+    AutoScalingGroupName = each.value.name
+  }
+  tags = var.tags
+}
+
+resource "aws_cloudwatch_event_rule" "nat_instance_alarm" {
+  count = var.enable_event_driven_failover ? 1 : 0
+
+  name_prefix = "alternat-instance-alarm-"
+  description = "NAT instance status check alarm"
+  event_pattern = jsonencode({
+    source      = ["aws.cloudwatch"]
+    detail-type = ["CloudWatch Alarm State Change"]
+    resources   = [for alarm in aws_cloudwatch_metric_alarm.nat_instance_status_check : alarm.arn]
+    detail = {
+      state = {
+        value = ["ALARM"]
+      }
+    }
+  })
+  tags = var.tags
+}
+
+resource "aws_cloudwatch_event_target" "nat_instance_state_change" {
+  count = var.enable_event_driven_failover ? 1 : 0
+
+  rule      = aws_cloudwatch_event_rule.nat_instance_state_change[0].name
+  target_id = "alternat-failover-state-change"
+  arn       = aws_lambda_function.alternat_autoscaling_hook.arn
+}
+
+resource "aws_cloudwatch_event_target" "nat_instance_alarm" {
+  count = var.enable_event_driven_failover ? 1 : 0
+
+  rule      = aws_cloudwatch_event_rule.nat_instance_alarm[0].name
+  target_id = "alternat-failover-alarm"
+  arn       = aws_lambda_function.alternat_autoscaling_hook.arn
+}
+
+resource "aws_lambda_permission" "allow_state_change_to_call_autoscaling_hook" {
+  count = var.enable_event_driven_failover ? 1 : 0
+
+  statement_id  = "AllowExecutionFromInstanceStateChange"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.alternat_autoscaling_hook.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.nat_instance_state_change[0].arn
+}
+
+resource "aws_lambda_permission" "allow_alarm_to_call_autoscaling_hook" {
+  count = var.enable_event_driven_failover ? 1 : 0
+
+  statement_id  = "AllowExecutionFromInstanceAlarm"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.alternat_autoscaling_hook.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.nat_instance_alarm[0].arn
+}
+
 data "aws_iam_policy_document" "lambda_ssm_send_command_document" {
   statement {
     sid    = "AllowSSMSendCommandOnDocument"
@@ -273,8 +404,46 @@ data "aws_iam_policy_document" "lambda_ssm_send_command_document" {
 }
 
 resource "aws_iam_role_policy" "lambda_ssm_send_command_policy" {
-  count  = var.enable_nat_restore ? 1 : 0
+  count  = var.enable_nat_restore || var.enable_brownout_detection || var.nat_instances_per_az > 1 ? 1 : 0
   name   = "AllowLambdaToSendSSMCommand"
   role   = aws_iam_role.nat_lambda_role.id
   policy = data.aws_iam_policy_document.lambda_ssm_send_command_document.json
 }
+
+# Route state shared by the Lambda functions, used to skip route table lookups
+# and hold off restoring a NAT instance shortly after failing over
+resource "aws_dynamodb_table" "alternat_state" {
+  count = var.enable_state_table ? 1 : 0
+
+  name         = var.state_table_name
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "RouteTableId"
+
+  attribute {
+    name = "RouteTableId"
+    type = "S"
+  }
+
+  tags = var.tags
+}
+
+data "aws_iam_policy_document" "lambda_state_table" {
+  count = var.enable_state_table ? 1 : 0
+
+  statement {
+    sid    = "alterNATStateTablePermissions"
+    effect = "Allow"
+    actions = [
+      "dynamodb:BatchGetItem",
+      "dynamodb:UpdateItem",
+    ]
+    resources = [aws_dynamodb_table.alternat_state[0].arn]
+  }
+}
+
+resource "aws_iam_role_policy" "lambda_state_table" {
+  count  = var.enable_state_table ? 1 : 0
+  name   = "alternat-lambda-state-table-policy"
+  role   = aws_iam_role.nat_lambda_role.id
+  policy = data.aws_iam_policy_document.lambda_state_table[0].json
+}
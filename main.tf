@@ -35,9 +35,10 @@ locals {
     : {}
   )
 
-  # Must provide exactly 1 EIP per AZ
-  # var.nat_instance_eip_ids ignored if doesn't match AZ count
-  reuse_nat_instance_eips = length(var.nat_instance_eip_ids) == length(var.vpc_az_maps)
+  # Must provide exactly 1 EIP per NAT instance
+  # var.nat_instance_eip_ids ignored if doesn't match the NAT instance count
+  nat_instance_count      = length(var.vpc_az_maps) * var.nat_instances_per_az
+  reuse_nat_instance_eips = length(var.nat_instance_eip_ids) == local.nat_instance_count
   nat_instance_eip_ids    = local.reuse_nat_instance_eips ? var.nat_instance_eip_ids : (var.prevent_destroy_eips ? aws_eip.protected_nat_instance_eips[*].id : aws_eip.nat_instance_eips[*].id)
   nat_instance_eips       = var.prevent_destroy_eips ? aws_eip.protected_nat_instance_eips : aws_eip.nat_instance_eips
   nat_gateway_eips        = var.prevent_destroy_eips ? aws_eip.protected_nat_gateway_eips : aws_eip.nat_gateway_eips
@@ -58,7 +59,7 @@ locals {
 resource "aws_eip" "protected_nat_instance_eips" {
   count = (local.reuse_nat_instance_eips
     ? 0
-  : var.prevent_destroy_eips ? length(var.vpc_az_maps) : 0)
+  : var.prevent_destroy_eips ? local.nat_instance_count : 0)
 
   tags = merge(var.tags, {
     "Name" = "alternat-instance-${count.index}"
@@ -72,7 +73,7 @@ resource "aws_eip" "protected_nat_instance_eips" {
 resource "aws_eip" "nat_instance_eips" {
   count = (local.reuse_nat_instance_eips
     ? 0
-  : (var.prevent_destroy_eips ? 0 : length(var.vpc_az_maps)))
+  : (var.prevent_destroy_eips ? 0 : local.nat_instance_count))
 
   tags = merge(var.tags, {
     "Name" = "alternat-instance-${count.index}"
@@ -89,8 +90,8 @@ resource "aws_autoscaling_group" "nat_instance" {
   for_each = { for obj in var.vpc_az_maps : obj.az => obj.public_subnet_id }
 
   name_prefix           = var.nat_instance_name_prefix
-  max_size              = 1
-  min_size              = 1
+  max_size              = var.nat_instances_per_az
+  min_size              = var.nat_instances_per_az
   max_instance_lifetime = var.max_instance_lifetime
   vpc_zone_identifier   = [each.value]
 
@@ -202,6 +203,7 @@ data "cloudinit_config" "config" {
       route_table_ids_csv     = join(",", each.value),
       enable_ssm              = var.enable_ssm,
       enable_cloudwatch_agent = var.enable_cloudwatch_agent
+      shard_route_tables      = var.nat_instances_per_az > 1
     })
   }
 
@@ -24,6 +24,7 @@ load_config() {
    validate_var "route_table_ids_csv" "$route_table_ids_csv"
    validate_var "enable_ssm" "$enable_ssm"
    validate_var "enable_cloudwatch_agent" "$enable_cloudwatch_agent"
+   validate_var "shard_route_tables" "$shard_route_tables"
 }
 
 validate_var() {
@@ -134,6 +135,8 @@ function associate_eip() {
 
 # First try to replace an existing route
 # If no route exists already (e.g. first time set up) then create the route.
+# When route tables are sharded across several NAT instances, existing routes
+# are left for the replace-route function to assign to their shard owner.
 configure_route_table() {
    echo "Configuring route tables"
 
@@ -148,6 +151,13 @@ configure_route_table() {
       fi
 
       echo "Found route table $rtb_id"
+      if [ "$shard_route_tables" = "true" ]; then
+         local default_route=$(aws ec2 describe-route-tables --route-table-ids "$rtb_id" --query 'RouteTables[0].Routes[?DestinationCidrBlock==`0.0.0.0/0`] | length(@)')
+         if [ "$default_route" != "0" ]; then
+            echo "Route tables are sharded, leaving the existing route to 0.0.0.0/0 for $rtb_id"
+            continue
+         fi
+      fi
       echo "Replacing route to 0.0.0.0/0 for $rtb_id"
       aws ec2 replace-route --route-table-id "$rtb_id" --instance-id "$INSTANCE_ID" --destination-cidr-block 0.0.0.0/0
       if [ $? -eq 0 ]; then
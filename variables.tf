@@ -67,6 +67,24 @@ variable "enable_ssm" {
   default     = true
 }
 
+variable "enable_event_driven_failover" {
+  description = "Whether to fail over as soon as a NAT instance stops or fails its status checks, without waiting for the next connectivity test."
+  type        = bool
+  default     = false
+}
+
+variable "enable_state_table" {
+  description = "Whether to keep route state in a DynamoDB table shared by the Lambda functions. The table must be reachable from the Lambda subnets without the NAT instance, for example through a DynamoDB gateway endpoint."
+  type        = bool
+  default     = false
+}
+
+variable "state_table_name" {
+  description = "Name of the DynamoDB table created when enable_state_table is true."
+  type        = string
+  default     = "alternat-state"
+}
+
 variable "enable_nat_restore" {
   description = "Whether to enable NAT restore functionality."
   type        = bool
@@ -163,11 +181,17 @@ variable "nat_instance_type" {
   default     = "c6gn.8xlarge"
 }
 
+variable "nat_instances_per_az" {
+  description = "Number of NAT instances in each zone. With more than one, route tables are sharded across the instances by consistent hashing."
+  type        = number
+  default     = 1
+}
+
 variable "nat_instance_eip_ids" {
   description = <<-EOT
   Allocation IDs of Elastic IPs to associate with the NAT instances. If not specified, EIPs will be created.
 
-  Note: if the number of EIPs does not match the number of subnets specified in `vpc_public_subnet_ids`, this variable will be ignored.
+  Note: if the number of EIPs does not match the number of subnets specified in `vpc_public_subnet_ids` multiplied by `nat_instances_per_az`, this variable will be ignored.
   EOT
   type        = list(string)
   default     = []
@@ -306,6 +330,33 @@ variable "cloudwatch_namespace" {
   default     = "alterNAT"
 }
 
+variable "enable_saturation_failover" {
+  description = "Whether to shift route tables to the standby NAT Gateway while a NAT instance exceeds its EC2 network allowances. Requires enable_cloudwatch_agent."
+  type        = bool
+  default     = false
+}
+
+variable "enable_brownout_detection" {
+  description = "Whether to shift route tables to the standby NAT Gateway while connectivity checks through a NAT instance are slow or intermittently failing."
+  type        = bool
+  default     = false
+}
+
+variable "enable_load_sharing" {
+  description = "Whether to split each zone's route tables between its NAT instance and NAT Gateways according to load_sharing_weights."
+  type        = bool
+  default     = false
+}
+
+variable "load_sharing_weights" {
+  description = "Share of route tables for each target when enable_load_sharing is true. \"instance\" is the NAT instance, \"gateway\" the zone's standby NAT Gateway, and other keys are NAT Gateway IDs."
+  type        = map(number)
+  default = {
+    instance = 3
+    gateway  = 1
+  }
+}
+
 variable "cloudwatch_interfaces" {
   description = "List of NAT instance interfaces that should be monitored by the CloudWatch Agent"
   type        = list(string)